@@ -19,6 +19,7 @@ Email: aus.poli1@gmail.com
 
 # Imports
 import os
+import io
 import sys
 import json
 import time
@@ -31,14 +32,16 @@ import logzero
 import redis
 
 from functools import wraps
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
 from json.decoder import JSONDecodeError
 from tempfile import NamedTemporaryFile
-from collections import defaultdict
+from collections import defaultdict, OrderedDict
 from klein import Klein, resource
 from logzero import logger
 from Crypto import Random
 from twisted.web.resource import Resource
-from twisted.internet import reactor, task, endpoints
+from twisted.internet import reactor, task, endpoints, threads, defer
 from twisted.web.server import Request, Site
 from twisted.python import log
 from twisted.internet.protocol import Factory
@@ -59,8 +62,10 @@ from neocore.Cryptography.Crypto import Crypto
 from uuid import uuid4
 from uuid import UUID
 
-# Import the smart contract queue handler.
+# Import the smart contract queue handler and storage reader.
 from LootMarketHandler import LootMarketsSmartContract
+from LootMarketStorage import ContractStorage
+from LootMarketBulk import read_grant_rows, chunk_grants
 
 # Allow importing 'neo' from parent path
 current_dir = os.path.dirname(os.path.abspath(__file__))
@@ -81,6 +86,40 @@ PROTOCOL_CONFIG = os.path.join(parent_dir, "protocol.faucet.json")
 WALLET_FILE = "/home/ec2-user/neo-python/poli.wallet"
 WALLET_PWD = os.getenv("WALLET_PWD", "password123")
 
+# Additional wallets, separated by commas, which invokes are spread over. They share the wallet password
+# and each one must be registered as an operator of the marketplace with add_marketplace_operator.
+WALLET_FILES = [WALLET_FILE] + [path for path in os.getenv("WALLET_FILES", "").split(",") if path]
+
+# The maximum number of invoke transactions of each wallet waiting for confirmation at once.
+MAX_IN_FLIGHT = int(os.getenv("MAX_IN_FLIGHT", "4"))
+
+# The maximum number of items queued give_items calls for an address may be merged into.
+MAX_COALESCED_ITEMS = int(os.getenv("MAX_COALESCED_ITEMS", "32"))
+
+# The maximum number of queued operations packed into the script of one transaction.
+MAX_PACKED_OPERATIONS = int(os.getenv("MAX_PACKED_OPERATIONS", "8"))
+
+# The number of small GAS outputs each wallet is kept split into, and the GAS value of each output.
+UTXO_SPLIT_COUNT = int(os.getenv("UTXO_SPLIT_COUNT", "20"))
+UTXO_SPLIT_AMOUNT = float(os.getenv("UTXO_SPLIT_AMOUNT", "0.01"))
+
+# The number of threads running the blocking work of the request handlers, so the storage reads, redis calls and
+# wallet operations do not block the reactor.
+ROUTE_THREADS = int(os.getenv("ROUTE_THREADS", "15"))
+
+# The maximum number of transaction keys and addresses one event stream may subscribe to,
+# and the seconds between the keepalive comments of the streams.
+MAX_EVENT_TOPICS = int(os.getenv("MAX_EVENT_TOPICS", "100"))
+EVENT_KEEPALIVE = int(os.getenv("EVENT_KEEPALIVE", "15"))
+
+# The maximum number of keys a batch read may ask for, and the number of threads reading the keys missing the cache.
+MAX_BATCH_KEYS = int(os.getenv("MAX_BATCH_KEYS", "500"))
+BATCH_READ_THREADS = int(os.getenv("BATCH_READ_THREADS", "8"))
+
+# The maximum number of rows of a bulk grant, and of invalid rows reported when a bulk grant is rejected.
+MAX_BULK_GRANT_ROWS = int(os.getenv("MAX_BULK_GRANT_ROWS", "100000"))
+MAX_BULK_GRANT_ERRORS = int(os.getenv("MAX_BULK_GRANT_ERRORS", "100"))
+
 # Log file settings.
 LOGFILE = os.path.join(parent_dir, "LootToken.log")
 logzero.logfile(LOGFILE, maxBytes=1e7, backupCount=3)
@@ -100,8 +139,13 @@ if not API_AUTH_TOKEN:
         raise Exception("No API_AUTH_TOKEN environment variable found")
 
 # Setup the smart contract and cache.
-smart_contract = LootMarketsSmartContract(CONTRACT_HASH, WALLET_FILE, WALLET_PWD)
+smart_contract = LootMarketsSmartContract(CONTRACT_HASH, WALLET_FILES, WALLET_PWD, MAX_IN_FLIGHT, MAX_COALESCED_ITEMS,
+                                          MAX_PACKED_OPERATIONS, UTXO_SPLIT_COUNT, UTXO_SPLIT_AMOUNT)
 redis_cache = redis.StrictRedis(host='localhost', port=6379, db=0)
+contract_storage = ContractStorage(CONTRACT_HASH, smart_contract.marketplace)
+
+# Reads the keys of the batch reads which miss the cache, shared by all the batch requests so their parallelism is bounded.
+batch_executor = ThreadPoolExecutor(max_workers=BATCH_READ_THREADS)
 
 # Setup web app.
 app = Klein()
@@ -139,9 +183,15 @@ def json_response(func):
 
     @wraps(func)
     def wrapper(request, *args, **kwargs):
+        def dump(res):
+            request.setHeader('Content-Type', 'application/json')
+            return json.dumps(res) if isinstance(res, dict) else res
+
         res = func(request, *args, **kwargs)
-        request.setHeader('Content-Type', 'application/json')
-        return json.dumps(res) if isinstance(res, dict) else res
+        # The response of the work done in the thread pool is dumped once it is done, on the reactor thread.
+        if isinstance(res, defer.Deferred):
+            return res.addCallback(dump)
+        return dump(res)
 
     return wrapper
 
@@ -149,15 +199,21 @@ def json_response(func):
 def catch_exceptions(func):
     """ @catch_exceptions decorator which handles generic exceptions in the request handler """
 
+    def handle_error(request, e):
+        logger.exception(e)
+        request.setResponseCode(500)
+        request.setHeader('Content-Type', 'application/json')
+        return build_error(STATUS_ERROR_GENERIC, str(e))
+
     @wraps(func)
     def wrapper(request, *args, **kwargs):
         try:
             res = func(request, *args, **kwargs)
         except Exception as e:
-            logger.exception(e)
-            request.setResponseCode(500)
-            request.setHeader('Content-Type', 'application/json')
-            return build_error(STATUS_ERROR_GENERIC, str(e))
+            return handle_error(request, e)
+        # The exceptions of the work done in the thread pool are handled once it is done, on the reactor thread.
+        if isinstance(res, defer.Deferred):
+            return res.addErrback(lambda failure: handle_error(request, failure.value))
         return res
 
     return wrapper
@@ -176,6 +232,139 @@ def request_header(request):
     request.setHeader('Content-type', 'application/json')
 
 
+def in_thread(func, *args, **kwargs):
+    """
+    Run the blocking work of a request handler, such as storage reads, redis calls and invokes, on the bounded
+    reactor thread pool, so it never holds up the reactor thread serving the connections.
+
+    The Twisted Request is not thread safe: the handler reads the request and sets its headers on the reactor
+    thread, and only hands the arguments it read to the work. The callbacks of the returned Deferred run on the
+    reactor thread, where the response code and body are set.
+
+    :param func:function The blocking work.
+    :return:
+        Deferred: Fires with the result of the work.
+    """
+    return threads.deferToThread(func, *args, **kwargs)
+
+
+def cached_read(request, operation, args, tags, compute):
+    """
+    Read a contract query through the block height cache, reporting the cache hit in the response headers.
+    Identical queries missing the cache at the same time share one read.
+
+    :param request:Request The request being answered.
+    :param operation:str The name of the query.
+    :param args:tuple The arguments of the query.
+    :param tags:list The cache tags the result depends on.
+    :param compute:function Reads the result on a cache miss.
+    :return:
+        Deferred: Fires with the result of the query.
+    """
+    def report(result):
+        value, status, height = result
+        request.setHeader('X-Cache', status)
+        request.setHeader('X-Cache-Height', str(height))
+        return value
+
+    return in_thread(smart_contract.read_cache.get, operation, args, tags, compute).addCallback(report)
+
+
+def query_param(request, name, default=None):
+    """
+    Read a query string parameter of a request.
+
+    :param request:Request The request being answered.
+    :param name:str The name of the parameter.
+    :param default: The value if the parameter is not given.
+    :return:
+        str: The value of the parameter.
+    """
+    values = request.args.get(name.encode("utf-8"))
+    if not values:
+        return default
+    return values[0].decode("utf-8")
+
+
+def transaction_status(transaction_key):
+    """
+    Read the status of the transaction of an operation from the cache.
+
+    :param transaction_key:str The transaction key of the operation.
+    :return:
+        dict: Whether the transaction was found, its block height, whether the operation completed,
+        and its dead letter if it failed.
+    """
+    # The confirmation tracker records the status of the transaction as blocks are persisted.
+    confirmation = smart_contract.search_tx(transaction_key)
+
+    was_transaction_found = None
+    block_height = None
+    if confirmation is not None:
+        was_transaction_found = str(confirmation["status"] == smart_contract.confirmations.CONFIRMED)
+        block_height = confirmation["height"]
+
+    operation_complete = None
+    # If the transaction was found we can check if the operation was successfully completed.
+    if was_transaction_found == "True":
+        # Results are saved under the transaction key of the operation.
+        operation_complete = redis_cache.get("result:%s" % transaction_key)
+        if operation_complete is not None:
+            operation_complete = bool(int.from_bytes(operation_complete, byteorder='little'))
+
+    return {
+        "tx_found": was_transaction_found,
+        "block_height": block_height,
+        "operation_complete": operation_complete,
+        "dead_letter": smart_contract.dead_letters.get(transaction_key)
+    }
+
+
+def batch_keys(request, name):
+    """
+    Read the list of keys of a batch read from the JSON body of the request.
+
+    :param request:Request The request being answered.
+    :param name:str The name of the list in the body, e.g. "addresses".
+    :return:
+        list: The keys without duplicates, in the order given.
+    :raises ValueError: If the body is not JSON or the list is missing or too long.
+    """
+    body = json.loads(request.content.read().decode("utf-8"))
+    keys = body.get(name) if isinstance(body, dict) else None
+    if not isinstance(keys, list) or not all(isinstance(key, str) for key in keys):
+        raise ValueError("The request body must contain a list of strings %s" % name)
+    keys = list(OrderedDict.fromkeys(keys))
+    if len(keys) > MAX_BATCH_KEYS:
+        raise ValueError("A batch may read at most %s %s" % (MAX_BATCH_KEYS, name))
+    return keys
+
+
+def batch_read(keys, read, results=None):
+    """
+    Read many keys with bounded parallelism, reporting the keys which failed instead of failing the batch.
+
+    :param keys:list The keys to read.
+    :param read:function Called with a key to read its result, on the batch executor.
+    :param results:dict The results already read, such as from a cache, the keys in it are not read again.
+    :return:
+        dict: The results of the keys read, by key, and the error of each key which failed.
+    """
+    results = dict(results or {})
+    errors = {}
+    futures = [(key, batch_executor.submit(read, key)) for key in keys if key not in results]
+    for key, future in futures:
+        try:
+            results[key] = future.result()
+        except Exception as e:
+            errors[key] = str(e)
+
+    return {
+        "results": dict((key, results[key]) for key in keys if key in results),
+        "errors": errors
+    }
+
+
 def build_error(error_code, error_message, to_json=True):
     """ Builder for generic errors. """
     res = {
@@ -226,31 +415,86 @@ def search_transaction(request, transaction_key, address, operation):
     :param operation:str Which smart contract operation to check if was successfully completed.
     :returns
         tx_found:bool Whether the transaction was found.
+        block_height:int The height of the block the transaction was confirmed in.
         operation_complete:bool Whether the smart contract invocation was successful in operation.
+        dead_letter:dict Why the operation failed, if it was moved to the dead letters without being invoked.
     """
     request_header(request)
 
-    # Search to see if we can find the transaction on the blockchain.
-    smart_contract.search_tx(transaction_key)
+    # The result is looked up by the transaction key alone, the address and operation are kept in the route for
+    # the games which already use it.
+    return in_thread(transaction_status, transaction_key)
 
-    # Get if the transaction was found from the redis_cache.
-    was_transaction_found = redis_cache.get("tx%s" % transaction_key)
 
-    # If the transaction was found we can decode it.
-    if was_transaction_found is not None:
-        was_transaction_found = was_transaction_found.decode("utf-8")
+@app.route('/events')
+@authenticated
+def stream_events(request):
+    """
+    Stream the results of operations as Server-Sent Events, instead of polling /search for them.
+    Each event is pushed as soon as the Notify of the operation is written to the cache, or when the operation
+    is moved to the dead letters. The current status of each transaction key subscribed to is sent first.
 
-    operation_complete = None
-    # If the transaction was found we can check if the operation was successfully completed.
-    if was_transaction_found == "True":
-        operation_complete = redis_cache.get(operation+"%s" % address)
-        if operation_complete is not None:
-            operation_complete = bool(int.from_bytes(operation_complete, byteorder='little'))
+    Query parameters, each may be given many times:
+        transaction_key:str A transaction key to receive the result of.
+        address:str An address to receive the results of the operations of.
 
-    return {
-        "tx_found": was_transaction_found,
-        "operation_complete": operation_complete
-    }
+    :returns
+        A stream of "result" and "dead_letter" events, whose data is the JSON object /search returns with the
+        transaction_key, operation, address and tx_hash of the operation, and "status" events for the current status.
+    """
+    request_header(request)
+    transaction_keys = [key.decode("utf-8") for key in request.args.get(b"transaction_key", [])]
+    addresses = [address.decode("utf-8") for address in request.args.get(b"address", [])]
+
+    topics = [smart_contract.events.transaction_topic(key) for key in transaction_keys] + \
+             [smart_contract.events.address_topic(address) for address in addresses]
+    if not topics or len(topics) > MAX_EVENT_TOPICS:
+        request.setResponseCode(400)
+        return build_error(STATUS_ERROR_GENERIC, "Subscribe to between 1 and %s transaction keys and addresses" % MAX_EVENT_TOPICS)
+
+    request.setHeader('Content-Type', 'text/event-stream')
+    request.setHeader('Cache-Control', 'no-cache')
+    finished = []
+
+    def write_event(event):
+        # Only called on the reactor thread.
+        if not finished:
+            request.write(("event: %s\ndata: %s\n\n" % (event["type"], json.dumps(event))).encode("utf-8"))
+
+    def push(event):
+        reactor.callFromThread(write_event, event)
+
+    def keepalive():
+        if not finished:
+            request.write(b": keepalive\n\n")
+
+    subscription = smart_contract.events.subscribe(topics, push)
+    keepalive_loop = task.LoopingCall(keepalive)
+    keepalive_loop.start(EVENT_KEEPALIVE, now=True)
+
+    # Klein finishes the request as soon as the route returns anything but a Deferred, so the route returns
+    # one which only fires once the client disconnects.
+    closed = defer.Deferred()
+
+    def on_finish(_):
+        finished.append(True)
+        smart_contract.events.unsubscribe(subscription)
+        keepalive_loop.stop()
+        closed.callback(None)
+
+    request.notifyFinish().addBoth(on_finish)
+
+    # Send the current status of the transaction keys, their result may have been written before subscribing.
+    def send_statuses(statuses):
+        for transaction_key, status in statuses:
+            status.update({"type": "status", "transaction_key": transaction_key})
+            write_event(status)
+
+    statuses = threads.deferToThread(lambda: [(key, transaction_status(key)) for key in transaction_keys])
+    statuses.addCallback(send_statuses)
+    statuses.addErrback(lambda failure: logger.error(failure.getErrorMessage()))
+
+    return closed
 
 
 @app.route('/inventory/<address>')
@@ -259,26 +503,157 @@ def search_transaction(request, transaction_key, address, operation):
 @authenticated
 def get_inventory(request, address):
     """
-    Test invoke the contract to query the inventory of the address on a marketplace.
+    Read the inventory of the address on a marketplace from its inventory materialized in redis.
 
     :param address:str The address to query for items.
 
     :returns
         address:str The address of a player, returned to the game to ensure we have the correct address.
-        inventory:str The items the inventory of the address contains.
+        inventory:str The item ids the inventory of the address contains, formatted as the repr of the bytes of
+            the list, such as "b'[1, 2, 3]'", which the games already parse. /inventory/batch returns the lists.
     """
     request_header(request)
 
-    # Test invoke the operation to get a result.
-    smart_contract.test_invoke("market","get_inventory",address)
+    # The inventory keeps the format of the inventories read from the cache, the bytes of the list as a string.
+    def respond(inventory):
+        return {
+            "address": address,
+            "inventory": str(str(inventory).encode("utf-8"))
+        }
 
-    # Get the inventory from cache.
-    inventory = str(redis_cache.get("inventory:%s" % address))
+    # Read the inventory materialized in redis, it is loaded from the contract storage the first time it is read.
+    return in_thread(smart_contract.inventories.get, address).addCallback(respond)
 
-    return {
-        "address": address,
-        "inventory": inventory
-    }
+
+@app.route('/inventory/batch', methods=['POST'])
+@catch_exceptions
+@json_response
+@authenticated
+def get_inventories(request):
+    """
+    Read the inventories of many addresses at once. The inventories materialized in redis are read in one
+    round trip, the others are loaded from the contract storage in parallel.
+
+    Request body:
+        addresses:list The addresses to read the inventories of, at most MAX_BATCH_KEYS.
+
+    :returns
+        results:dict The item ids of each address read.
+        errors:dict The error of each address which could not be read.
+    """
+    request_header(request)
+    try:
+        addresses = batch_keys(request, "addresses")
+    except ValueError as e:
+        request.setResponseCode(400)
+        return build_error(STATUS_ERROR_JSON, "JSON Error: %s" % str(e))
+    return in_thread(lambda: batch_read(addresses, smart_contract.inventories.get,
+                                        smart_contract.inventories.get_many(addresses)))
+
+
+@app.route('/inventory/give/bulk', methods=['POST'])
+@catch_exceptions
+@authenticated
+@json_response
+def give_items_bulk(request):
+    """
+    Grant items to many addresses as one job. The rows are validated as a whole and nothing is queued if any
+    row is invalid, so a corrected grant can be uploaded again without giving items twice. The items of each
+    address are merged and queued as the fewest give_items invocations of at most MAX_COALESCED_ITEMS items.
+
+    Request body, by Content-Type:
+        application/json: A list of rows {"address": str, "item_ids": [int]} or [address, [item_ids]].
+        application/x-ndjson: One JSON row per line.
+        text/csv: One row per line, the address followed by one item id per column.
+
+    :returns
+        job_id:str The id to read the progress of the job with from /inventory/give/bulk/<job_id>.
+        rows:int The number of rows of the grant.
+        addresses:int The number of addresses given items.
+        items:int The number of items given.
+        invocations:int The number of give_items invocations queued.
+    """
+    request_header(request)
+    body = request.content.read()
+    content_type = request.getHeader("Content-Type")
+
+    def respond(result):
+        code, response = result
+        request.setResponseCode(code)
+        return response
+
+    # Validating the rows hashes every address, it is done in the thread pool with the queuing.
+    return in_thread(grant_items, body, content_type).addCallback(respond)
+
+
+def grant_items(body, content_type):
+    """
+    Validate the rows of a bulk grant and queue its invocations, run in the thread pool.
+
+    :param body:bytes The body of the request.
+    :param content_type:str The content type of the body.
+    :return:
+        tuple: The response code, and the progress of the job or the invalid rows.
+    """
+    rows = []
+    errors = []
+    for row_number, address, item_ids, error in read_grant_rows(io.BytesIO(body), content_type):
+        if error is not None:
+            errors.append({"row": row_number, "error": error})
+            if len(errors) >= MAX_BULK_GRANT_ERRORS:
+                break
+        elif len(rows) >= MAX_BULK_GRANT_ROWS:
+            errors.append({"row": row_number, "error": "A bulk grant may have at most %s rows" % MAX_BULK_GRANT_ROWS})
+            break
+        else:
+            rows.append((address, item_ids))
+
+    if errors or not rows:
+        error = build_error(STATUS_ERROR_JSON, "Invalid rows, nothing was queued", to_json=False)
+        error["errors"] = errors or [{"row": 0, "error": "The grant has no rows"}]
+        return 400, error
+
+    invocations = chunk_grants(rows, MAX_COALESCED_ITEMS)
+
+    job_id = UUIDEncoder.default(None, uuid4())
+    smart_contract.bulk_grants.create(job_id, len(rows), len(set(address for address, item_ids in invocations)),
+                                      sum(len(item_ids) for address, item_ids in invocations), len(invocations))
+
+    # The address we are giving the items to is the first of the args.
+    smart_contract.add_invokes("give_items", [(smart_contract.bulk_grants.transaction_key(job_id, number),
+                                               [address] + item_ids)
+                                              for number, (address, item_ids) in enumerate(invocations)])
+
+    return 200, smart_contract.bulk_grants.get(job_id)
+
+
+@app.route('/inventory/give/bulk/<job_id>')
+@catch_exceptions
+@authenticated
+@json_response
+def give_items_bulk_progress(request, job_id):
+    """
+    Read the progress of a bulk grant.
+
+    :param job_id:str The id of the job returned by /inventory/give/bulk.
+    :returns
+        job_id:str The id of the job.
+        rows, addresses, items, invocations:int The size of the grant.
+        completed:int The invocations the contract completed.
+        rejected:int The invocations the contract refused, such as when the wallet is not an operator.
+        dead_lettered:int The invocations which failed to be relayed, see /queue/dead_letters.
+        pending:int The invocations without a result yet.
+        done:bool Whether every invocation has a result.
+    """
+    request_header(request)
+
+    def respond(job):
+        if job is None:
+            request.setResponseCode(404)
+            return build_error(STATUS_ERROR_GENERIC, "No bulk grant %s" % job_id)
+        return job
+
+    return in_thread(smart_contract.bulk_grants.get, job_id).addCallback(respond)
 
 
 @app.route('/inventory/give/<address>/<item_ids>')
@@ -307,11 +682,11 @@ def give_items(request, address, item_ids):
     transaction_key = UUIDEncoder.default(None,transaction_key)
 
     # Add the operation to the smart contract handler queue.
-    smart_contract.add_invoke("give_items", transaction_key, args)
+    d = in_thread(smart_contract.add_invoke, "give_items", transaction_key, args)
 
-    return {
+    return d.addCallback(lambda _: {
         "transaction_key": transaction_key
-    }
+    })
 
 
 @app.route('/inventory/remove/<address>/<item_id>')
@@ -335,11 +710,11 @@ def remove_item(request, address, item_id):
 
     args = [address,item_id]
     # Add the operation to the smart contract handler queue.
-    smart_contract.add_invoke("remove_items",transaction_key, args)
+    d = in_thread(smart_contract.add_invoke, "remove_item", transaction_key, args)
 
-    return {
+    return d.addCallback(lambda _: {
         "transaction_key": transaction_key
-    }
+    })
 
 
 @app.route('/inventory/trade/<address_from>/<address_to>/<item_id>')
@@ -364,11 +739,11 @@ def transfer_item(request, address_from, address_to, item_id):
 
     # Add the operation to the smart contract handler queue.
     args = [address_from,address_to,item_id]
-    smart_contract.add_invoke("transfer_item",transaction_key, args)
+    d = in_thread(smart_contract.add_invoke, "transfer_item", transaction_key, args)
 
-    return {
+    return d.addCallback(lambda _: {
         "transaction_key": transaction_key
-    }
+    })
 
 
 @app.route('/market/owner/<marketplace>')
@@ -376,7 +751,7 @@ def transfer_item(request, address_from, address_to, item_id):
 @json_response
 def marketplace_owner(request, marketplace):
     """
-    Test invoke the contract operation to query the owner of a marketplace.
+    Read the owner of a marketplace from the contract storage.
 
     :param marketplace: The name of the marketplace to query to owner of.
     :returns:
@@ -384,18 +759,14 @@ def marketplace_owner(request, marketplace):
         owner:str The address of the owner of the marketplace.
     """
     request_header(request)
-    # Test invoke the contract to query the owner of the contract.
-    smart_contract.test_invoke("general", "marketplace_owner", marketplace)
-
-    # Get the stored owner from redis, decode if not None, and return the details.
-    r_owner = redis_cache.get("owner:%s" % marketplace)
-    if r_owner is not None:
-        r_owner = r_owner.decode("utf-8")
+    # Read the owner of the marketplace, None if the marketplace is not registered.
+    owner = cached_read(request, "marketplace_owner", (marketplace,), [smart_contract.read_cache.owner_tag(marketplace)],
+                        lambda: contract_storage.marketplace_owner(marketplace))
 
-    return {
+    return owner.addCallback(lambda owner: {
         "marketplace": marketplace,
-        "owner": r_owner
-    }
+        "owner": owner
+    })
 
 
 @app.route('/market/buy/<address>/<offer_id>')
@@ -418,22 +789,23 @@ def buy_offer(request, address, offer_id):
     byte_part = str(byte_part).lstrip('b').lstrip('\'').rstrip('\'')
     offer_id_s = 'offer' + byte_part
 
-    # First we test invoke the offer, if it does not fail, we cache the cancelled offer so it isn't
-    # displayed in the market until the tx is found.
-    if smart_contract.test_invoke("offer","buy_offer",address,offer_id_s):
-        smart_contract.put_in_cached_offers(offer_id)
-
     # Generate a unique UUID4 transaction key.
     transaction_key = uuid4()
     transaction_key = UUIDEncoder.default(None,transaction_key)
 
-    # Construct the args and add the "buy" operation to the smart contract handler queue.
-    args = [address,offer_id_s]
-    smart_contract.add_invoke("buy_offer",transaction_key, args)
+    def queue():
+        # First we check the offer can be bought, if so, we reserve the bought offer so it isn't
+        # displayed in the market until the tx is found.
+        if contract_storage.can_buy_offer(address, offer_id):
+            smart_contract.reserve_offer(offer_id, transaction_key)
 
-    return {
+        # Construct the args and add the "buy" operation to the smart contract handler queue.
+        args = [address,offer_id_s]
+        smart_contract.add_invoke("buy_offer",transaction_key, args)
+
+    return in_thread(queue).addCallback(lambda _: {
         "transaction_key": transaction_key
-    }
+    })
 
 
 @app.route('/market/put/<address>/<item_id>/<price>')
@@ -458,11 +830,11 @@ def put_offer(request, address, item_id, price):
 
     # Construct the args and add the "put" operation to the smart contract handler queue.
     args = [address,item_id,price]
-    smart_contract.add_invoke("put_offer", transaction_key, args)
+    d = in_thread(smart_contract.add_invoke, "put_offer", transaction_key, args)
 
-    return {
+    return d.addCallback(lambda _: {
         "transaction_key": transaction_key
-    }
+    })
 
 @app.route('/market/cancel/<address>/<offer_id>')
 @json_response
@@ -484,22 +856,23 @@ def cancel_offer(request, address, offer_id):
     byte_part = str(byte_part).lstrip('b').lstrip('\'').rstrip('\'')
     offer_id_s = 'offer' + byte_part
 
-    # First we test invoke the offer, if it does not fail, we cache the cancelled offer so it isn't
-    # displayed in the market until the tx is found.
-    if smart_contract.test_invoke("offer","cancel_offer",address,offer_id_s):
-        smart_contract.put_in_cached_offers(offer_id)
-
     # Generate a UUID4 transaction key.
     transaction_key = uuid4()
     transaction_key = UUIDEncoder.default(None,transaction_key)
 
-    # Construct the args and add the "cancel" operation to the smart contract handler queue.
-    args = [address,offer_id_s]
-    smart_contract.add_invoke("cancel_offer",transaction_key, args)
+    def queue():
+        # First we check the offer can be cancelled, if so, we reserve the cancelled offer so it isn't
+        # displayed in the market until the tx is found.
+        if contract_storage.can_cancel_offer(address, offer_id):
+            smart_contract.reserve_offer(offer_id, transaction_key)
 
-    return {
+        # Construct the args and add the "cancel" operation to the smart contract handler queue.
+        args = [address,offer_id_s]
+        smart_contract.add_invoke("cancel_offer",transaction_key, args)
+
+    return in_thread(queue).addCallback(lambda _: {
         "transaction_key": transaction_key
-    }
+    })
 
 @app.route('/market/get')
 @catch_exceptions
@@ -507,25 +880,81 @@ def cancel_offer(request, address, offer_id):
 @json_response
 def get_offers(request):
     """
-    Test invoke the contract operation to query the offers on a marketplace.
+    List the offers on a marketplace from the offer book.
+
+    Query parameters:
+        sort:str The order of the offers, "id", "price" or "item_id", by default "id".
+        order:str "asc" or "desc", by default "asc".
+        offset:int The number of offers to skip, by default 0.
+        limit:int The maximum number of offers to list, at most 500, by default 50 if offset is given.
+        Without offset and limit every offer is listed, as before the offers were paginated.
+        seller:str Only list the offers of this address.
 
     :returns
         offers:list The list of offer ids retrieved from a marketplace.
+        details:list The address, offer id, item id and price of each offer listed.
+        total:int The number of offers matching, across all pages.
         timeOffersUpdated:str The time the offers were last updated at.
     """
     request_header(request)
 
-    # Test invoke the smart contract to get the offers that are on a marketplace.
-    smart_contract.test_invoke("market","get_all_offers")
+    sort = query_param(request, "sort", "id")
+    descending = query_param(request, "order", "asc") == "desc"
+    offset = query_param(request, "offset")
+    limit = query_param(request, "limit")
+    if offset is None and limit is None:
+        limit = None
+    else:
+        limit = min(max(int(limit or 50), 1), 500)
+    offset = max(int(offset or 0), 0)
+    seller = query_param(request, "seller")
 
-    # Get the offers and the time updated from the redis cache and return them.
-    r_offers = redis_cache.get("offers").decode("utf-8")
-    r_updated_at = redis_cache.get("timeOffersUpdated").decode("utf-8")
+    def read_offers():
+        # We don't want to show the reserved offers to the players.
+        offers, total = smart_contract.offer_book.page(sort, descending, offset, limit, seller,
+                                                    smart_contract.offer_reservations.reserved())
+        updated_at = smart_contract.offer_book.updated_at()
 
-    return {
-        "offers": r_offers,
-        "timeOffersUpdated": r_updated_at
-    }
+        return {
+            "offers": str([offer[1] for offer in offers]),
+            "details": offers,
+            "total": total,
+            "timeOffersUpdated": str(datetime.fromtimestamp(updated_at)) if updated_at else None
+        }
+
+    return in_thread(read_offers)
+
+
+@app.route('/market/get/batch', methods=['POST'])
+@catch_exceptions
+@json_response
+@authenticated
+def get_offers_batch(request):
+    """
+    Read the details of many offers at once from the offer book, in one redis round trip.
+
+    Request body:
+        offer_ids:list The ids of the offers, e.g. "offer3", at most MAX_BATCH_KEYS.
+
+    :returns
+        results:dict The address, offer id, item id and price of each offer found.
+        errors:dict The error of each offer which is not on the marketplace.
+    """
+    request_header(request)
+    try:
+        offer_ids = batch_keys(request, "offer_ids")
+    except ValueError as e:
+        request.setResponseCode(400)
+        return build_error(STATUS_ERROR_JSON, "JSON Error: %s" % str(e))
+
+    def respond(offers):
+        offers = dict((offer_id, offer) for offer_id, offer in zip(offer_ids, offers) if offer is not None)
+        return {
+            "results": offers,
+            "errors": dict((offer_id, "No offer %s on the marketplace" % offer_id) for offer_id in offer_ids if offer_id not in offers)
+        }
+
+    return in_thread(smart_contract.offer_book.get_offers, offer_ids).addCallback(respond)
 
 
 @app.route('/market/get/<offer_id>')
@@ -534,7 +963,7 @@ def get_offers(request):
 @json_response
 def get_offer(request, offer_id):
     """
-    Test invoke the contract to query the details of an offer on a marketplace.
+    Read the details of an offer on a marketplace from the contract storage.
 
     :param offer_id: The id of the offer on a marketplace.
     :return
@@ -542,21 +971,18 @@ def get_offer(request, offer_id):
     """
     request_header(request)
 
-    # Offer_id is sent in format, e.g. 'offer1', need to convert to e.g. 'offer\x01' for contract.
-    index = offer_id.split('r', 1)
-    byte_part = int.to_bytes(int(index[1]), 1, 'little')
-    byte_part = str(byte_part).lstrip('b').lstrip('\'').rstrip('\'')
-    offer_id_s = 'offer' + byte_part
+    # Read the offer from the contract storage, or the cache if it has not changed.
+    def respond(offer):
+        if offer is None:
+            raise Exception("No offer %s on the marketplace" % offer_id)
 
-    # Test invoke contract with the offer_id.
-    smart_contract.test_invoke("offer","get_offer", offer_id_s)
+        return {
+            "offer": str(offer)
+        }
 
-    # Get the offer information from the redis cache.
-    r_offer = redis_cache.get(offer_id).decode("utf-8")
-
-    return {
-        "offer": r_offer
-    }
+    offer = cached_read(request, "get_offer", (offer_id,), [smart_contract.read_cache.offers_tag()],
+                        lambda: contract_storage.get_offer(offer_id))
+    return offer.addCallback(respond)
 
 # endregion
 
@@ -576,15 +1002,45 @@ def loot_balance(request, address):
     """
     request_header(request)
 
-    # Test invoke the contract to get the balance.
-    smart_contract.test_invoke("general", "balance_of", address)
+    # Read the balance from the contract storage, or the cache if it has not changed.
+    balance = cached_read(request, "balance_of", (address,), [smart_contract.read_cache.balances_tag()],
+                          lambda: contract_storage.balance_of(address))
 
-    # Get the balance from the cache and return it.
-    balance = redis_cache.get("balance:%s" % address).decode("utf-8")
+    return balance.addCallback(lambda balance: {
+        "balance": str(balance)
+    })
 
-    return {
-        "balance": balance
-    }
+
+@app.route('/wallet/batch', methods=['POST'])
+@catch_exceptions
+@json_response
+@authenticated
+def loot_balances(request):
+    """
+    Read the LOOT balances of many addresses at once, through the block height cache. The balances are cached
+    with the same keys as /wallet/<address>, so either route reads the balances the other cached.
+
+    Request body:
+        addresses:list The addresses to read the balances of, at most MAX_BATCH_KEYS.
+
+    :returns
+        results:dict The LOOT balance of each address read.
+        errors:dict The error of each address which could not be read.
+    """
+    request_header(request)
+    try:
+        addresses = batch_keys(request, "addresses")
+    except ValueError as e:
+        request.setResponseCode(400)
+        return build_error(STATUS_ERROR_JSON, "JSON Error: %s" % str(e))
+
+    def read_balance(address):
+        balance, status, height = smart_contract.read_cache.get("balance_of", (address,),
+                                                                [smart_contract.read_cache.balances_tag()],
+                                                                lambda: contract_storage.balance_of(address))
+        return balance
+
+    return in_thread(batch_read, addresses, read_balance)
 
 
 @app.route('/wallets/create')
@@ -618,23 +1074,99 @@ def create_wallet(request):
         request.setResponseCode(400)
         return build_error(STATUS_ERROR_JSON, "Password needs a minimum length of 8 characters.")
 
-    private_key = bytes(Random.get_random_bytes(32))
-    key = KeyPair(priv_key=private_key)
+    def create():
+        private_key = bytes(Random.get_random_bytes(32))
+        key = KeyPair(priv_key=private_key)
+
+        # The NEP-2 key is derived with scrypt, which takes a while.
+        return {
+            "address": key.GetAddress(),
+            "nep2_key": key.ExportNEP2(pwd)
+        }
+
+    return in_thread(create)
 
+
+@app.route('/wallet/status')
+@catch_exceptions
+@authenticated
+@json_response
+def wallet_status(request):
+    """
+    Returns the health and sync state of the API wallets.
+
+    :return
+        wallets:list The state of each wallet, containing:
+        wallet:str The path of the wallet.
+        open:bool Whether the wallet is open.
+        healthy:bool Whether the wallet is open and not corrupted.
+        synced:bool Whether the wallet has processed every block on the blockchain.
+        wallet_height:int The height the wallet has processed to.
+        blockchain_height:int The height of the blockchain.
+        gas:float The GAS balance of the wallet.
+        reloads:int The number of times the wallet was reloaded after being corrupted.
+        last_error:str Why the wallet was last found corrupted.
+    """
+    request_header(request)
+    return in_thread(lambda: {
+        "wallets": smart_contract.wallet_pool.health()
+    })
+
+
+@app.route('/queue/status')
+@catch_exceptions
+@authenticated
+@json_response
+def queue_status(request):
+    """
+    Returns the state of the invoke queue for each priority class.
+
+    :return
+        in_progress:int The number of transactions waiting for confirmation.
+        classes:dict The state of each priority class, containing:
+        depth:int The number of queued operations.
+        addresses:int The number of addresses with queued operations.
+        oldest_wait:float The seconds the oldest queued operation has waited.
+        average_wait:float The moving average of the seconds operations waited to be invoked.
+    """
+    request_header(request)
     return {
-        "address": key.GetAddress(),
-        "nep2_key": key.ExportNEP2(pwd)
+        "classes": smart_contract.invoke_queue.stats(),
+        "in_progress": len(smart_contract.tx_in_progress)
     }
 
 
+@app.route('/queue/dead_letters')
+@catch_exceptions
+@authenticated
+@json_response
+def dead_letters(request):
+    """
+    Returns the operations which were given up on, because they failed permanently or ran out of attempts.
+
+    :return
+        dead_letters:dict The failed operations by transaction key, containing:
+        operation_name:str The smart contract operation.
+        transaction_keys:list The transaction keys the operation was invoked for.
+        args:list The arguments of the operation.
+        attempts:int The number of times the operation was attempted.
+        reason:str Whether the failure was permanent or transient.
+        error:str The error of the last attempt.
+        failed_at:float When the operation was given up on.
+    """
+    request_header(request)
+    return in_thread(lambda: {
+        "dead_letters": smart_contract.dead_letters.all()
+    })
+
+
 @app.route('/wallet/claim_gas')
 @catch_exceptions
 @authenticated
 def claim_gas(request):
-    """ Claim the gas in the API wallet. """
+    """ Claim the gas in the API wallets. """
     request_header(request)
-    smart_contract.claim_gas()
-    return "Claimed gas!"
+    return in_thread(smart_contract.claim_gas).addCallback(lambda _: "Claimed gas!")
 
 
 # endregion
@@ -653,7 +1185,7 @@ if __name__ == "__main__":
     # Get the blockchain up and running.
     blockchain = LevelDBBlockchain(settings.LEVELDB_PATH)
     Blockchain.RegisterBlockchain(blockchain)
-    reactor.suggestThreadPoolSize(15)
+    reactor.suggestThreadPoolSize(ROUTE_THREADS)
     NodeLeader.Instance().Start()
     dbloop = task.LoopingCall(Blockchain.Default().PersistBlocks)
     dbloop.start(.1)
@@ -0,0 +1,115 @@
+"""
+=====================================================================================
+
+Batched redis writes of the smart contract Notify events.
+
+Every Notify event used to write the cache with its own redis round trips, on the thread neo-python
+persists blocks on. The writes of the events are buffered instead, and written as one MULTI/EXEC
+pipeline when the block they were notified in is persisted, or after a short time window for the
+events which are not part of a block. The keys an event updates together are written atomically,
+and catching up on many blocks takes one round trip per block.
+
+=====================================================================================
+"""
+
+import time
+import threading
+from contextlib import contextmanager
+from logzero import logger
+from neo.Core.Blockchain import Blockchain
+
+
+class RedisWriteBatch:
+    """ Buffers redis writes in a transactional pipeline, flushed per persisted block or after max_delay. """
+
+    # The maximum seconds a buffered write waits to be flushed.
+    max_delay = 1.0
+
+    def __init__(self, redis_cache):
+        """
+        :param redis_cache:StrictRedis The redis connection to write with.
+        """
+        self.redis_cache = redis_cache
+        self._pipe = redis_cache.pipeline()
+        self._buffered_since = None
+
+        # The callbacks to call once the buffered writes are written.
+        self._callbacks = []
+
+        # The number of pipelines and commands written.
+        self.flushes = 0
+        self.writes = 0
+
+        self._lock = threading.RLock()
+        self._thread = threading.Thread(target=self._flush_loop, daemon=True)
+        self._thread.start()
+
+        Blockchain.PersistCompleted.on_change += self.on_block_persisted
+
+    @contextmanager
+    def batch(self, flush=False):
+        """
+        Add writes to the buffered pipeline, the writes added in one batch are flushed together.
+
+        :param flush:bool Whether to flush the pipeline once the writes are added.
+        :return:
+            Pipeline: The pipeline to add the writes to.
+        """
+        with self._lock:
+            if self._buffered_since is None:
+                self._buffered_since = time.time()
+            yield self._pipe
+            if flush:
+                self.flush()
+
+    def after_flush(self, callback):
+        """
+        Call a callback once the writes buffered so far are written, such as to announce what they changed.
+
+        :param callback:function Called without arguments, on the flushing thread.
+        """
+        with self._lock:
+            if self._buffered_since is None:
+                self._buffered_since = time.time()
+            self._callbacks.append(callback)
+
+    def flush(self):
+        """ Write the buffered writes as one MULTI/EXEC. """
+        with self._lock:
+            self._buffered_since = None
+            if not len(self._pipe) and not self._callbacks:
+                return
+            pipe, self._pipe = self._pipe, self.redis_cache.pipeline()
+            callbacks, self._callbacks = self._callbacks, []
+            try:
+                self.writes += len(pipe)
+                self.flushes += 1
+                pipe.execute()
+            except Exception as e:
+                logger.exception(e)
+
+            for callback in callbacks:
+                try:
+                    callback()
+                except Exception as e:
+                    logger.exception(e)
+
+    def on_block_persisted(self, block):
+        """ Block persist callback, the writes of the Notify events of the block are flushed. """
+        self.flush()
+
+    def stats(self):
+        """
+        :return:
+            dict: The number of pipelines and commands written, and the commands waiting to be flushed.
+        """
+        with self._lock:
+            return {"flushes": self.flushes, "writes": self.writes, "buffered": len(self._pipe)}
+
+    def _flush_loop(self):
+        """ Flush the writes which waited for max_delay without a block being persisted. """
+        while True:
+            time.sleep(self.max_delay / 2)
+            buffered_since = self._buffered_since
+            if buffered_since is not None and time.time() - buffered_since >= self.max_delay:
+                self.flush()
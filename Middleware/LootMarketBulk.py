@@ -0,0 +1,239 @@
+"""
+=====================================================================================
+
+Bulk item grants of the game server.
+
+Season rewards give items to tens of thousands of addresses. Instead of one request and one queue
+entry per address and call, a grant is uploaded as one body of (address, item_ids) rows, validated
+as a whole, merged by address and chunked into the fewest give_items invocations of at most
+max_coalesced_items items each, which the invoke queue packs into transactions within the script
+size and GAS limits as usual. The grant is tracked as one job, whose progress counters are updated
+from the results of its invocations.
+
+=====================================================================================
+"""
+
+import io
+import csv
+import json
+import time
+from collections import OrderedDict
+from neo.Core.Helper import Helper
+
+
+# The content types of the bodies which are read one row per line.
+NDJSON_TYPES = ("application/x-ndjson", "application/ndjson", "application/jsonl")
+CSV_TYPES = ("text/csv", "application/csv")
+
+
+def read_grant_rows(stream, content_type):
+    """
+    Read the rows of a bulk grant body. NDJSON and CSV bodies are read a line at a time,
+    a JSON body is an array of rows.
+
+    A JSON row is {"address": str, "item_ids": [int]} or [address, [item_ids]],
+    a CSV row is the address followed by one item id per column.
+
+    :param stream:file The binary stream of the body.
+    :param content_type:str The content type of the body, JSON if not NDJSON or CSV.
+    :return:
+        generator: A tuple (row_number, address, item_ids, error) for each row, error is None if the row is valid.
+    """
+    content_type = (content_type or "").split(";")[0].strip().lower()
+    text = io.TextIOWrapper(stream, encoding="utf-8", newline="" if content_type in CSV_TYPES else None)
+
+    if content_type in CSV_TYPES:
+        for row_number, row in enumerate(csv.reader(text), 1):
+            row = [column.strip() for column in row]
+            if not any(row):
+                continue
+            # Skip the header row, if the body has one.
+            if row_number == 1 and row[0].lower() == "address":
+                continue
+            yield (row_number,) + validate_grant_row(row[0], [column for column in row[1:] if column])
+
+    elif content_type in NDJSON_TYPES:
+        for row_number, line in enumerate(text, 1):
+            if not line.strip():
+                continue
+            try:
+                row = json.loads(line)
+            except ValueError as e:
+                yield row_number, None, None, "JSON Error: %s" % str(e)
+                continue
+            yield (row_number,) + validate_grant_row(*json_grant_row(row))
+
+    else:
+        try:
+            rows = json.load(text)
+        except ValueError as e:
+            yield 0, None, None, "JSON Error: %s" % str(e)
+            return
+        if not isinstance(rows, list):
+            yield 0, None, None, "The request body must be a list of rows"
+            return
+        for row_number, row in enumerate(rows, 1):
+            yield (row_number,) + validate_grant_row(*json_grant_row(row))
+
+
+def json_grant_row(row):
+    """ The address and item ids of a JSON row, None if the row is neither a dict nor a pair. """
+    if isinstance(row, dict):
+        return row.get("address"), row.get("item_ids")
+    if isinstance(row, list) and len(row) == 2:
+        return row[0], row[1]
+    return None, None
+
+
+def validate_grant_row(address, item_ids):
+    """
+    Validate the address and item ids of a row.
+
+    :param address:str The address to give the items to.
+    :param item_ids:list The item ids to give, as ints or the strings of ints.
+    :return:
+        tuple: The address, the item ids as ints and None if the row is valid, else the error of the row.
+    """
+    if not isinstance(address, str):
+        return address, item_ids, "The address must be a string"
+    try:
+        Helper.AddrStrToScriptHash(address)
+    except Exception as e:
+        return address, item_ids, "Invalid address %s: %s" % (address, str(e))
+
+    if not isinstance(item_ids, list) or not item_ids:
+        return address, item_ids, "The item ids must be a non empty list"
+    try:
+        # Booleans are ints, but not item ids.
+        if any(isinstance(item_id, (bool, float)) for item_id in item_ids):
+            raise ValueError()
+        item_ids = [int(item_id) for item_id in item_ids]
+    except (TypeError, ValueError):
+        return address, item_ids, "The item ids must be integers"
+    if any(item_id < 0 for item_id in item_ids):
+        return address, item_ids, "The item ids must not be negative"
+
+    return address, item_ids, None
+
+
+def chunk_grants(rows, max_items):
+    """
+    Merge the rows of the same address and split the items of each address into the fewest invocations.
+
+    :param rows:list The (address, item_ids) of each row.
+    :param max_items:int The maximum number of items one give_items invocation may give.
+    :return:
+        list: The (address, item_ids) of each invocation, the addresses in the order they first appear.
+    """
+    items_by_address = OrderedDict()
+    for address, item_ids in rows:
+        items_by_address.setdefault(address, []).extend(item_ids)
+
+    invocations = []
+    for address, item_ids in items_by_address.items():
+        for i in range(0, len(item_ids), max_items):
+            invocations.append((address, item_ids[i:i + max_items]))
+    return invocations
+
+
+class BulkGrantJobs:
+    """
+    The progress of the bulk grants. The transaction key of each invocation of a job is bulk:<job_id>:<n>,
+    so its job is known from the key without a lookup.
+    """
+
+    # The redis hash of the counters of a job, kept for job_ttl seconds.
+    job_key = "bulk_grant:%s"
+    job_ttl = 604800
+
+    def __init__(self, redis_cache):
+        """
+        :param redis_cache:StrictRedis The redis connection the jobs are kept in.
+        """
+        self.redis_cache = redis_cache
+
+    @staticmethod
+    def transaction_key(job_id, number):
+        return "bulk:%s:%s" % (job_id, number)
+
+    @staticmethod
+    def job_id_of(transaction_key):
+        """
+        :param transaction_key:str The transaction key of an operation.
+        :return:
+            str: The job of the operation, or None if it is not part of a bulk grant.
+        """
+        if not transaction_key.startswith("bulk:"):
+            return None
+        return transaction_key.split(":")[1]
+
+    def create(self, job_id, rows, addresses, items, invocations):
+        """
+        Record a job before its invocations are queued.
+
+        :param job_id:str The id of the job.
+        :param rows:int The number of rows of the grant.
+        :param addresses:int The number of addresses given items.
+        :param items:int The number of items given.
+        :param invocations:int The number of give_items invocations queued.
+        """
+        pipe = self.redis_cache.pipeline()
+        pipe.hmset(self.job_key % job_id, {
+            "rows": rows,
+            "addresses": addresses,
+            "items": items,
+            "invocations": invocations,
+            "completed": 0,
+            "rejected": 0,
+            "dead_lettered": 0,
+            "created_at": time.time()
+        })
+        pipe.expire(self.job_key % job_id, self.job_ttl)
+        pipe.execute()
+
+    def on_result(self, pipe, transaction_keys, operation_successful):
+        """
+        Count the notified result of the invocations of jobs.
+
+        :param pipe:Pipeline The pipeline the result is written with.
+        :param transaction_keys:list The transaction keys of the operation.
+        :param operation_successful:bool Whether the contract completed the operation.
+        """
+        for transaction_key in transaction_keys:
+            job_id = self.job_id_of(transaction_key)
+            if job_id is not None:
+                pipe.hincrby(self.job_key % job_id, "completed" if operation_successful else "rejected", 1)
+
+    def on_dead_letter(self, transaction_keys):
+        """
+        Count the invocations of jobs moved to the dead letters.
+
+        :param transaction_keys:list The transaction keys of the failed task.
+        """
+        pipe = self.redis_cache.pipeline()
+        for transaction_key in transaction_keys:
+            job_id = self.job_id_of(transaction_key)
+            if job_id is not None:
+                pipe.hincrby(self.job_key % job_id, "dead_lettered", 1)
+        if len(pipe):
+            pipe.execute()
+
+    def get(self, job_id):
+        """
+        :param job_id:str The id of the job.
+        :return:
+            dict: The counters of the job, the invocations still pending and whether it is done,
+            or None if there is no such job.
+        """
+        job = self.redis_cache.hgetall(self.job_key % job_id)
+        if not job:
+            return None
+
+        job = dict((key.decode("utf-8"), value.decode("utf-8")) for key, value in job.items())
+        progress = dict((key, int(value)) for key, value in job.items() if key != "created_at")
+        progress["created_at"] = float(job["created_at"])
+        progress["pending"] = progress["invocations"] - progress["completed"] - progress["rejected"] \
+            - progress["dead_lettered"]
+        progress["done"] = progress["pending"] <= 0
+        progress["job_id"] = job_id
+        return progress
@@ -0,0 +1,254 @@
+"""
+=====================================================================================
+
+Block height versioned read-through cache of the smart contract queries.
+
+The state of the smart contract only changes when a block is persisted, so a query read at a block
+height stays valid until a later block notifies an operation touching what it read. Each cached result
+is tagged with what it depends on, such as the inventory of an address or the offers of the marketplace,
+and a Notify of a persisted block invalidates only the results depending on what the operation changed.
+
+Identical queries missing the cache at the same time share a single read, so a wave of requests after
+an invalidation reads the storage once instead of once per request.
+
+=====================================================================================
+"""
+
+import threading
+from collections import OrderedDict
+from logzero import logger
+from neocore import UInt160
+from neocore.Cryptography.Crypto import Crypto
+from neo.Core.Blockchain import Blockchain
+
+# Every result depends on this tag, a Notify which can not be mapped to tags invalidates the whole cache.
+ALL_TAG = "all"
+
+# Changed by every persisted block, for the results which may change without a Notify.
+BLOCK_TAG = "block"
+
+
+class _Flight:
+    """ A read in progress, shared by the callers waiting for it. """
+
+    def __init__(self):
+        self.done = threading.Event()
+        self.value = None
+        self.error = None
+        self.waiters = 0
+
+
+class SingleFlight:
+    """ Coalesces identical concurrent calls, the first caller runs the call and the others wait for its result. """
+
+    def __init__(self):
+        self._flights = {}
+        self._lock = threading.Lock()
+
+        # The number of calls which shared the result of another call.
+        self.shared = 0
+
+    def do(self, key, func):
+        """
+        Run func, or wait for the call already running for the same key.
+
+        :param key:object The key identifying the call.
+        :param func:function The call, without arguments.
+        :return:
+            tuple: The result of the call, and whether it was shared from another caller.
+        """
+        with self._lock:
+            flight = self._flights.get(key)
+            if flight is None:
+                flight = self._flights[key] = _Flight()
+                leader = True
+            else:
+                flight.waiters += 1
+                self.shared += 1
+                leader = False
+
+        if not leader:
+            flight.done.wait()
+            if flight.error is not None:
+                raise flight.error
+            return flight.value, True
+
+        try:
+            flight.value = func()
+        except Exception as e:
+            flight.error = e
+            raise
+        finally:
+            with self._lock:
+                del self._flights[key]
+            flight.done.set()
+        return flight.value, False
+
+
+class BlockHeightCache:
+    """
+    Caches query results by (operation, args) with the block height they were read at. A result is served
+    as long as no block after that height has changed one of its tags.
+    """
+
+    # The maximum number of cached results, the least recently read are evicted first.
+    max_entries = 10000
+
+    def __init__(self, marketplace):
+        """
+        :param marketplace:str The name of the marketplace being cached, Notify events of other marketplaces are ignored.
+        """
+        self.marketplace = marketplace
+
+        # (operation, args) -> (height, value, tags)
+        self.entries = OrderedDict()
+
+        # The last block height each tag was changed at.
+        self.changed_at = {}
+
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+
+        # The reads of the cache misses in progress.
+        self.flights = SingleFlight()
+
+        Blockchain.PersistCompleted.on_change += self.on_block_persisted
+
+    def get(self, operation, args, tags, compute):
+        """
+        Return the cached result of a query, or compute and cache it.
+
+        :param operation:str The name of the query.
+        :param args:tuple The arguments of the query.
+        :param tags:list The tags the result depends on.
+        :param compute:function Called without arguments to read the result on a miss.
+        :return:
+            tuple: The result, "HIT", "MISS" or "SHARED" if it was read by a concurrent identical query,
+            and the block height it was read at.
+        """
+        key = (operation, tuple(args))
+        with self._lock:
+            entry = self.entries.get(key)
+            if entry is not None and self._is_valid(entry):
+                self.entries.move_to_end(key)
+                self.hits += 1
+                return entry[1], "HIT", entry[0]
+            self.misses += 1
+
+        (height, value), shared = self.flights.do(key, lambda: self._read(key, tags, compute))
+        return value, "SHARED" if shared else "MISS", height
+
+    def _read(self, key, tags, compute):
+        """
+        Read a query result on a cache miss, and cache it.
+
+        :return:
+            tuple: The block height the result was read at, and the result.
+        """
+        # Take the height before reading, so a block persisted while reading invalidates the result.
+        height = Blockchain.Default().Height
+        value = compute()
+
+        # Missing results are not cached, what creates them, such as registering a marketplace, may not notify.
+        if value is None:
+            return height, value
+
+        with self._lock:
+            self.entries[key] = (height, value, [ALL_TAG] + list(tags))
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+        return height, value
+
+    def invalidate(self, tags, height):
+        """
+        Mark tags as changed by a block.
+
+        :param tags:list The tags which changed.
+        :param height:int The height of the block which changed them.
+        """
+        with self._lock:
+            for tag in tags:
+                if self.changed_at.get(tag, -1) < height:
+                    self.changed_at[tag] = height
+
+    def on_block_persisted(self, block):
+        """ Block persist callback, the results tagged with BLOCK_TAG are only valid within a block. """
+        self.invalidate([BLOCK_TAG], block.Index)
+
+    def on_notify(self, event):
+        """
+        Invalidate the results depending on what a Notify of a persisted block changed.
+
+        :param event:SmartContractEvent The Notify event.
+        """
+        try:
+            tags = self.tags_for_event(event)
+        except Exception as e:
+            logger.exception(e)
+            tags = [ALL_TAG]
+
+        if tags:
+            self.invalidate(tags, event.block_number)
+
+    def tags_for_event(self, event):
+        """
+        :param event:SmartContractEvent The Notify event.
+        :return:
+            list: The tags the operation of the event changed.
+        """
+        payload = event.event_payload
+        event_name = payload[0].decode("utf-8")
+
+        # Queries do not change the state.
+        if event_name in ("get_inventory", "get_all_offers", "get_offer", "marketplace_owner", "balance_of"):
+            return []
+
+        if event_name in ("give_items", "remove_item", "put_offer", "cancel_offer", "buy_offer", "transfer_item"):
+            if payload[1].decode("utf-8") != self.marketplace:
+                return []
+            tags = [self.inventory_tag(self._address(payload[2]))]
+            if event_name == "transfer_item":
+                tags.append(self.inventory_tag(self._address(payload[3])))
+            if event_name in ("put_offer", "cancel_offer", "buy_offer"):
+                tags.append(self.offers_tag())
+            return tags
+
+        # Token transfers, minting and administration are not mapped to tags.
+        return [ALL_TAG]
+
+    @staticmethod
+    def inventory_tag(address):
+        return "inventory:%s" % address
+
+    @staticmethod
+    def offers_tag():
+        return "offers"
+
+    @staticmethod
+    def balances_tag():
+        # The owner may transfer LOOT without a Notify, so balances are only cached within a block.
+        return BLOCK_TAG
+
+    @staticmethod
+    def owner_tag(marketplace):
+        return "owner:%s" % marketplace
+
+    def stats(self):
+        """
+        :return:
+            dict: The number of cached results, hits, misses and misses which shared a concurrent read.
+        """
+        with self._lock:
+            return {"entries": len(self.entries), "hits": self.hits, "misses": self.misses, "shared": self.flights.shared}
+
+    def _is_valid(self, entry):
+        """ A result is valid if none of its tags changed after the height it was read at. """
+        height, value, tags = entry
+        return all(self.changed_at.get(tag, -1) <= height for tag in tags)
+
+    @staticmethod
+    def _address(script_hash):
+        """ Convert a notified script hash to an address. """
+        return Crypto.ToAddress(UInt160.UInt160(data=script_hash))
@@ -0,0 +1,199 @@
+"""
+=====================================================================================
+
+Codec of the LootMarkets smart contract storage format.
+
+Lists are saved in storage by the serialize_array helper of the smart contract:
+
+    length prefix of the list, then for each item: length prefix of the item, the item.
+
+A length prefix is written by serialize_var_length_item as one byte holding 1, 2 or 4,
+followed by the length as the VM concatenates an integer: its minimal little endian two's
+complement bytes. The byte count of the prefix is only chosen from the length, so lengths from
+128 to 255 are written with two bytes while the prefix says one, and a length of 0 is written with
+no bytes. The contract reads back as many bytes as the prefix says, and so does this codec,
+which is why such lists do not survive a round trip through the contract either.
+
+Items are decoded as memoryview slices of the serialized data, without copying. Many lists of
+integers, such as inventories or prices, can be decoded at once into NumPy arrays.
+
+=====================================================================================
+"""
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+
+def encode_int(value):
+    """
+    Convert an integer to the bytes the smart contract VM concatenates it as.
+
+    :param value:int The integer.
+    :return:
+        bytes: The minimal little endian two's complement bytes of the integer, empty for 0.
+    """
+    if value == 0:
+        return b''
+    # The bits of a negative integer are those of its complement, so -128 fits in one byte like 127.
+    bits = value.bit_length() if value > 0 else (~value).bit_length()
+    return value.to_bytes((bits + 8) // 8, 'little', signed=True)
+
+
+def decode_int(data):
+    """
+    Convert an item to an integer, the same way the middleware decodes the items of the Notify events.
+
+    :param data:bytes The item.
+    :return:
+        int: The unsigned little endian integer of the item.
+    """
+    return int.from_bytes(data, 'little')
+
+
+def serialize_var_length_item(length):
+    """
+    The length prefix serialize_var_length_item of the smart contract writes for a length.
+
+    :param length:int The length of the item or list.
+    :return:
+        bytes: The length prefix.
+    """
+    if length <= 255:
+        byte_len = b'\x01'
+    elif length <= 65535:
+        byte_len = b'\x02'
+    else:
+        byte_len = b'\x04'
+    return byte_len + encode_int(length)
+
+
+def serialize_array(items):
+    """
+    Serialize a list the same way the serialize_array helper of the smart contract does.
+
+    :param items:list The items, as bytes or integers.
+    :return:
+        bytes: The serialized list.
+    """
+    output = [serialize_var_length_item(len(items))]
+    for item in items:
+        if isinstance(item, int):
+            item = encode_int(item)
+        output.append(serialize_var_length_item(len(item)))
+        output.append(bytes(item))
+    return b''.join(output)
+
+
+def _read_length(data, offset):
+    """
+    Read a length prefix.
+
+    :param data:memoryview The serialized data.
+    :param offset:int The offset of the prefix.
+    :return:
+        tuple: The length, and the offset after the prefix.
+    """
+    if offset >= len(data):
+        raise ValueError("Truncated length prefix at offset %s" % offset)
+    length_length = data[offset]
+    # Like substr in the VM the length is cut short at the end of the data, the length of an empty list has no bytes.
+    end = min(offset + 1 + length_length, len(data))
+    length = int.from_bytes(data[offset + 1:end], 'little', signed=True)
+    if length < 0:
+        raise ValueError("Length prefix at offset %s reads a negative length, lengths of 128 to 255 are not decodable" % offset)
+    return length, end
+
+
+def _item_spans(data):
+    """
+    Locate the items of a serialized list.
+
+    :param data:memoryview The serialized list.
+    :return:
+        generator: The start and end offset of each item.
+    """
+    collection_len, offset = _read_length(data, 0)
+    for i in range(collection_len):
+        item_len, start = _read_length(data, offset)
+        offset = start + item_len
+        if offset > len(data):
+            raise ValueError("Truncated item %s of %s" % (i, collection_len))
+        yield start, offset
+
+
+def iter_items(data):
+    """
+    Iterate over the items of a serialized list, without copying them.
+
+    :param data:bytes The serialized list.
+    :return:
+        generator: A memoryview of each item.
+    """
+    if not data:
+        return
+    data = memoryview(data)
+    for start, end in _item_spans(data):
+        yield data[start:end]
+
+
+def deserialize_bytearray(data):
+    """
+    Deserialize a list the same way the deserialize_bytearray helper of the smart contract does.
+
+    :param data:bytes The serialized list, an empty or missing value is an empty list.
+    :return:
+        list: A memoryview of each item, slices of data.
+    """
+    return list(iter_items(data))
+
+
+def decode_ints(data):
+    """
+    :param data:bytes A serialized list of integers.
+    :return:
+        list: The integers of the list.
+    """
+    return [decode_int(item) for item in iter_items(data)]
+
+
+def bulk_decode_ints(blobs):
+    """
+    Decode many serialized lists of integers at once, such as the inventories of many addresses.
+
+    :param blobs:list The serialized lists, of integers of up to 8 bytes.
+    :return:
+        tuple: A uint64 array of the integers of every list, and an int64 array of the offsets of each list
+        in it, the integers of list i are values[offsets[i]:offsets[i + 1]].
+    """
+    if numpy is None:
+        raise ImportError("bulk_decode_ints requires numpy")
+
+    # Locate the items in the joined data, only the length prefixes are read.
+    buffer = b''.join(bytes(blob) for blob in blobs if blob)
+    view = memoryview(buffer)
+    starts = []
+    lengths = []
+    offsets = [0]
+    base = 0
+    for blob in blobs:
+        if blob:
+            for start, end in _item_spans(view[base:base + len(blob)]):
+                starts.append(base + start)
+                lengths.append(end - start)
+            base += len(blob)
+        offsets.append(len(starts))
+
+    starts = numpy.array(starts, dtype=numpy.int64)
+    lengths = numpy.array(lengths, dtype=numpy.int64)
+    if len(lengths) and lengths.max() > 8:
+        raise ValueError("Items of more than 8 bytes do not fit a uint64")
+
+    # Gather up to 8 bytes of each item into a row, zero padding the rest, and view each row as a little endian uint64.
+    data = numpy.frombuffer(buffer + bytes(8), dtype=numpy.uint8)
+    columns = numpy.arange(8)
+    rows = data[starts[:, None] + columns]
+    rows[columns >= lengths[:, None]] = 0
+    values = numpy.ascontiguousarray(rows).view('<u8').reshape(-1)
+    return values, numpy.array(offsets, dtype=numpy.int64)
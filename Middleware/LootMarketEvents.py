@@ -0,0 +1,101 @@
+"""
+=====================================================================================
+
+Publish/subscribe hub of the operation results pushed to the game.
+
+Instead of polling the search endpoint until a transaction is found, a client subscribes to the
+transaction keys or addresses it waits on, and is pushed the result of each operation as soon as
+the Notify event of the operation is written to the cache, or when the operation is moved to the
+dead letters.
+
+=====================================================================================
+"""
+
+import threading
+from logzero import logger
+
+
+class Subscription:
+    """ The topics a subscriber listens to, and the callback it is pushed the events with. """
+
+    def __init__(self, topics, callback):
+        self.topics = set(topics)
+        self.callback = callback
+
+
+class EventHub:
+    """ Dispatches the events published to a topic to the callbacks subscribed to it. """
+
+    def __init__(self):
+        # The subscriptions of each topic.
+        self.topics = {}
+
+        # The number of events published, and pushed to subscribers.
+        self.published = 0
+        self.pushed = 0
+
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def transaction_topic(transaction_key):
+        return "tx:%s" % transaction_key
+
+    @staticmethod
+    def address_topic(address):
+        return "address:%s" % address
+
+    def subscribe(self, topics, callback):
+        """
+        Subscribe to topics.
+
+        :param topics:list The topics to subscribe to.
+        :param callback:function Called with each event published to one of the topics, on the publishing thread.
+        :return:
+            Subscription: The subscription, to unsubscribe with.
+        """
+        subscription = Subscription(topics, callback)
+        with self._lock:
+            for topic in subscription.topics:
+                self.topics.setdefault(topic, set()).add(subscription)
+        return subscription
+
+    def unsubscribe(self, subscription):
+        """
+        :param subscription:Subscription The subscription to remove.
+        """
+        with self._lock:
+            for topic in subscription.topics:
+                subscriptions = self.topics.get(topic)
+                if subscriptions is None:
+                    continue
+                subscriptions.discard(subscription)
+                if not subscriptions:
+                    del self.topics[topic]
+
+    def publish(self, topics, event):
+        """
+        Push an event to the subscribers of any of the topics, once to each subscriber.
+
+        :param topics:list The topics of the event.
+        :param event:dict The event.
+        """
+        with self._lock:
+            self.published += 1
+            subscriptions = set()
+            for topic in topics:
+                subscriptions.update(self.topics.get(topic, ()))
+            self.pushed += len(subscriptions)
+
+        for subscription in subscriptions:
+            try:
+                subscription.callback(event)
+            except Exception as e:
+                logger.exception(e)
+
+    def stats(self):
+        """
+        :return:
+            dict: The number of topics subscribed to, events published and events pushed.
+        """
+        with self._lock:
+            return {"topics": len(self.topics), "published": self.published, "pushed": self.pushed}
@@ -9,25 +9,52 @@ Email: aus.poli1@gmail.com
 =====================================================================================
 """
 
-import struct
 import time
 import redis
 import threading
-import codecs
-from datetime import datetime
-from queue import Queue
+from queue import Empty
 from logzero import logger
 from twisted.internet import task
 from neocore import UInt160
-from neo.Implementations.Wallets.peewee.UserWallet import UserWallet
-from neo.Prompt.Commands.Invoke import InvokeContract, TestInvokeContract, test_invoke
+from neo.Prompt.Commands.Invoke import test_invoke
 from neo.Settings import settings
 from neo.Core.Blockchain import Blockchain
+from neo.Network.NodeLeader import NodeLeader
+from neo.SmartContract.ContractParameterContext import ContractParametersContext
 from neocore.Cryptography.Crypto import Crypto
+from neocore.Fixed8 import Fixed8
 from neo.contrib.smartcontract import SmartContract
 from neo.Prompt.Commands.Wallet import ClaimGas
 from neo.VM.ScriptBuilder import ScriptBuilder
 from neo.Prompt.Utils import parse_param
+from neo.VM.OpCode import PACK
+from LootMarketWallet import WalletPool
+from LootMarketUTXO import UTXOManager
+from LootMarketCache import BlockHeightCache
+from LootMarketStorage import ContractStorage
+from LootMarketOffers import OfferBook, OfferReservations
+from LootMarketInventory import InventoryStore
+from LootMarketBatch import RedisWriteBatch
+from LootMarketTracker import ConfirmationTracker
+from LootMarketEvents import EventHub
+from LootMarketBulk import BulkGrantJobs
+from LootMarketQueue import InvokeJournal, InvokeScheduler, DeadLetterStore, PermanentInvokeError, InfrastructureError, \
+    classify_failure
+
+class PendingTransaction:
+    """ A container object for a relayed transaction that is waiting to be confirmed. """
+
+    def __init__(self, tx, tasks, session):
+        # The relayed transaction and its hash.
+        self.tx = tx
+        self.tx_hash = tx.Hash.ToString()
+        # The queue items (operation_name, transaction_key, args) packed into the transaction.
+        self.tasks = tasks
+        # The time the transaction was relayed, used to time it out.
+        self.relayed_at = time.time()
+        # The wallet session of the wallet which signed the transaction.
+        self.session = session
+
 
 # Setup the blockchain task queue.
 class LootMarketsSmartContract(threading.Thread):
@@ -39,11 +66,10 @@ class LootMarketsSmartContract(threading.Thread):
     # The name of the smart contract marketplace being used, this must be registered on the blockchain before use.
     marketplace = "LootClicker"
 
-    # Stores offers that are trying to be cancelled/bought so we don't see them within the marketplace.
+    # Reserves the offers that are trying to be cancelled/bought so we don't see them within the marketplace.
     # We do not want multiple people queuing up to buy the same item, or a cancelled item.
-    # This will be removed from the cache as all transactions will be added to the queue and eventually invoked,
-    # removing it on fail or success.
-    cached_offers = []
+    # A reservation is released when its operation is confirmed or dead lettered, or when it expires.
+    offer_reservations = None
 
     smart_contract = None
     contract_hash = None
@@ -51,30 +77,149 @@ class LootMarketsSmartContract(threading.Thread):
     wallet_path = None
     wallet_pass = None
 
+    # The maximum number of relayed transactions of each wallet that may be waiting for confirmation at once.
+    max_in_flight = 4
+
+    # The seconds a relayed transaction may wait to be confirmed before its operation is requeued.
+    tx_timeout = 300
+
+    # The seconds between checks of the pending transactions confirmed by the persisted blocks.
+    tx_check_interval = 1
+
+    # The hashes of the relayed transactions waiting to be confirmed.
     tx_in_progress = None
 
-    # Queue items are always a tuple (operation_name, args)
+    # The transactions waiting to be confirmed, a PendingTransaction for each hash in tx_in_progress.
+    pending_txs = None
+
+    # The maximum number of items a merged give_items invocation may give.
+    max_coalesced_items = 32
+
+    # The operations which may be packed together into the script of one invoke transaction.
+    packable_operations = ("give_items", "remove_item", "transfer_item", "put_offer", "buy_offer", "cancel_offer")
+
+    # The maximum number of operations packed into one transaction.
+    max_packed_operations = 8
+
+    # The maximum number of VM operations a packed script may execute when test invoked.
+    max_packed_ops = 20000
+
+    # The maximum GAS a packed script may consume above the free 10 GAS of a transaction.
+    max_packed_gas = Fixed8.Zero()
+
+    # The operations of each relayed transaction that have not notified their result yet,
+    # a list of (operation_name, address, transaction_keys) keyed by transaction hash.
+    tx_operations = None
+
+    # Queue items are always a tuple (operation_name, transaction_key, args),
+    # the transaction_key of merged give_items tasks is a list of the merged keys.
+    # Tasks are served by priority class, and in turns between addresses within a class.
     invoke_queue = None
-    wallet = None
-    _walletdb_loop = None
 
-    def __init__(self, contract_hash, wallet_path, wallet_pass):
+    # The durable journal of the queued operations, replayed when the API starts.
+    journal = None
+
+    # The read-through cache of the contract queries, invalidated by the Notify events of persisted blocks.
+    read_cache = None
+
+    # The operations which failed permanently or ran out of attempts.
+    dead_letters = None
+
+    # The offers of the marketplace in redis, updated from the Notify events of the offer operations.
+    offer_book = None
+
+    # The inventories of the marketplace in redis, updated from the Notify events of the item operations.
+    inventories = None
+
+    # Buffers the redis writes of the Notify events, flushed as one pipeline per persisted block.
+    notify_writes = None
+
+    # Confirms the relayed transactions from the persisted blocks, and records the status of each transaction key.
+    confirmations = None
+
+    # Pushes the results of the operations to the clients subscribed to their transaction keys or addresses.
+    events = None
+
+    # The progress of the bulk item grants, updated from the results of their invocations.
+    bulk_grants = None
+
+    # The maximum number of times a failing task is attempted before it is moved to the dead letters.
+    max_attempts = 5
+
+    # The seconds before the first retry of a failed task, doubled on every attempt up to retry_max_delay.
+    retry_base_delay = 2
+    retry_max_delay = 300
+
+    # While the wallets or the node fail, the queue is paused instead of charging the failures to the tasks,
+    # for retry_base_delay seconds doubled on every consecutive failure up to retry_max_delay.
+    infrastructure_failures = 0
+    paused_until = 0
+
+    # The maximum number of times one task may pause the queue before the failure is counted as an attempt of it,
+    # so a task which always fails the same way cannot hold up the queue.
+    max_task_pauses = 3
+
+    # The number of times the tasks paused the queue, by transaction key.
+    task_pauses = None
+
+    # The number of failed attempts of the tasks being retried, by transaction key.
+    task_attempts = None
+
+    # The transactions relayed before the API restarted, which are reconciled against the blockchain:
+    # a tuple (tasks, submitted_at) keyed by transaction hash.
+    recovered_txs = None
+
+    # The wallets kept open for the life of the process, shared by the invoke queue, test invokes and gas claims.
+    # Invokes are dispatched to the idle wallets, each must be authorized as an operator of the marketplace.
+    wallet_pool = None
+
+    # The maximum seconds an invoke waits for the wallet to sync.
+    wallet_sync_timeout = 60
+
+    # Keeps the GAS of the wallets split into small outputs and reserves the inputs of the transactions in progress.
+    utxo_manager = None
+
+    def __init__(self, contract_hash, wallet_path, wallet_pass, max_in_flight=4, max_coalesced_items=32, max_packed_operations=8,
+                 utxo_split_count=20, utxo_split_amount=0.01):
         super(LootMarketsSmartContract, self).__init__()
         self.daemon = True
 
         self.contract_hash = contract_hash
-        self.wallet_path = wallet_path
+        # A list of wallets may be given to invoke with in parallel.
+        self.wallet_path = wallet_path if isinstance(wallet_path, list) else [wallet_path]
         self.wallet_pass = wallet_pass
+        self.max_in_flight = max_in_flight
+        self.max_coalesced_items = max_coalesced_items
+        self.max_packed_operations = max_packed_operations
 
         self.smart_contract = SmartContract(contract_hash)
-        self.invoke_queue = Queue()
+        self.invoke_queue = InvokeScheduler()
 
         # Setup redis cache.
         self.redis_cache = redis.StrictRedis(host='localhost', port=6379, db=0)
+        self.notify_writes = RedisWriteBatch(self.redis_cache)
+        self.confirmations = ConfirmationTracker(self.redis_cache, self.notify_writes)
+        self.events = EventHub()
+        self.bulk_grants = BulkGrantJobs(self.redis_cache)
+        self.journal = InvokeJournal(self.redis_cache)
+        self.read_cache = BlockHeightCache(self.marketplace)
+        self.dead_letters = DeadLetterStore(self.redis_cache)
+        contract_storage = ContractStorage(contract_hash, self.marketplace)
+        self.offer_book = OfferBook(self.redis_cache, contract_storage)
+        self.inventories = InventoryStore(self.redis_cache, contract_storage, self.notify_writes)
+        self.offer_reservations = OfferReservations(self.redis_cache, self.marketplace)
+        self.task_attempts = {}
+        self.task_pauses = {}
+        self.recovered_txs = {}
 
         self.calling_transaction = None
-        self.tx_in_progress = None
-        self.wallet = None
+        self.tx_in_progress = set()
+        self.pending_txs = {}
+        self.tx_operations = {}
+        self._tx_operations_lock = threading.Lock()
+        self._last_tx_check = 0
+        self.wallet_pool = WalletPool(self.wallet_path, wallet_pass)
+        self.utxo_manager = UTXOManager(self.wallet_pool, utxo_split_count, utxo_split_amount)
 
         settings.set_log_smart_contract_events(False)
 
@@ -84,138 +229,80 @@ class LootMarketsSmartContract(threading.Thread):
         def sc_notify(event):
             """ This method catches Runtime.Notify calls, and updates the relevant cache. """
 
-            # Log the received smart contract event.
-            logger.info("- SmartContract Event: %s", str(event))
-            event_name = event.event_payload[0].decode("utf-8")
-
-            # ==== General Events ====
-            # Smart contract events that are not specific to a marketplace.
-
-            # Event: balance_of
-            if event_name == "balance_of":
-                # Convert the given script hash to an address.
-                script_hash = event.event_payload[1]
-                sh = UInt160.UInt160(data=script_hash)
-                address = Crypto.ToAddress(sh)
-                balance = int.from_bytes(event.event_payload[2], 'little')
-                # Save the balance to the cache.
-                logger.info("- Balance of %s updated to %s LOOT", address, balance)
-                self.redis_cache.set("balance:%s" % address, int(balance))
-                return
+            # The writes of the events of a block are flushed together once it is persisted,
+            # test invokes are not part of a block so their writes are flushed right away.
+            with self.notify_writes.batch(flush=event.test_mode) as pipe:
+                self._handle_notify(event, pipe)
 
-            # Event: get_marketplace_owner
-            if event_name == "get_marketplace_owner":
-                marketplace = event.event_payload[1].decode("utf-8")
-                script_hash = event.event_payload[2]
-                sh = UInt160.UInt160(data=script_hash)
-                address = Crypto.ToAddress(sh)
-                logger.info("- Owner of %s: %s", marketplace, address)
-                self.redis_cache.set("owner:%s" % marketplace, address)
-                return
+    def _handle_notify(self, event, pipe):
+        """
+        Update the relevant cache from a Runtime.Notify event.
 
-            # ==== Marketplace Events ====
-            # Events that are specific to a marketplace.
+        :param event:SmartContractEvent The Notify event.
+        :param pipe:Pipeline The buffered pipeline to add the redis writes of the event to.
+        """
+        # Log the received smart contract event.
+        logger.info("- SmartContract Event: %s", str(event))
 
-            # Get the name of the marketplace, if it is none this is not a marketplace operation, return.
-            marketplace = event.event_payload[1]
-            if marketplace is not None:
-                marketplace = marketplace.decode("utf-8")
-            else:
-                return
+        # Invalidate the cached queries depending on what a persisted operation changed.
+        if not event.test_mode:
+            self.read_cache.on_notify(event)
+            self.offer_book.on_notify(event, pipe)
+            self.inventories.on_notify(event, pipe)
 
-            # Ignore smart contract events that are not on our marketplace being used.
-            if marketplace != self.marketplace:
-                return
+        event_name = event.event_payload[0].decode("utf-8")
+
+        # ==== Marketplace Events ====
+        # Events that are specific to a marketplace.
 
-            # Event: get_inventory
-            if event_name == "get_inventory":
-                # Convert the script hash to an address.
-                script_hash = event.event_payload[2]
-                sh = UInt160.UInt160(data=script_hash)
-                address = Crypto.ToAddress(sh)
-
-                # After being converted from a byte to an int, append each element to the list.
-                inventory = []
-                for i in event.event_payload[3]:
-                    item_id = int.from_bytes(i, 'little')
-                    inventory.append(item_id)
-
-                # Update the inventory in the redis cache.
-                logger.info("- Setting inventory of %s to %s", address, inventory)
-                self.redis_cache.set("inventory:%s" % address, inventory)
-                self.redis_cache.set("inventoryUpdatedAt:%s" % address, int(time.time()))
-
-            # Event: get_all_offers
-            if event_name == "get_all_offers":
-                retrieved_offers = event.event_payload[2]
-                # Decode all the offers given in the payload.
-                offers = []
-                for i in retrieved_offers:
-                    # Offer is received like 'offer\x03' so we convert to 'offer3'.
-                    # We don't want to show the cached offers to the players.
-                    i = i.decode("utf-8")
-                    index = ord(i.split('offer')[1])
-                    offer_id = 'offer' + str(index)
-                    if offer_id not in self.cached_offers:
-                        offers.append(offer_id)
-
-                # Log the information and save to the cache.
-                logger.info("-Setting offers in marketplace: %s", offers)
-                self.redis_cache.set("offers", offers)
-                self.redis_cache.set("timeOffersUpdated", str(datetime.now()))
-
-            # Event: get_offer
-            if event_name == "get_offer":
-                print("Event: get_offer")
-                # Get all the relevant information about the offer.
-                offer = event.event_payload[2]
-                address = offer[0]
-                offer_id_encoded = offer[1]
-
-                # If the offer is empty, return.
-                if not offer:
-                    return
-
-                # We receive the offer index sent from contract in format e.g. "offer\x03", convert to "offer3".
-                index = ord(offer_id_encoded.decode().split('offer')[1])
-                offer_id = 'offer' + str(index)
-
-                # Decode the bytes into integers.
-                item_id = int.from_bytes(offer[2], 'little')
-                price = int.from_bytes(offer[3], 'little')
-
-                # Convert the script hash to an address.
-                script_hash = address
-                sh = UInt160.UInt160(data=script_hash)
-                address = Crypto.ToAddress(sh)
-
-                # Put the offer information in a list and save it to the redis cache with the offer id as the key.
-                offer_information = [address, offer_id, item_id, price]
-                logger.info("-Setting offer:%s to %s", offer_id, offer_information)
-                self.redis_cache.set(offer_id, offer_information)
-
-            # Event: Market/Item operation
-            # The game/operator must know if these operations were successfully completed within the smart contract.
-            # All of these notify events are sent in the same format.
-            if event_name in ("cancel_offer", "buy_offer", "put_offer", "give_items", "remove_item"):
-                # Convert the script hash to address.
-                script_hash = event.event_payload[2]
-                sh = UInt160.UInt160(data=script_hash)
-                address = Crypto.ToAddress(sh)
-                # Check if the operation was successfully completed within the smart contract.
+        # Get the name of the marketplace, if it is none this is not a marketplace operation, return.
+        marketplace = event.event_payload[1]
+        if marketplace is not None:
+            marketplace = marketplace.decode("utf-8")
+        else:
+            return
+
+        # Ignore smart contract events that are not on our marketplace being used.
+        if marketplace != self.marketplace:
+            return
+
+        # Event: Market/Item operation
+        # The game/operator must know if these operations were successfully completed within the smart contract.
+        # All of these notify events are sent in the same format, except transfer_item which
+        # notifies the receiving address and item before the result. The offer operations notify the offer
+        # after the result, which the offer book is updated from.
+        if event_name in ("cancel_offer", "buy_offer", "put_offer", "give_items", "remove_item", "transfer_item"):
+            # Convert the script hash to address.
+            script_hash = event.event_payload[2]
+            sh = UInt160.UInt160(data=script_hash)
+            address = Crypto.ToAddress(sh)
+            # Check if the operation was successfully completed within the smart contract.
+            if event_name == "transfer_item":
+                operation_successful = event.event_payload[5]
+            else:
                 operation_successful = event.event_payload[3]
-                # Save the address, and result to the cache with the event_name used as a key.
-                self.redis_cache.set(event_name+"%s" % address, operation_successful)
-                logger.info("-"+event_name+" of address %s was completed: %s", address, operation_successful)
+            logger.info("-"+event_name+" of address %s was completed: %s", address, operation_successful)
+
+            # Save the result under the transaction keys of the operation, matched through the hash of the
+            # transaction which notified it, so operations of the same address do not overwrite each other.
+            if not event.test_mode:
+                self._save_operation_result(pipe, event.tx_hash.ToString(), event.block_number, event_name, address,
+                                            operation_successful)
 
-    def add_invoke(self, operation_name, transaction_key, args):
+
+    def add_invoke(self, operation_name, transaction_key, args, priority=None):
         """
         Add a smart contract operation to the queue.
 
         :param operation_name:str The name of the operation to invoke.
         :param transaction_key:str The transaction key to associate with the transaction of the invoke.
         :param args:list The arguments to pass to the smart contract operation.
+        :param priority:str The priority class of the operation, one of InvokeScheduler.priority_classes,
+        by default the class of the operation.
         """
+        if priority is not None and priority not in self.invoke_queue.priority_classes:
+            raise ValueError("Unknown priority class %s" % priority)
+
         self.calling_transaction = True
 
         # By the LootMarkets smart contract convention, the marketplace name should be the
@@ -224,270 +311,706 @@ class LootMarketsSmartContract(threading.Thread):
 
         logger.info("SmartContractInvokeQueue: add_invoke %s %s" % (operation_name, str(args)))
         logger.info("- The queue size is : %s", self.invoke_queue.qsize())
-        self.invoke_queue.put((operation_name, transaction_key, args))
 
-    def run(self):
-        """ The smart contract invocation queue. """
-        while True:
-            task = self.invoke_queue.get()
-            logger.info("SmartContractInvokeQueue Task: %s", str(task))
-            operation_name,transaction_key, args = task
-            logger.info("- operation_name: %s, args: %s", operation_name, task)
-            logger.info("- queue size: %s", self.invoke_queue.qsize())
+        # Journal the operation first, so it survives a restart once the API has accepted it.
+        self.journal.acked(operation_name, transaction_key, args, priority)
+        self.invoke_queue.put((operation_name, transaction_key, args), priority=priority)
 
-            try:
-                self.invoke_operation(operation_name, transaction_key, *args)
-            except Exception as e:
-                logger.exception(e)
+    def add_invokes(self, operation_name, tasks, priority=None):
+        """
+        Add many smart contract operations to the queue, journaled together in one redis write.
+
+        :param operation_name:str The name of the operations to invoke.
+        :param tasks:list The (transaction_key, args) of each operation.
+        :param priority:str The priority class of the operations, one of InvokeScheduler.priority_classes,
+        by default the class of the operation.
+        """
+        if priority is not None and priority not in self.invoke_queue.priority_classes:
+            raise ValueError("Unknown priority class %s" % priority)
+
+        self.calling_transaction = True
+
+        # By the LootMarkets smart contract convention, the marketplace name is the first of the args.
+        tasks = [(transaction_key, [self.marketplace] + list(args)) for transaction_key, args in tasks]
 
-                # Wait a few seconds.
-                logger.info("Waiting 10 seconds...")
-                time.sleep(10)
+        logger.info("SmartContractInvokeQueue: add_invokes %s operations of %s" % (len(tasks), operation_name))
 
-                # Re-add the task to the queue.
-                logger.info("Re-adding the task to the queue....")
+        self.journal.acked_many(operation_name, tasks, priority)
+        for transaction_key, args in tasks:
+            self.invoke_queue.put((operation_name, transaction_key, args), priority=priority)
+        logger.info("- The queue size is : %s", self.invoke_queue.qsize())
+
+    def _recover_journal(self):
+        """
+        Replay the operations journaled before the API restarted. Operations which were never relayed are queued
+        again, those which were are reconciled against the blockchain before they are requeued.
+        """
+        recovered = 0
+        for operation_name, transaction_key, args, priority, tx_hash, submitted_at in self.journal.unfinished():
+            task = (operation_name, transaction_key, args)
+            recovered += 1
+            if priority is not None:
+                self.invoke_queue.prioritize([transaction_key], priority)
+            if tx_hash is None:
                 self.invoke_queue.put(task)
+                continue
+
+            tasks, _submitted_at = self.recovered_txs.setdefault(tx_hash, ([], submitted_at))
+            tasks.append(task)
+
+            # Save the results of the recovered transaction when it notifies them.
+            with self._tx_operations_lock:
+                self.tx_operations.setdefault(tx_hash, []).append((operation_name, args[1], [transaction_key]))
+
+        # The operations journaled with a transaction keep the keys of merged operations together.
+        for tx_hash in self.recovered_txs:
+            operations = self.journal.operations(tx_hash)
+            if operations is not None:
+                with self._tx_operations_lock:
+                    self.tx_operations[tx_hash] = operations
+
+        # The recovered transactions may have been persisted while the API was stopped, they are looked up once,
+        # after that the persisted blocks confirm them.
+        for tx_hash, (tasks, submitted_at) in self.recovered_txs.items():
+            self.confirmations.track(tx_hash, self._transaction_keys(tasks))
+            self.confirmations.check(tx_hash)
+
+        if recovered:
+            logger.info("Recovered %s operations from the journal, %s relayed transactions to reconcile.",
+                        recovered, len(self.recovered_txs))
+
+    @staticmethod
+    def _transaction_keys(tasks):
+        """
+        :param tasks:list The queue items.
+        :return:
+            list: The transaction keys of the tasks, merged tasks have a list of keys.
+        """
+        transaction_keys = []
+        for operation_name, transaction_key, args in tasks:
+            transaction_keys.extend(transaction_key if isinstance(transaction_key, list) else [transaction_key])
+        return transaction_keys
 
-            finally:
-                # Always mark task as done, because even on error it was done and re-added
-                self.invoke_queue.task_done()
+    def run(self):
+        """
+        The smart contract invocation queue.
+        Up to max_in_flight transactions are relayed without waiting for the previous ones to be confirmed,
+        each one is retired once it is found on the blockchain, or its operation requeued if it times out.
+        """
+        # Open the wallets once, they stay open for the life of the process.
+        self.wallet_pool.open()
 
-    def open_wallet(self):
-        """ Open a wallet. Needed for invoking contract operations. """
-        if self.wallet is not None:
-            return
-        self.wallet = UserWallet.Open(self.wallet_path, self.wallet_pass)
-        self._walletdb_loop = task.LoopingCall(self.wallet.ProcessBlocks)
-        self._walletdb_loop.start(1)
+        # Keep the GAS of the wallets split, so each transaction in flight has inputs of its own.
+        self.utxo_manager.start()
 
-    def close_wallet(self):
-        """ Close the currently opened wallet. """
-        if self.wallet is None:
-            return
-        self._walletdb_loop.stop()
-        self._walletdb_loop = None
-        self.wallet = None
-
-    def wallet_has_gas(self):
-        """ Check if the wallet has gas available. """
-        # Make sure no tx is in progress and we have GAS.
-        if self.wallet is None:
-            self.open_wallet()
-        synced_balances = self.wallet.GetSyncedBalances()
-        for balance in synced_balances:
-            asset, amount = balance
-            logger.info("- balance %s: %s", asset, amount)
-            if asset == "NEOGas" and amount > 0:
-                return True
+        # Replay the operations which were not confirmed before the API restarted.
+        self._recover_journal()
 
-        return False
+        # Build the offer book from the contract storage, it is kept up to date from the Notify events after that.
+        self.offer_book.start()
 
-    def claim_gas(self):
-        """ Claim gas from the wallet associated with the API. """
-        if self.wallet is None:
-            self.open_wallet()
-        ClaimGas(self.wallet)
-        self.close_wallet()
-
-    def put_in_cached_offers(self,offer_id):
-        """ Put an offer in the offers that are undergoing purchase or cancel. """
-        self.cached_offers.append(offer_id)
-
-    def _wait_for_tx(self,tx, max_seconds=300):
-        """ Wait for the transaction to show up on the blockchain. """
-        sec_passed = 0
-        while sec_passed < max_seconds:
-            _tx, height = Blockchain.Default().GetTransaction(tx.Hash.ToString())
-            if height > -1:
-                return True
-            # logger.info("Waiting for tx {} to show up on blockchain...".format(tx.Hash.ToString()))
-            time.sleep(5)
-            sec_passed += 5
+        # The inventories missed the Notify events while the API was stopped, they are loaded again as they are read.
+        self.inventories.clear()
 
-        logger.error("Transaction was relayed but never accepted by consensus node.")
-        return False
+        deferred_task = None
+        while True:
+            # Retire the transactions that have been confirmed or timed out.
+            self._check_pending_txs()
+
+            # Wait for the wallets or the node to recover.
+            if time.time() < self.paused_until:
+                time.sleep(1)
+                continue
+
+            # Wait until there is room in the in-flight window of the wallets.
+            if len(self.tx_in_progress) >= self.max_in_flight * len(self.wallet_pool):
+                time.sleep(1)
+                continue
+
+            # A task deferred because all the inputs were reserved is retried before any new task.
+            if deferred_task is not None:
+                task = deferred_task
+                deferred_task = None
+            else:
+                try:
+                    task = self.invoke_queue.get(timeout=1)
+                except Empty:
+                    continue
+                # Always mark task as done, because even on error it is re-added.
+                self.invoke_queue.task_done()
 
-    def search_tx(self,transaction_key):
+                # Merge the queued give_items of the same marketplace and address into this task.
+                if task[0] == "give_items":
+                    task = self._coalesce_give_items(task)
+
+            deferred_task = self._invoke_task(task)
+
+    def _invoke_task(self, task):
         """
-        Search for a transaction on the blockchain and the result of the operation.
+        Invoke a task taken from the queue, retrying it or moving it to the dead letters if it fails.
 
-        :param: transaction_key:str A key associated with a transaction which was returned when
-        invoking a smart contract operation from the API.
+        :param task:tuple The queue item.
+        :return:
+            tuple: The task if it must be invoked again before any other, because every wallet is busy
+            or the queue is paused, else None.
         """
-        # Get the tx with the given transaction_key.
-        tx = self.redis_cache.get(transaction_key)
+        logger.info("SmartContractInvokeQueue Task: %s", str(task))
+        operation_name,transaction_key, args = task
+        logger.info("- operation_name: %s, args: %s", operation_name, task)
+        logger.info("- queue size: %s, transactions in progress: %s", self.invoke_queue.qsize(), len(self.tx_in_progress))
+
+        transaction_keys = self._transaction_keys([task])
+        try:
+            if not self.invoke_operation(operation_name, transaction_key, *args):
+                # Every wallet is busy or has its inputs reserved, wait for a transaction to be confirmed.
+                time.sleep(1)
+                return task
+        except InfrastructureError as e:
+            logger.exception(e)
+
+            pauses = max(self.task_pauses.get(key, 0) for key in transaction_keys) + 1
+            if pauses > self.max_task_pauses:
+                # The failure follows the task rather than the wallets, count it as an attempt of the task.
+                for key in transaction_keys:
+                    self.task_pauses.pop(key, None)
+                self._retry_task(task, e)
+                return None
+
+            # The task may not have failed, pause the queue and retry it first without counting an attempt.
+            for key in transaction_keys:
+                self.task_pauses[key] = pauses
+            pause = min(self.retry_base_delay * 2 ** self.infrastructure_failures, self.retry_max_delay)
+            self.infrastructure_failures += 1
+            self.paused_until = time.time() + pause
+            logger.error("The wallet or node failed %s times in a row, pausing the queue for %s seconds.",
+                         self.infrastructure_failures, pause)
+            return task
+        except Exception as e:
+            logger.exception(e)
+
+            # Retry the task later without holding up the queue.
+            for key in transaction_keys:
+                self.task_pauses.pop(key, None)
+            self._retry_task(task, e)
+            return None
+
+        self.infrastructure_failures = 0
+        for key in transaction_keys:
+            self.task_pauses.pop(key, None)
+        return None
+
+    def _retry_task(self, task, error):
+        """
+        Schedule a failed task to be re-added to the queue with exponential backoff, or move it
+        to the dead letters if it failed permanently or has run out of attempts.
 
-        # If nothing is saved in the cache, return.
-        if not tx:
+        :param task:tuple The queue item which failed.
+        :param error:Exception The exception it failed with.
+        """
+        transaction_keys = self._transaction_keys([task])
+        attempts = max(self.task_attempts.get(key, 0) for key in transaction_keys) + 1
+        reason = classify_failure(error)
+
+        if reason == "permanent" or attempts >= self.max_attempts:
+            logger.error("Task %s failed %s times (%s), moving it to the dead letters.", task, attempts, reason)
+            for key in transaction_keys:
+                self.task_attempts.pop(key, None)
+            self.dead_letters.add(task, attempts, reason, error)
+            self.journal.dead_lettered(transaction_keys)
+            self._release_offer_reservations([task])
+            self.invoke_queue.forget(transaction_keys)
+            self._publish_dead_letter(task, transaction_keys)
+            self.bulk_grants.on_dead_letter(transaction_keys)
             return
 
-        # Try find the transaction on the blockchain.
-        _tx, height = Blockchain.Default().GetTransaction(tx.decode("utf-8"))
+        for key in transaction_keys:
+            self.task_attempts[key] = attempts
 
-        # If we find a tx, save true to the redis cache, else set false.
-        if _tx:
-            self.redis_cache.set("tx%s" % transaction_key, True)
-        else:
-            self.redis_cache.set("tx%s" % transaction_key, False)
+        delay = min(self.retry_base_delay * 2 ** (attempts - 1), self.retry_max_delay)
+        logger.info("Re-adding the task to the queue in %s seconds, attempt %s of %s.", delay, attempts, self.max_attempts)
+        timer = threading.Timer(delay, self.invoke_queue.put, [task])
+        timer.daemon = True
+        timer.start()
 
-    def test_invoke(self,transaction_type,operation_name,*args):
+    def _coalesce_give_items(self, task):
         """
-        Test invoke a smart contract operation. We catch the Notify events of the contract for instant query.
+        Merge the give_items tasks waiting in the queue for the same marketplace, address and priority class into
+        one task.
+        The merged task gives all their items in a single invocation, up to max_coalesced_items items.
 
-        :param transaction_type:str The type of smart contract operation we are test invoking.
-        :param operation_name:str The name of the operation we are test invoking.
-        :param args:list The arguments to pass to the smart contract operation.
+        :param task:tuple The give_items task taken from the queue.
         :return:
-            bool: Whether we found a tx for the test invoke.
-        """
-        if self.wallet is None:
-            self.open_wallet()
-
-        # If we get a marketplace specific operation, we need to add the marketplace
-        # name in front of the argument list as hence the LootMarkets smart contract convention.
-        if transaction_type == "market":
-            l = list(args)
-            l.insert(0,self.marketplace)
-            _args = [self.contract_hash, operation_name, str(l)]
-
-        # If we get a non-marketplace specific operation, we do not need to add the marketplace
-        # name in front of the argument list.
-        if transaction_type == "general":
-            _args = [self.contract_hash, operation_name, str(list(args))]
-
-        # Method of dealing with double backslashes being duplicated when sending.
-        if transaction_type == "offer":
-            # This transaction type will only be with an address or offer at the front.
-            if len(args) == 2:
-                address = args[0]
-                offer_id = str(args[1])
-                params = str([self.marketplace, address, offer_id])
-            else:
-                offer_id = str(args[0])
-                params = str([self.marketplace, offer_id])
+            tuple: The merged task, its transaction_key is the list of all the merged transaction keys.
+        """
+        operation_name, transaction_key, args = task
+        marketplace, address = args[0], args[1]
+        transaction_keys = transaction_key if isinstance(transaction_key, list) else [transaction_key]
+        items = list(args[2:])
+
+        def match(queued):
+            queued_operation, queued_key, queued_args = queued
+            # Only merge give_items for the same marketplace which still fit within the limit.
+            if queued_operation == "give_items" and queued_args[0] == marketplace \
+                    and len(items) + len(queued_args) - 2 <= self.max_coalesced_items:
+                transaction_keys.extend(queued_key if isinstance(queued_key, list) else [queued_key])
+                items.extend(queued_args[2:])
+                return True
+            return False
 
-            list_to_add = params.replace("\\", '', 1)
+        # Only the tasks of the priority class of the task are merged, so no task is served ahead of its class.
+        merged = len(self.invoke_queue.take_matching(task, match))
 
-            _args = [self.contract_hash, operation_name, list_to_add]
+        # The merged tasks were taken from the queue, mark them as done.
+        for i in range(merged):
+            self.invoke_queue.task_done()
 
-        logger.info("TestInvokeContract args: %s", _args)
-        tx, fee, results, num_ops = TestInvokeContract(self.wallet, _args)
-        if not tx:
-            logger.info("TestInvokeContract failed: no tx was found!")
-            self.close_wallet()
-            return False
+        if not merged:
+            return task
 
-        # If we found the tx,the result is a success, and the operation
-        # is a buy or cancel, we should cache it.
-        if operation_name in ["buy_offer","cancel_offer"]:
-            # Offers are concatenated in the smart contract for specific markets.
-            offer_id = self.marketplace+offer_id
-            self.cached_offers.append(offer_id)
+        logger.info("Merged %s give_items tasks for %s, giving %s items.", merged + 1, address, len(items))
+        return (operation_name, transaction_keys, [marketplace, address] + items)
 
-        return True
+    def wallet_has_gas(self, wallet):
+        """
+        Check if the wallet has gas available, must be called while holding the wallet session.
+
+        :param wallet:UserWallet The wallet to check.
+        """
+        synced_balances = wallet.GetSyncedBalances()
+        for balance in synced_balances:
+            asset, amount = balance
+            logger.info("- balance %s: %s", asset, amount)
+            if asset == "NEOGas" and amount > 0:
+                return True
 
+        return False
 
-    def invoke_operation(self, operation_name,transaction_key, *args):
+    def claim_gas(self):
+        """ Claim gas from the wallets associated with the API. """
+        for session in self.wallet_pool.sessions:
+            with session.use() as wallet:
+                ClaimGas(wallet)
+
+    def reserve_offer(self, offer_id, transaction_key):
         """
-        Directly invoke a smart contract operation.
+        Reserve an offer that is undergoing purchase or cancel, until its operation is finished.
 
-        :param operation_name:str The name of the smart contract operation to invoke.
-        :param transaction_key:str The transaction key to associate with the transaction of the invoke.
-        :param args:list The arguments to pass to the smart contract operation.
+        :param offer_id:str The offer id, in the form 'offer3'.
+        :param transaction_key:str The transaction key of the buy or cancel operation.
         """
-        logger.info("invoke_operation: operation_name=%s, args=%s", operation_name, args)
-        logger.info("Block %s / %s" % (str(Blockchain.Default().Height), str(Blockchain.Default().HeaderHeight)))
+        self.offer_reservations.reserve(offer_id, transaction_key)
 
-        self.open_wallet()
+    def _check_pending_txs(self):
+        """
+        Retire the pending transactions the persisted blocks confirmed, and requeue the operations of those timed out.
+        A transaction timing out is looked up on the blockchain once before it is requeued.
+        """
+        if not (self.tx_in_progress or self.recovered_txs) or time.time() - self._last_tx_check < self.tx_check_interval:
+            return
+        self._last_tx_check = time.time()
+
+        confirmed = self.confirmations.take_confirmed()
+        for tx_hash in list(self.tx_in_progress):
+            pending = self.pending_txs[tx_hash]
+            timed_out = time.time() - pending.relayed_at > self.tx_timeout
+            if tx_hash in confirmed or (timed_out and self.confirmations.check(tx_hash)):
+                logger.info("✅ Transaction found! %s", tx_hash)
+                self._retire_tx(pending)
+                self._confirm_tasks(pending.tasks)
+            elif timed_out:
+                logger.error("Transaction %s was relayed but never accepted by consensus node, requeueing.", tx_hash)
+                self.confirmations.untrack(tx_hash)
+                self._retire_tx(pending)
+                self._requeue_tx(tx_hash, pending.tasks)
+
+        # The transactions relayed before a restart can only be timed out once the blockchain has caught up.
+        caught_up = Blockchain.Default().Height >= Blockchain.Default().HeaderHeight
+        for tx_hash, (tasks, submitted_at) in list(self.recovered_txs.items()):
+            timed_out = caught_up and time.time() - submitted_at > self.tx_timeout
+            if tx_hash in confirmed or (timed_out and self.confirmations.check(tx_hash)):
+                logger.info("✅ Recovered transaction found! %s", tx_hash)
+                del self.recovered_txs[tx_hash]
+                self._confirm_tasks(tasks)
+            elif timed_out:
+                logger.error("Recovered transaction %s was never accepted by consensus node, requeueing.", tx_hash)
+                self.confirmations.untrack(tx_hash)
+                del self.recovered_txs[tx_hash]
+                self._requeue_tx(tx_hash, tasks)
+
+    def _confirm_tasks(self, tasks):
+        """
+        Remove the tasks of a confirmed transaction from the journal and the scheduler.
 
-        if not self.wallet:
-            raise Exception("Open a wallet before invoking a smart contract operation.")
+        :param tasks:list The queue items packed into the transaction.
+        """
+        transaction_keys = self._transaction_keys(tasks)
+        self.journal.confirmed(transaction_keys)
+        self.invoke_queue.forget(transaction_keys)
+        self._release_offer_reservations(tasks)
 
-        if self.tx_in_progress:
-            raise Exception("Transaction already in progress (%s)" % self.tx_in_progress.Hash.ToString())
+    def _requeue_tx(self, tx_hash, tasks):
+        """
+        Requeue the operations of a transaction that timed out.
 
-        logger.info("making sure wallet is synced...")
-        time.sleep(10)
+        :param tx_hash:str The hash of the transaction.
+        :param tasks:list The queue items packed into the transaction.
+        """
+        with self._tx_operations_lock:
+            self.tx_operations.pop(tx_hash, None)
+        self.journal.requeued(self._transaction_keys(tasks))
+        for task in tasks:
+            self.invoke_queue.put(task)
 
-        # Wait until wallet is synced:
-        while True:
-            if not self.wallet:
-                self.open_wallet()
-            percent_synced = int(100 * self.wallet._current_height / Blockchain.Default().Height)
-            if percent_synced > 99:
-                break
-            logger.info("waiting for wallet sync... height: %s. percent synced: %s" % (self.wallet._current_height, percent_synced))
-            time.sleep(5)
+    def _retire_tx(self, pending):
+        """
+        Remove a transaction from those in progress, freeing its inputs.
 
-        time.sleep(3)
-        logger.info("wallet synced. checking if gas is available...")
+        :param pending:PendingTransaction The transaction to retire.
+        """
+        self.tx_in_progress.discard(pending.tx_hash)
+        del self.pending_txs[pending.tx_hash]
+        self.utxo_manager.release(pending.tx_hash)
+        logger.info("Transaction %s retired, %s transactions in progress.", pending.tx_hash, len(self.tx_in_progress))
 
-        # If the wallet has no GAS, rebuild the wallet.
-        if not self.wallet_has_gas():
-            logger.error("Oh now, wallet has no gas! Trying to rebuild the wallet...")
-            self.wallet.Rebuild()
+    def _release_offer_reservations(self, tasks):
+        """
+        Release the offers reserved by the buy and cancel operations which are finished.
 
-            # Wait until rebuild is complete.
-            while not len(self.wallet.GetSyncedBalances()):
-                 percent_synced = int(100 * self.wallet._current_height / Blockchain.Default().Height)
-                 logger.info("rebuilding wallet... height: %s. percent synced: %s" % (self.wallet._current_height, percent_synced))
-                 time.sleep(10)
+        :param tasks:list The queue items which are finished.
+        """
+        tasks = [task for task in tasks if task[0] in ["buy_offer","cancel_offer"]]
+        if tasks:
+            self.offer_reservations.release(self._transaction_keys(tasks))
 
-            logger.info(self.wallet.GetSyncedBalances())
-            logger.info("Wallet rebuild complete. waiting 10 sec and trying again...")
-            time.sleep(10)
+    def _relay_tx(self, wallet, tx, fee):
+        """
+        Sign and relay an invocation transaction, spending free inputs chosen by the UTXO manager,
+        which stay reserved until the transaction is retired.
 
-            raise Exception("Wallet has no gas.")
+        :param wallet:UserWallet The wallet to sign with, held by the caller.
+        :param tx:InvocationTransaction The transaction built by TestInvokeContract.
+        :param fee:Fixed8 The network fee to attach to the transaction.
+        :return:
+            InvocationTransaction: The relayed transaction, or None if no unreserved inputs could pay for it.
+        """
+        # Choose the inputs to pay the network fee and the GAS consumed by the script.
+        inputs = self.utxo_manager.select_inputs(wallet, fee + tx.Gas)
+        if inputs is None:
+            return None
+
+        wallet_tx = wallet.MakeTransaction(tx=tx, fee=fee, use_standard=True,
+                                           use_vins_for_asset=[inputs, Blockchain.SystemCoin().Hash])
+        if not wallet_tx:
+            return None
+
+        context = ContractParametersContext(wallet_tx)
+        wallet.Sign(context)
+        if not context.Completed:
+            raise InfrastructureError("InvokeContract failed: incomplete signature")
+
+        wallet_tx.scripts = context.GetScripts()
+        if not NodeLeader.Instance().Relay(wallet_tx):
+            raise InfrastructureError("InvokeContract failed: could not relay tx %s" % wallet_tx.Hash.ToString())
+
+        # Mark the inputs as spent within the wallet, and reserve them until the transaction is retired.
+        wallet.SaveTransaction(wallet_tx)
+        self.utxo_manager.reserve(wallet_tx.Hash.ToString(), wallet_tx.inputs)
+        return wallet_tx
+
+    def _save_operation_result(self, pipe, tx_hash, height, operation_name, address, operation_successful):
+        """
+        Save the Notify result of an operation in a relayed transaction under its transaction keys.
+        Packed operations are matched to their result in order by operation name and address.
+
+        :param pipe:Pipeline The buffered pipeline to add the writes to.
+        :param tx_hash:str The hash of the transaction which notified the result.
+        :param height:int The height of the block of the transaction.
+        :param operation_name:str The name of the operation notified.
+        :param address:str The address the operation was notified for.
+        :param operation_successful:bytes Whether the operation was successfully completed.
+        """
+        with self._tx_operations_lock:
+            operations = self.tx_operations.get(tx_hash)
+            if not operations:
+                return
 
+            transaction_keys = None
+            for i, (queued_operation, queued_address, queued_keys) in enumerate(operations):
+                if queued_operation == operation_name and queued_address == address:
+                    transaction_keys = queued_keys
+                    del operations[i]
+                    break
+
+            if not operations:
+                del self.tx_operations[tx_hash]
+
+        if transaction_keys is None:
+            return
+        for key in transaction_keys:
+            pipe.set("result:%s" % key, operation_successful)
+
+        # Push the result to the subscribers once it is written, so what they read back agrees with it.
+        if isinstance(operation_successful, bytes):
+            operation_successful = int.from_bytes(operation_successful, byteorder='little')
+        self.bulk_grants.on_result(pipe, transaction_keys, operation_successful)
+        for key in transaction_keys:
+            event = {
+                "type": "result",
+                "transaction_key": key,
+                "operation": operation_name,
+                "address": address,
+                "tx_hash": tx_hash,
+                "tx_found": "True",
+                "block_height": height,
+                "operation_complete": bool(operation_successful),
+                "dead_letter": None
+            }
+            topics = [self.events.transaction_topic(key), self.events.address_topic(address)]
+            self.notify_writes.after_flush(lambda topics=topics, event=event: self.events.publish(topics, event))
+
+    def _publish_dead_letter(self, task, transaction_keys):
+        """
+        Push to the subscribers that the operations of a task were moved to the dead letters.
+
+        :param task:tuple The queue item which failed.
+        :param transaction_keys:list The transaction keys of the task.
+        """
+        operation_name, transaction_key, args = task
+        address = args[1] if len(args) > 1 else None
+        for key in transaction_keys:
+            # A task without an address is only pushed to the subscribers of its transaction keys.
+            topics = [self.events.transaction_topic(key)]
+            if address is not None:
+                topics.append(self.events.address_topic(address))
+            event = {
+                "type": "dead_letter",
+                "transaction_key": key,
+                "operation": operation_name,
+                "address": address,
+                "tx_hash": None,
+                "tx_found": None,
+                "block_height": None,
+                "operation_complete": None,
+                "dead_letter": self.dead_letters.get(key)
+            }
+            self.events.publish(topics, event)
+
+    def _peek_queue(self):
+        """ Return the next task in the queue without taking it, or None if the queue is empty. """
+        return self.invoke_queue.peek()
+
+    def _return_tasks(self, tasks):
+        """
+        Put packed tasks that were not relayed back at the front of the queue, keeping their order.
+
+        :param tasks:list The tasks to return to the queue.
+        """
+        if not tasks:
+            return
+        self.invoke_queue.put_front(tasks)
+
+    def _build_invoke_script(self, wallet, operation_name, args):
+        """
+        Build the script of a Main(operation, args) app call to the smart contract,
+        pushing the parameters the same way TestInvokeContract does.
+
+        :param wallet:UserWallet The wallet used to parse the parameters.
+        :param operation_name:str The name of the smart contract operation.
+        :param args:list The arguments to pass to the smart contract operation.
+        :return:
+            bytes: The hex encoded script.
+        """
         # The offer must be sent to contract exactly like e.g. "offer\x03" slashes are duplicated in the offer
         # strings when sent through the API, we remove the duplication.
         s = str(list(args))
         if "offer" in s:
             s = s.replace("\\",'',1)
-            _args = [self.contract_hash, operation_name, s]
-        else:
-            _args = [self.contract_hash, operation_name, str(list(args))]
 
-        logger.info("TestInvokeContract args: %s", _args)
-        tx, fee, results, num_ops = TestInvokeContract(self.wallet, _args)
+        # Parameters are pushed in reverse order, the argument list is packed into an array.
+        sb = ScriptBuilder()
+        for p in [s, operation_name]:
+            item = parse_param(p, wallet)
+            if type(item) is list:
+                item.reverse()
+                for list_item in item:
+                    sb.push(parse_param(list_item, wallet))
+                sb.push(len(item))
+                sb.Emit(PACK)
+            else:
+                sb.push(item)
 
-        if not tx:
-            raise Exception("TestInvokeContract failed")
+        sb.EmitAppCall(UInt160.UInt160.ParseString(self.contract_hash).Data)
+        return sb.ToArray()
 
-        # Store the transaction in redis.
-        logger.info("TestInvokeContract done, calling InvokeContract now...")
-        sent_tx = InvokeContract(self.wallet, tx, fee)
+    def _pack_tasks(self, wallet, task):
+        """
+        Test invoke a task, packing the queued tasks after it into the same script as long as
+        the script stays within max_packed_operations, max_packed_ops and max_packed_gas.
 
-        if sent_tx:
+        :param wallet:UserWallet The wallet to test invoke with, held by the caller.
+        :param task:tuple The task taken from the queue.
+        :return:
+            tuple: The list of packed tasks, and the transaction and fee of their test invoke.
+        """
+        operation_name, transaction_key, args = task
+        if operation_name not in self.packable_operations:
+            raise PermanentInvokeError("%s is not an operation of the invoke queue" % operation_name)
+        script = self._build_invoke_script(wallet, operation_name, args)
+
+        logger.info("TestInvokeContract operation: %s, args: %s", operation_name, args)
+        try:
+            tx, fee, results, num_ops = test_invoke(script, wallet, [])
+        except Exception as e:
+            # The wallet could not make or sign the transaction, the script was not run.
+            raise InfrastructureError("TestInvokeContract failed: %s" % str(e))
+
+        # test_invoke returns no transaction if the VM raised while running the script, and no results
+        # if the engine ended in the FAULT state, the script faults the same way however often it is retried.
+        if not tx or not results:
+            raise PermanentInvokeError("TestInvokeContract faulted: %s %s" % (operation_name, args))
+
+        tasks = [task]
+        while len(tasks) < self.max_packed_operations:
+            queued = self._peek_queue()
+            if queued is None or queued[0] not in self.packable_operations:
+                break
 
-            # Save the sent transaction in the redis cache.
-            self.redis_cache.set(transaction_key,sent_tx.Hash.ToString())
+            # Each app call leaves its result on the stack, so a script that did not fault returns one per operation.
+            packed_script = script + self._build_invoke_script(wallet, queued[0], queued[2])
+            try:
+                packed_tx, packed_fee, packed_results, packed_num_ops = test_invoke(packed_script, wallet, [])
+            except Exception as e:
+                logger.exception(e)
+                break
+            if not packed_tx or len(packed_results) != len(tasks) + 1:
+                break
+            if packed_num_ops > self.max_packed_ops or packed_tx.Gas > self.max_packed_gas:
+                break
 
-            logger.info("InvokeContract success, transaction underway: %s" % sent_tx.Hash.ToString())
-            self.tx_in_progress = sent_tx
+            # The operation fits, take it from the queue unless a task put meanwhile is served before it.
+            if not self.invoke_queue.take_if_head(queued):
+                break
+            self.invoke_queue.task_done()
+            tasks.append(queued)
+            script, tx, fee, num_ops = packed_script, packed_tx, packed_fee, packed_num_ops
 
-            found = self._wait_for_tx(sent_tx)
-            if found:
-                logger.info("✅ Transaction found!")
-            else:
-                logger.error("=== TX not found!")
+        if len(tasks) > 1:
+            logger.info("Packed %s operations into one transaction, %s ops.", len(tasks), num_ops)
+        return tasks, tx, fee
+
+    def _idle_session(self):
+        """
+        Choose the wallet to invoke the next task with, preferring synced wallets with GAS
+        and then the wallet with the fewest transactions in progress.
 
-            # If this operation is buy or cancel, remove the first element
-            # from the cached offers, the operations are ordered in the queue so we may do this.
-            if operation_name in ["buy_offer","cancel_offer"]:
-                del self.cached_offers[0]
+        :return:
+            WalletSession: The wallet session, or None if every wallet has max_in_flight transactions in progress.
+        """
+        in_flight = dict((session, 0) for session in self.wallet_pool.sessions)
+        for pending in self.pending_txs.values():
+            in_flight[pending.session] += 1
 
-            self.close_wallet()
+        idle_sessions = [session for session in self.wallet_pool.sessions if in_flight[session] < self.max_in_flight]
+        if not idle_sessions:
+            return None
+        return min(idle_sessions, key=lambda session: (not session.is_synced(), session.gas <= 0, in_flight[session]))
 
-            # time.sleep(100)
-            self.tx_in_progress = None
-            logger.info("InvokeContract done, tx_in_progress freed.")
+    def search_tx(self,transaction_key):
+        """
+        Search for the transaction of an operation, as recorded by the confirmation tracker.
 
-        else:
-            raise Exception("InvokeContract failed")
+        :param: transaction_key:str A key associated with a transaction which was returned when
+        invoking a smart contract operation from the API.
+        :return:
+            dict: The tx_hash, status and block height of the transaction, or None if it was never relayed.
+        """
+        return self.confirmations.status(transaction_key)
 
+    def invoke_operation(self, operation_name,transaction_key, *args):
+        """
+        Directly invoke a smart contract operation.
 
+        :param operation_name:str The name of the smart contract operation to invoke.
+        :param transaction_key:str The transaction key to associate with the transaction of the invoke,
+        or a list of keys if the task merges several operations.
+        :param args:list The arguments to pass to the smart contract operation.
+        :return:
+            bool: Whether the transaction was relayed, False if every wallet is busy or has its inputs reserved.
+        """
+        logger.info("invoke_operation: operation_name=%s, args=%s", operation_name, args)
+        logger.info("Block %s / %s" % (str(Blockchain.Default().Height), str(Blockchain.Default().HeaderHeight)))
 
+        # Dispatch the task to the idle wallet.
+        session = self._idle_session()
+        if session is None:
+            logger.info("Every wallet has transactions in progress, deferring the task.")
+            return False
+        logger.info("Invoking with wallet %s", session.wallet_path)
+
+        # Wait until wallet is synced, returns at once if it already is.
+        logger.info("making sure wallet is synced...")
+        if not session.wait_synced(self.wallet_sync_timeout):
+            raise InfrastructureError("Wallet is not synced, height: %s / %s" % (session.wallet._current_height, Blockchain.Default().Height))
+        logger.info("wallet synced. checking if gas is available...")
+
+        # If the wallet has no GAS, rebuild the wallet.
+        with session.use() as wallet:
+            has_gas = self.wallet_has_gas(wallet)
+            if not has_gas:
+                logger.error("Oh now, wallet has no gas! Trying to rebuild the wallet...")
+                wallet.Rebuild()
 
+        if not has_gas:
+            # Wait until rebuild is complete.
+            while not session.wait_synced(10):
+                 percent_synced = int(100 * session.wallet._current_height / Blockchain.Default().Height)
+                 logger.info("rebuilding wallet... height: %s. percent synced: %s" % (session.wallet._current_height, percent_synced))
+
+            logger.info(session.wallet.GetSyncedBalances())
+            logger.info("Wallet rebuild complete. trying again...")
+
+            raise InfrastructureError("Wallet has no gas.")
 
+        with session.use() as wallet:
+            # Test invoke the operation, packing in the operations queued after it.
+            tasks, tx, fee = self._pack_tasks(wallet, (operation_name, transaction_key, list(args)))
 
+            # Store the transaction in redis.
+            logger.info("TestInvokeContract done, calling InvokeContract now...")
+            try:
+                sent_tx = self._relay_tx(wallet, tx, fee)
+            except Exception:
+                self._return_tasks(tasks[1:])
+                raise
+
+        if not sent_tx:
+            self._return_tasks(tasks[1:])
+            # Wait for the inputs of a transaction in progress of this wallet to be freed, or for its GAS to be split.
+            if any(pending.session is session for pending in self.pending_txs.values()) \
+                    or self.utxo_manager.is_splitting(session):
+                logger.info("All inputs are reserved by transactions in progress, deferring the task.")
+                return False
+            raise InfrastructureError("InvokeContract failed")
+
+        tx_hash = sent_tx.Hash.ToString()
+        operations = []
+        for packed_operation, packed_key, packed_args in tasks:
+            transaction_keys = packed_key if isinstance(packed_key, list) else [packed_key]
+            # The address of a marketplace operation follows the marketplace in its args.
+            operations.append((packed_operation, packed_args[1], transaction_keys))
+
+        # Remember the operations of the transaction, so their results are saved under their transaction keys.
+        with self._tx_operations_lock:
+            self.tx_operations[tx_hash] = operations
+        self.journal.submitted(self._transaction_keys(tasks), tx_hash, operations)
+        for key in self._transaction_keys(tasks):
+            self.task_attempts.pop(key, None)
+
+        # Track the transaction until a persisted block includes it, saving its status under every key it was invoked for.
+        self.confirmations.track(tx_hash, self._transaction_keys(tasks))
+        pending = PendingTransaction(sent_tx, tasks, session)
+        self.pending_txs[pending.tx_hash] = pending
+        self.tx_in_progress.add(pending.tx_hash)
+        logger.info("InvokeContract success, transaction underway: %s" % pending.tx_hash)
+
+        return True
@@ -0,0 +1,168 @@
+"""
+=====================================================================================
+
+Inventories of the marketplace, materialized in redis.
+
+The inventory of an address is kept as a redis list of its item ids, in the order of the list the
+smart contract stores: items are given by appending them, and removed by removing their first
+occurrence, the same as the contract does. An inventory is loaded from the contract storage the
+first time it is read, and updated incrementally from the Notify events of the give_items,
+remove_item, transfer_item, put_offer, buy_offer and cancel_offer operations of persisted blocks
+after that, which notify the items they moved.
+
+Events missed while the API is stopped cannot be replayed, so the inventories are cleared when
+it starts and loaded again as they are read.
+
+=====================================================================================
+"""
+
+import threading
+from logzero import logger
+from neocore import UInt160
+from neocore.Cryptography.Crypto import Crypto
+from neo.Core.Blockchain import Blockchain
+from LootMarketCodec import decode_int
+
+
+class InventoryStore:
+    """ The inventories of a marketplace in redis, kept up to date from the Notify events of the item operations. """
+
+    # The operations which move items between inventories.
+    item_operations = ("give_items", "remove_item", "transfer_item", "put_offer", "buy_offer", "cancel_offer")
+
+    def __init__(self, redis_cache, contract_storage, write_batch):
+        """
+        :param redis_cache:StrictRedis The redis connection the inventories are kept in.
+        :param contract_storage:ContractStorage The reader of the contract storage the inventories are loaded from.
+        :param write_batch:RedisWriteBatch The buffered writes of the Notify events. The loaded inventories are
+        written after the buffered writes, so the events are not applied twice to an inventory which includes them.
+        """
+        self.redis_cache = redis_cache
+        self.contract_storage = contract_storage
+        self.write_batch = write_batch
+        self.marketplace = contract_storage.marketplace.decode("utf-8")
+        self.prefix = "inventory_items:%s:" % self.marketplace
+
+        # The number of item events seen, and the highest block height of one. An inventory is not saved
+        # if an event was seen while it was loaded, as the loaded inventory may miss what the event changed.
+        self.events_seen = 0
+        self.event_height = -1
+
+        self._lock = threading.Lock()
+
+    def inventory_key(self, address):
+        return self.prefix + address
+
+    def clear(self):
+        """ Remove every materialized inventory, they are loaded again as they are read. """
+        keys = list(self.redis_cache.scan_iter(match=self.prefix + "*"))
+        if keys:
+            self.redis_cache.delete(*keys)
+        logger.info("- Inventories: cleared %s materialized inventories", len(keys))
+
+    def get(self, address):
+        """
+        Read the inventory of an address, loading it from the contract storage if it is not materialized.
+
+        :param address:str The address to read the inventory of.
+        :return:
+            list: The item ids the address owns on the marketplace.
+        """
+        items = self.redis_cache.lrange(self.inventory_key(address), 0, -1)
+        if items:
+            return [int(item) for item in items]
+
+        with self._lock:
+            events_seen = self.events_seen
+            event_height = self.event_height
+        height = Blockchain.Default().Height
+
+        inventory = self.contract_storage.get_inventory(address)
+
+        # The Notify events of a block are raised before its storage is written, so the inventory read
+        # is only saved if every event seen so far is in the storage and none arrived while reading it.
+        with self.write_batch.batch() as pipe, self._lock:
+            if inventory and self.events_seen == events_seen and event_height <= height:
+                pipe.delete(self.inventory_key(address))
+                pipe.rpush(self.inventory_key(address), *inventory)
+        return inventory
+
+    def get_many(self, addresses):
+        """
+        Read the materialized inventories of many addresses in one redis round trip.
+
+        :param addresses:list The addresses to read the inventories of.
+        :return:
+            dict: The item ids of each address whose inventory is materialized, by address. The others are
+            missing and must be read with get().
+        """
+        pipe = self.redis_cache.pipeline(transaction=False)
+        for address in addresses:
+            pipe.lrange(self.inventory_key(address), 0, -1)
+        return dict((address, [int(item) for item in items])
+                    for address, items in zip(addresses, pipe.execute()) if items)
+
+    def on_notify(self, event, pipe):
+        """
+        Apply a Notify event of a persisted block to the materialized inventories.
+
+        :param event:SmartContractEvent The Notify event.
+        :param pipe:Pipeline The pipeline to add the writes to, written with the other writes of the block.
+        """
+        payload = event.event_payload
+        event_name = payload[0].decode("utf-8")
+        if event_name not in self.item_operations or payload[1] is None or payload[1].decode("utf-8") != self.marketplace:
+            return
+
+        with self._lock:
+            self.events_seen += 1
+            self.event_height = max(self.event_height, event.block_number)
+
+            try:
+                self._apply(pipe, event_name, payload)
+            except (IndexError, ValueError):
+                # A contract which does not notify the items, forget the inventories so they are loaded again.
+                logger.info("- Inventories: %s did not notify its items, reloading the inventories", event_name)
+                for address in self._addresses(event_name, payload):
+                    pipe.delete(self.inventory_key(address))
+
+    def _apply(self, pipe, event_name, payload):
+        """ Add the writes of an item event to a pipeline, only the materialized inventories are updated. """
+        if event_name == "transfer_item":
+            address_from, address_to = self._addresses(event_name, payload)
+            if payload[5] and address_from != address_to:
+                item_id = decode_int(payload[4])
+                pipe.lrem(self.inventory_key(address_from), 1, item_id)
+                pipe.rpushx(self.inventory_key(address_to), item_id)
+            return
+
+        # The operation failed, no items moved.
+        if not payload[3]:
+            return
+
+        address = self._address(payload[2])
+        if event_name == "give_items":
+            # The args of the operation are notified, the items given follow the marketplace and address.
+            args = payload[4]
+            if not isinstance(args, (list, tuple)) or len(args) < 2:
+                raise ValueError("give_items notified %r instead of its args" % (args,))
+            for item in args[2:]:
+                pipe.rpushx(self.inventory_key(address), decode_int(item))
+        elif event_name == "remove_item":
+            pipe.lrem(self.inventory_key(address), 1, decode_int(payload[4]))
+        elif event_name == "put_offer":
+            pipe.lrem(self.inventory_key(address), 1, decode_int(payload[5]))
+        else:
+            # The item of a bought offer is given to the buyer, the item of a cancelled offer back to its owner.
+            pipe.rpushx(self.inventory_key(address), decode_int(payload[5]))
+
+    def _addresses(self, event_name, payload):
+        """ The addresses whose inventory an item event changes. """
+        if event_name == "transfer_item":
+            return [self._address(payload[2]), self._address(payload[3])]
+        return [self._address(payload[2])]
+
+    @staticmethod
+    def _address(script_hash):
+        """ Convert a notified script hash to an address. """
+        return Crypto.ToAddress(UInt160.UInt160(data=script_hash))
@@ -0,0 +1,376 @@
+"""
+=====================================================================================
+
+Offer book of the marketplace, materialized in redis.
+
+Each offer on the marketplace is kept as a redis hash, indexed by sorted sets of the offers by id,
+price, item id and seller, so the market can be listed sorted and paginated without reading every
+offer from the contract storage.
+
+The book is updated incrementally from the Notify events of the put_offer, buy_offer and cancel_offer
+operations of persisted blocks, which notify the offer after their result. It is reconciled against
+the contract storage when it is started and periodically after that, which repairs the offers missed
+while the API was stopped or notified by a contract deployed before the offer was notified.
+
+The offers being bought or cancelled are reserved in redis until their operation is confirmed,
+so the market does not show them in the meantime.
+
+=====================================================================================
+"""
+
+import time
+import threading
+from logzero import logger
+from neocore import UInt160
+from neocore.Cryptography.Crypto import Crypto
+from neo.Core.Blockchain import Blockchain
+from LootMarketCodec import decode_int
+
+
+def offer_id_from_bytes(marketplace, data):
+    """
+    Convert an offer id of the smart contract to the form used by the API.
+
+    :param marketplace:str The name of the marketplace.
+    :param data:bytes The offer id, e.g. 'offer\\x03', optionally preceded by the name of the marketplace.
+    :return:
+        str: The offer id in the form 'offer3'.
+    """
+    data = bytes(data)
+    marketplace = marketplace.encode("utf-8")
+    if data.startswith(marketplace):
+        data = data[len(marketplace):]
+    return 'offer' + str(decode_int(data[len(b'offer'):]))
+
+
+def offer_index(offer_id):
+    """
+    :param offer_id:str The offer id in the form 'offer3'.
+    :return:
+        int: The index of the offer.
+    """
+    return int(offer_id.split('offer', 1)[1])
+
+
+class OfferBook:
+    """ The offers of a marketplace in redis, kept up to date from the Notify events of the offer operations. """
+
+    # The orders the offers can be listed in, and the sorted set of each.
+    sort_orders = ("id", "price", "item_id")
+
+    # The seconds between reconciliations of the book against the contract storage.
+    reconcile_interval = 600
+
+    def __init__(self, redis_cache, contract_storage):
+        """
+        :param redis_cache:StrictRedis The redis connection the book is kept in.
+        :param contract_storage:ContractStorage The reader of the contract storage the book is reconciled against.
+        """
+        self.redis_cache = redis_cache
+        self.contract_storage = contract_storage
+        self.marketplace = contract_storage.marketplace.decode("utf-8")
+        self.prefix = "offer_book:%s:" % self.marketplace
+
+        # The number of events applied, and the highest block height of an applied event.
+        # A reconciliation is discarded if an event was applied while it read the storage.
+        self.events_applied = 0
+        self.event_height = -1
+
+        # The seller of each offer put since the last reconciliation. The writes of the events of a block are
+        # flushed once it is persisted, so an offer bought or cancelled in the block it was put in is not in redis
+        # yet when it is removed, and its seller is looked up here instead.
+        self._sellers = {}
+
+        self._lock = threading.Lock()
+        self._thread = None
+
+    def start(self):
+        """ Reconcile the book against the contract storage in the background, then again every reconcile_interval. """
+        if self._thread is not None:
+            return
+        self._thread = threading.Thread(target=self._reconcile_loop, daemon=True)
+        self._thread.start()
+
+    # region Keys
+
+    def offer_key(self, offer_id):
+        return self.prefix + "offer:" + offer_id
+
+    def sort_key(self, sort):
+        return self.prefix + "by_" + sort
+
+    def seller_key(self, address):
+        return self.prefix + "seller:" + address
+
+    # endregion
+
+    def _put(self, pipe, offer_id, address, item_id, price):
+        """ Add the writes of an offer to a pipeline. """
+        pipe.hmset(self.offer_key(offer_id), {"offer_id": offer_id, "address": address, "item_id": item_id, "price": price})
+        pipe.zadd(self.sort_key("id"), offer_index(offer_id), offer_id)
+        pipe.zadd(self.sort_key("price"), price, offer_id)
+        pipe.zadd(self.sort_key("item_id"), item_id, offer_id)
+        pipe.zadd(self.seller_key(address), offer_index(offer_id), offer_id)
+
+    def _remove(self, pipe, offer_id, address):
+        """ Add the writes removing an offer to a pipeline. """
+        pipe.delete(self.offer_key(offer_id))
+        for sort in self.sort_orders:
+            pipe.zrem(self.sort_key(sort), offer_id)
+        if address is not None:
+            pipe.zrem(self.seller_key(address), offer_id)
+
+    def on_notify(self, event, pipe):
+        """
+        Apply a Notify event of a persisted block to the book.
+
+        :param event:SmartContractEvent The Notify event.
+        :param pipe:Pipeline The pipeline to add the writes to, written with the other writes of the block.
+        """
+        payload = event.event_payload
+        event_name = payload[0].decode("utf-8")
+        if event_name not in ("put_offer", "buy_offer", "cancel_offer") or payload[1].decode("utf-8") != self.marketplace:
+            return
+
+        # The operation failed, the offers did not change.
+        if not payload[3]:
+            return
+
+        # A contract which does not notify the offer, the next reconciliation picks up the change.
+        if len(payload) < 5:
+            logger.info("- Offer book: %s did not notify the offer, waiting for the reconciliation", event_name)
+            return
+
+        offer_id = offer_id_from_bytes(self.marketplace, payload[4])
+        with self._lock:
+            if event_name == "put_offer":
+                address = Crypto.ToAddress(UInt160.UInt160(data=payload[2]))
+                item_id = decode_int(payload[5])
+                price = decode_int(payload[6])
+                self._put(pipe, offer_id, address, item_id, price)
+                self._sellers[offer_id] = address
+                logger.info("- Offer book: put %s of %s, item %s for %s LOOT", offer_id, address, item_id, price)
+            else:
+                # The offer is removed by its id, whichever order the events of the block came in.
+                address = self._sellers.pop(offer_id, None)
+                if address is None:
+                    address = self.redis_cache.hget(self.offer_key(offer_id), "address")
+                    address = address.decode("utf-8") if address else None
+                self._remove(pipe, offer_id, address)
+                logger.info("- Offer book: removed %s", offer_id)
+            pipe.set(self.prefix + "updated_at", time.time())
+
+            self.events_applied += 1
+            self.event_height = max(self.event_height, event.block_number)
+
+    def reconcile(self):
+        """
+        Rebuild the book from the contract storage.
+
+        :return:
+            bool: Whether the book was rebuilt, it is not if an offer operation was notified while reading the storage.
+        """
+        with self._lock:
+            events_applied = self.events_applied
+            event_height = self.event_height
+        height = Blockchain.Default().Height
+
+        # The Notify events of a block are raised before its storage is written, so the storage may not include
+        # the events applied so far yet.
+        if event_height > height:
+            return False
+
+        offers = []
+        for offer_id in self.contract_storage.get_all_offers():
+            offer = self.contract_storage.get_offer(offer_id)
+            if offer is not None:
+                offers.append(offer)
+
+        with self._lock:
+            if self.events_applied != events_applied:
+                logger.info("- Offer book: offers changed while reconciling, retrying on the next reconciliation")
+                return False
+
+            stale_keys = list(self.redis_cache.scan_iter(match=self.prefix + "*"))
+            pipe = self.redis_cache.pipeline()
+            if stale_keys:
+                pipe.delete(*stale_keys)
+            for address, offer_id, item_id, price in offers:
+                self._put(pipe, offer_id, address, item_id, price)
+            pipe.set(self.prefix + "updated_at", time.time())
+            pipe.set(self.prefix + "reconciled_height", height)
+            pipe.execute()
+            self._sellers.clear()
+
+        logger.info("- Offer book: reconciled %s offers at height %s", len(offers), height)
+        return True
+
+    def page(self, sort="id", descending=False, offset=0, limit=50, seller=None, exclude=()):
+        """
+        List the offers of the book.
+
+        :param sort:str The order of the offers, one of sort_orders.
+        :param descending:bool Whether to list the offers in descending order.
+        :param offset:int The number of offers to skip.
+        :param limit:int The maximum number of offers to list, or None to list every offer after offset.
+        :param seller:str Only list the offers of this address.
+        :param exclude:list The ids of offers to leave out, such as the offers being bought or cancelled.
+        :return:
+            tuple: The offers listed, each [address, offer_id, item_id, price], and the total number of offers.
+        """
+        if sort not in self.sort_orders:
+            raise ValueError("Unknown sort order %s" % sort)
+        exclude = set(exclude)
+
+        # The offers of a seller are only indexed by id, they are few enough to sort after reading them.
+        if seller is not None:
+            offer_ids = [offer_id.decode("utf-8") for offer_id in self.redis_cache.zrange(self.seller_key(seller), 0, -1)]
+            offer_ids = [offer_id for offer_id in offer_ids if offer_id not in exclude]
+            offers = [offer for offer in self.get_offers(offer_ids) if offer is not None]
+            field = {"id": 1, "price": 3, "item_id": 2}[sort]
+            offers.sort(key=lambda offer: offer_index(offer[1]) if sort == "id" else offer[field], reverse=descending)
+            return offers[offset:offset + limit if limit is not None else None], len(offers)
+
+        # Read past the excluded offers, there are only as many as the purchases and cancellations in flight.
+        key = self.sort_key(sort)
+        end = offset + limit + len(exclude) - 1 if limit is not None else -1
+        offer_ids = self.redis_cache.zrevrange(key, 0, end) if descending else self.redis_cache.zrange(key, 0, end)
+        offer_ids = [offer_id.decode("utf-8") for offer_id in offer_ids]
+        offer_ids = [offer_id for offer_id in offer_ids if offer_id not in exclude]
+        offer_ids = offer_ids[offset:offset + limit if limit is not None else None]
+
+        pipe = self.redis_cache.pipeline()
+        pipe.zcard(key)
+        for offer_id in exclude:
+            pipe.zscore(key, offer_id)
+        total, *excluded = pipe.execute()
+        total -= len([score for score in excluded if score is not None])
+        # The ids whose offer is missing, removed since they were read, are skipped.
+        return [offer for offer in self.get_offers(offer_ids) if offer is not None], total
+
+    def get_offers(self, offer_ids):
+        """
+        :param offer_ids:list The offer ids, in the form 'offer3'.
+        :return:
+            list: Each offer as [address, offer_id, item_id, price], or None if it is not in the book.
+        """
+        pipe = self.redis_cache.pipeline()
+        for offer_id in offer_ids:
+            pipe.hgetall(self.offer_key(offer_id))
+
+        offers = []
+        for offer in pipe.execute():
+            if not offer:
+                offers.append(None)
+                continue
+            offers.append([offer[b"address"].decode("utf-8"), offer[b"offer_id"].decode("utf-8"),
+                           int(offer[b"item_id"]), int(offer[b"price"])])
+        return offers
+
+    def updated_at(self):
+        """
+        :return:
+            float: The time the book was last changed, or None if it was never built.
+        """
+        updated_at = self.redis_cache.get(self.prefix + "updated_at")
+        return float(updated_at) if updated_at else None
+
+    def _reconcile_loop(self):
+        """ Reconcile the book periodically. """
+        while True:
+            try:
+                self.reconcile()
+            except Exception as e:
+                logger.exception(e)
+            time.sleep(self.reconcile_interval)
+
+
+class OfferReservations:
+    """
+    The offers being bought or cancelled, kept in redis so every API process hides them from the market
+    until the operation reserving them is confirmed. Each offer is reserved by the transaction key of
+    the latest operation queued for it, and released when that operation is confirmed or dead lettered,
+    or when its reservation expires.
+    """
+
+    # The seconds a reservation lasts if its operation is never confirmed nor dead lettered.
+    reservation_ttl = 1800
+
+    # Releases the reservations of transaction keys, only those still held by the key.
+    # KEYS: the expiry sorted set, the holder of each offer, the offer of each transaction key. ARGV: the transaction keys.
+    release_script = """
+        local released = 0
+        for _, transaction_key in ipairs(ARGV) do
+            local offer_id = redis.call('HGET', KEYS[3], transaction_key)
+            if offer_id then
+                redis.call('HDEL', KEYS[3], transaction_key)
+                if redis.call('HGET', KEYS[2], offer_id) == transaction_key then
+                    redis.call('HDEL', KEYS[2], offer_id)
+                    redis.call('ZREM', KEYS[1], offer_id)
+                    released = released + 1
+                end
+            end
+        end
+        return released
+    """
+
+    # Removes the reservations which expired before ARGV[1], with the same KEYS.
+    expire_script = """
+        local expired = redis.call('ZRANGEBYSCORE', KEYS[1], '-inf', ARGV[1])
+        for _, offer_id in ipairs(expired) do
+            local transaction_key = redis.call('HGET', KEYS[2], offer_id)
+            if transaction_key then
+                redis.call('HDEL', KEYS[3], transaction_key)
+            end
+            redis.call('HDEL', KEYS[2], offer_id)
+            redis.call('ZREM', KEYS[1], offer_id)
+        end
+        return #expired
+    """
+
+    def __init__(self, redis_cache, marketplace):
+        """
+        :param redis_cache:StrictRedis The redis connection the reservations are kept in.
+        :param marketplace:str The name of the marketplace of the offers.
+        """
+        self.redis_cache = redis_cache
+        self.expiry_key = "offer_reservations:%s" % marketplace
+        self.holders_key = self.expiry_key + ":holders"
+        self.offers_key = self.expiry_key + ":offers"
+        self.keys = [self.expiry_key, self.holders_key, self.offers_key]
+        self._release = redis_cache.register_script(self.release_script)
+        self._expire = redis_cache.register_script(self.expire_script)
+
+    def reserve(self, offer_id, transaction_key):
+        """
+        Reserve an offer for an operation, replacing any earlier reservation of the offer.
+
+        :param offer_id:str The offer id, in the form 'offer3'.
+        :param transaction_key:str The transaction key of the operation buying or cancelling the offer.
+        """
+        pipe = self.redis_cache.pipeline()
+        pipe.zadd(self.expiry_key, time.time() + self.reservation_ttl, offer_id)
+        pipe.hset(self.holders_key, offer_id, transaction_key)
+        pipe.hset(self.offers_key, transaction_key, offer_id)
+        pipe.execute()
+
+    def release(self, transaction_keys):
+        """
+        Release the offers reserved by operations which are finished.
+
+        :param transaction_keys:list The transaction keys of the operations.
+        :return:
+            int: The number of offers released.
+        """
+        if not transaction_keys:
+            return 0
+        return self._release(keys=self.keys, args=transaction_keys)
+
+    def reserved(self):
+        """
+        :return:
+            list: The ids of the reserved offers, the expired reservations are removed.
+        """
+        now = time.time()
+        self._expire(keys=self.keys, args=[now])
+        return [offer_id.decode("utf-8") for offer_id in self.redis_cache.zrangebyscore(self.expiry_key, now, "+inf")]
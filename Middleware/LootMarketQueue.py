@@ -0,0 +1,443 @@
+"""
+=====================================================================================
+
+Durable journal of the smart contract invoke queue.
+
+Every operation accepted by the API is journaled in redis before it is queued, and stays there
+until its transaction is confirmed, so the operations accepted but not yet confirmed when the
+API process stops are replayed when it starts again.
+
+Operations which fail permanently, or too many times, are moved to a dead letter store.
+
+The invoke queue itself serves operations by priority class, taking turns between addresses.
+
+=====================================================================================
+"""
+
+import json
+import time
+from collections import OrderedDict, deque
+from queue import Queue
+
+
+class InvokeJournal:
+    """
+    Records the state of each queued operation by transaction key:
+    acked when it is queued, submitted with the hash of the transaction it was relayed in,
+    and removed once that transaction is confirmed.
+    """
+
+    # The redis hash of the acked operations: transaction key -> {operation_name, args, acked_at}.
+    acked_key = "invoke_journal:acked"
+
+    # The redis hash of the submitted operations: transaction key -> {tx_hash, submitted_at}.
+    submitted_key = "invoke_journal:submitted"
+
+    # The operations of each submitted transaction in the order they notify their results,
+    # a list of [operation_name, address, transaction_keys] kept for operations_ttl seconds.
+    operations_key = "invoke_journal:operations:%s"
+    operations_ttl = 86400
+
+    def __init__(self, redis_cache):
+        """
+        :param redis_cache:StrictRedis The redis connection the journal is kept in.
+        """
+        self.redis_cache = redis_cache
+
+    def acked(self, operation_name, transaction_key, args, priority=None):
+        """
+        Journal an operation accepted by the API, a single redis write.
+
+        :param operation_name:str The name of the operation to invoke.
+        :param transaction_key:str The transaction key of the operation.
+        :param args:list The arguments to pass to the smart contract operation.
+        :param priority:str The priority class given to the operation, if any.
+        """
+        entry = {"operation_name": operation_name, "args": args, "priority": priority, "acked_at": time.time()}
+        self.redis_cache.hset(self.acked_key, transaction_key, json.dumps(entry))
+
+    def acked_many(self, operation_name, tasks, priority=None):
+        """
+        Journal many operations accepted by the API at once, a single redis write.
+
+        :param operation_name:str The name of the operation to invoke.
+        :param tasks:list The (transaction_key, args) of each operation.
+        :param priority:str The priority class given to the operations, if any.
+        """
+        acked_at = time.time()
+        entries = dict((transaction_key, json.dumps({"operation_name": operation_name, "args": args,
+                                                      "priority": priority, "acked_at": acked_at}))
+                       for transaction_key, args in tasks)
+        if entries:
+            self.redis_cache.hmset(self.acked_key, entries)
+
+    def submitted(self, transaction_keys, tx_hash, operations=None):
+        """
+        Journal the transaction the operations were relayed in.
+
+        :param transaction_keys:list The transaction keys of the operations.
+        :param tx_hash:str The hash of the relayed transaction.
+        :param operations:list The (operation_name, address, transaction_keys) of each operation of the transaction,
+        so their results can be matched to their transaction keys after a restart.
+        """
+        entry = json.dumps({"tx_hash": tx_hash, "submitted_at": time.time()})
+        pipe = self.redis_cache.pipeline()
+        pipe.hmset(self.submitted_key, dict((key, entry) for key in transaction_keys))
+        if operations is not None:
+            pipe.set(self.operations_key % tx_hash, json.dumps(operations), ex=self.operations_ttl)
+        pipe.execute()
+
+    def operations(self, tx_hash):
+        """
+        :param tx_hash:str The hash of a submitted transaction.
+        :return:
+            list: The (operation_name, address, transaction_keys) of each operation of the transaction,
+            or None if they were not journaled.
+        """
+        operations = self.redis_cache.get(self.operations_key % tx_hash)
+        if not operations:
+            return None
+        return [tuple(operation) for operation in json.loads(operations.decode("utf-8"))]
+
+    def requeued(self, transaction_keys):
+        """
+        Journal the operations of a transaction that timed out as acked again.
+
+        :param transaction_keys:list The transaction keys of the operations.
+        """
+        self.redis_cache.hdel(self.submitted_key, *transaction_keys)
+
+    def confirmed(self, transaction_keys):
+        """
+        Remove the operations of a confirmed transaction from the journal.
+
+        :param transaction_keys:list The transaction keys of the operations.
+        """
+        self._remove(transaction_keys)
+
+    def dead_lettered(self, transaction_keys):
+        """
+        Remove the operations moved to the dead letter store from the journal.
+
+        :param transaction_keys:list The transaction keys of the operations.
+        """
+        self._remove(transaction_keys)
+
+    def _remove(self, transaction_keys):
+        """ Remove operations from the journal. """
+        pipe = self.redis_cache.pipeline()
+        pipe.hdel(self.acked_key, *transaction_keys)
+        pipe.hdel(self.submitted_key, *transaction_keys)
+        pipe.execute()
+
+    def unfinished(self):
+        """
+        The journaled operations which have not been confirmed, in the order they were acked.
+
+        :return:
+            list: A tuple (operation_name, transaction_key, args, priority, tx_hash, submitted_at) for each operation,
+            tx_hash and submitted_at are None if the operation was not submitted.
+        """
+        acked = self.redis_cache.hgetall(self.acked_key)
+        submitted = self.redis_cache.hgetall(self.submitted_key)
+
+        entries = []
+        for transaction_key, entry in acked.items():
+            entry = json.loads(entry.decode("utf-8"))
+            submission = submitted.get(transaction_key)
+            submission = json.loads(submission.decode("utf-8")) if submission else {}
+            entries.append((entry["acked_at"], entry["operation_name"], transaction_key.decode("utf-8"), entry["args"],
+                            entry.get("priority"), submission.get("tx_hash"), submission.get("submitted_at")))
+
+        entries.sort(key=lambda entry: entry[0])
+        return [entry[1:] for entry in entries]
+
+
+class PermanentInvokeError(Exception):
+    """ An invoke which fails the same way however often it is retried, such as a script which faults. """
+    pass
+
+
+class InfrastructureError(Exception):
+    """ An invoke which failed because of the wallet or the node rather than the task, such as a wallet without GAS. """
+    pass
+
+
+def classify_failure(error):
+    """
+    Classify why an invoke failed.
+
+    :param error:Exception The exception the invoke raised.
+    :return:
+        str: "permanent" if retrying the invoke cannot succeed, "infrastructure" if the wallet or node failed,
+        else "transient".
+    """
+    if isinstance(error, (PermanentInvokeError, TypeError, ValueError)):
+        return "permanent"
+    if isinstance(error, InfrastructureError):
+        return "infrastructure"
+    return "transient"
+
+
+class DeadLetterStore:
+    """
+    Keeps the operations which failed permanently or ran out of attempts, by transaction key,
+    so they can be inspected through the API instead of being retried forever.
+    """
+
+    # The redis hash of the dead letters: transaction key -> {operation_name, args, attempts, reason, error, failed_at}.
+    dead_letters_key = "invoke_dead_letters"
+
+    def __init__(self, redis_cache):
+        """
+        :param redis_cache:StrictRedis The redis connection the dead letters are kept in.
+        """
+        self.redis_cache = redis_cache
+
+    def add(self, task, attempts, reason, error):
+        """
+        Store a failed task under each of its transaction keys.
+
+        :param task:tuple The queue item (operation_name, transaction_key, args).
+        :param attempts:int The number of times the task was attempted.
+        :param reason:str Whether the failure was "permanent" or "transient".
+        :param error:Exception The exception of the last attempt.
+        """
+        operation_name, transaction_key, args = task
+        transaction_keys = transaction_key if isinstance(transaction_key, list) else [transaction_key]
+        entry = json.dumps({
+            "operation_name": operation_name,
+            "transaction_keys": transaction_keys,
+            "args": args,
+            "attempts": attempts,
+            "reason": reason,
+            "error": str(error),
+            "failed_at": time.time()
+        })
+        self.redis_cache.hmset(self.dead_letters_key, dict((key, entry) for key in transaction_keys))
+
+    def get(self, transaction_key):
+        """
+        :param transaction_key:str The transaction key of the operation.
+        :return:
+            dict: The dead letter of the operation, or None if it has not failed.
+        """
+        entry = self.redis_cache.hget(self.dead_letters_key, transaction_key)
+        return json.loads(entry.decode("utf-8")) if entry else None
+
+    def all(self):
+        """
+        :return:
+            dict: Every dead letter, by transaction key.
+        """
+        return dict((key.decode("utf-8"), json.loads(entry.decode("utf-8")))
+                    for key, entry in self.redis_cache.hgetall(self.dead_letters_key).items())
+
+
+class InvokeScheduler(Queue):
+    """
+    The invoke queue, scheduling tasks by priority class and fairly across addresses within a class.
+    A class is only served when every class above it is empty, and within a class the addresses
+    with queued tasks take turns, so one address queuing many tasks cannot hold up the others.
+    Queue items are the same (operation_name, transaction_key, args) tuples as a FIFO Queue.
+    """
+
+    # The priority classes, highest first.
+    priority_classes = ("purchase", "market", "bulk")
+
+    # The default priority class of each operation.
+    operation_priorities = {
+        "buy_offer": "purchase",
+        "cancel_offer": "purchase",
+        "put_offer": "market",
+        "transfer_item": "market",
+        "remove_item": "market",
+        "give_items": "bulk"
+    }
+
+    # The weight of the latest wait in the moving average wait time of a class.
+    wait_smoothing = 0.1
+
+    def _init(self, maxsize):
+        # For each class, the queued (enqueued_at, task) of each address, in the order the addresses take turns.
+        self.classes = dict((priority, OrderedDict()) for priority in self.priority_classes)
+        self.depths = dict((priority, 0) for priority in self.priority_classes)
+        self.average_waits = dict((priority, 0.0) for priority in self.priority_classes)
+
+        # The priority class given to add_invoke for a transaction key, kept while it is retried.
+        self.priorities = {}
+
+    def put(self, item, block=True, timeout=None, priority=None):
+        """
+        Put a task in the queue, the queue is unbounded so it never blocks.
+
+        :param item:tuple The task (operation_name, transaction_key, args).
+        :param priority:str The priority class of the task, by default the class of its operation.
+        """
+        with self.not_full:
+            self._put(item, priority)
+            self.unfinished_tasks += 1
+            self.not_empty.notify()
+
+    def put_front(self, items):
+        """
+        Put tasks back at the front of their address in the queue, keeping their order.
+
+        :param items:list The tasks to return to the queue.
+        """
+        with self.not_full:
+            for item in reversed(items):
+                addresses = self.classes[self._priority(item)]
+                address = self._address(item)
+                addresses.setdefault(address, deque()).appendleft((time.time(), item))
+                addresses.move_to_end(address, last=False)
+                self.depths[self._priority(item)] += 1
+            self.unfinished_tasks += len(items)
+            self.not_empty.notify()
+
+    def peek(self):
+        """
+        :return:
+            tuple: The task the next get() returns, or None if the queue is empty.
+        """
+        with self.mutex:
+            return self._head()
+
+    def take_if_head(self, expected):
+        """
+        Take the next task from the queue only if it is still the one peeked, atomically, as tasks put
+        meanwhile may change which task is served next. The taken task must be marked as done with task_done().
+
+        :param expected:tuple The task returned by peek().
+        :return:
+            bool: Whether the task was taken.
+        """
+        with self.mutex:
+            if self._head() is not expected:
+                return False
+            self._get()
+            self.not_full.notify()
+            return True
+
+    def take_matching(self, task, match):
+        """
+        Take the queued tasks of the address of a task which match, in the order they would be served.
+        Only the tasks of the priority class of the task are taken, so a task is never served ahead of its class.
+        The taken tasks must be marked as done with task_done().
+
+        :param task:tuple The task taken from the queue, whose address and priority class are searched.
+        :param match:function Called with each queued task of the address, returns whether to take it.
+        :return:
+            list: The tasks taken from the queue.
+        """
+        taken = []
+        with self.mutex:
+            priority = self._priority(task)
+            address = self._address(task)
+            tasks = self.classes[priority].get(address)
+            if not tasks:
+                return taken
+            remaining = deque()
+            for enqueued_at, item in tasks:
+                if match(item):
+                    taken.append(item)
+                    self.depths[priority] -= 1
+                else:
+                    remaining.append((enqueued_at, item))
+            if remaining:
+                self.classes[priority][address] = remaining
+            else:
+                del self.classes[priority][address]
+        return taken
+
+    def forget(self, transaction_keys):
+        """
+        Forget the priority given to tasks which are finished.
+
+        :param transaction_keys:list The transaction keys of the tasks.
+        """
+        with self.mutex:
+            for key in transaction_keys:
+                self.priorities.pop(key, None)
+
+    def stats(self):
+        """
+        The depth and wait times of each priority class.
+
+        :return:
+            dict: For each class, the number of queued tasks, the seconds the oldest task has waited,
+            and the moving average of the seconds tasks waited before being served.
+        """
+        now = time.time()
+        with self.mutex:
+            return dict((priority, {
+                "depth": self.depths[priority],
+                "addresses": len(self.classes[priority]),
+                "oldest_wait": max([now - tasks[0][0] for tasks in self.classes[priority].values()] or [0]),
+                "average_wait": self.average_waits[priority]
+            }) for priority in self.priority_classes)
+
+    def _qsize(self):
+        return sum(self.depths.values())
+
+    def prioritize(self, transaction_keys, priority):
+        """
+        Give tasks a priority class other than the default of their operation, kept until they are forgotten.
+
+        :param transaction_keys:list The transaction keys of the tasks.
+        :param priority:str The priority class.
+        """
+        if priority not in self.priority_classes:
+            raise ValueError("Unknown priority class %s" % priority)
+        for key in transaction_keys:
+            self.priorities[key] = priority
+
+    def _put(self, item, priority=None):
+        operation_name, transaction_key, args = item
+        if priority is not None:
+            self.prioritize(transaction_key if isinstance(transaction_key, list) else [transaction_key], priority)
+
+        priority = self._priority(item)
+        self.classes[priority].setdefault(self._address(item), deque()).append((time.time(), item))
+        self.depths[priority] += 1
+
+    def _head(self):
+        """ The task _get() returns next, must be called holding the mutex. """
+        for priority in self.priority_classes:
+            for tasks in self.classes[priority].values():
+                return tasks[0][1]
+        return None
+
+    def _get(self):
+        for priority in self.priority_classes:
+            addresses = self.classes[priority]
+            if not addresses:
+                continue
+
+            # Serve the address whose turn it is, and move it to the back of the turns.
+            address, tasks = next(iter(addresses.items()))
+            enqueued_at, item = tasks.popleft()
+            if tasks:
+                addresses.move_to_end(address)
+            else:
+                del addresses[address]
+            self.depths[priority] -= 1
+
+            wait = time.time() - enqueued_at
+            self.average_waits[priority] += self.wait_smoothing * (wait - self.average_waits[priority])
+            return item
+
+    def _priority(self, item):
+        """ The priority class of a task, the one given to add_invoke or else the default of its operation. """
+        operation_name, transaction_key, args = item
+        keys = transaction_key if isinstance(transaction_key, list) else [transaction_key]
+        for key in keys:
+            if key in self.priorities:
+                return self.priorities[key]
+        return self.operation_priorities.get(operation_name, "market")
+
+    @staticmethod
+    def _address(item):
+        """ The address of a task, which follows the marketplace in the args of marketplace operations. """
+        operation_name, transaction_key, args = item
+        return args[1] if len(args) > 1 else None
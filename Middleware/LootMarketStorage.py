@@ -0,0 +1,138 @@
+"""
+=====================================================================================
+
+Direct reader of the LootMarkets smart contract storage.
+
+The read endpoints used to test invoke the contract and catch its Notify events to read a single
+storage key. The reader builds the storage keys the contract uses and reads them straight from the
+blockchain database, decoding them with the codec of the contract storage format.
+
+=====================================================================================
+"""
+
+from neocore import UInt160
+from neocore.Cryptography.Crypto import Crypto
+from neo.Core.Blockchain import Blockchain
+from neo.Core.Helper import Helper
+from neo.Core.State.StorageKey import StorageKey
+from LootMarketCodec import deserialize_bytearray, decode_int, decode_ints, encode_int
+
+# Storage keys of the smart contract, see the LootMarkets smart contract.
+inventory_key = b'Inventory'
+marketplace_key = b'marketplace'
+offers_key = b'Offers'
+
+
+class ContractStorage:
+    """ Reads the marketplace state of the smart contract from the blockchain storage. """
+
+    def __init__(self, contract_hash, marketplace):
+        """
+        :param contract_hash:str The script hash of the smart contract.
+        :param marketplace:str The name of the marketplace to read.
+        """
+        self.script_hash = UInt160.UInt160.ParseString(contract_hash)
+        self.marketplace = marketplace.encode("utf-8")
+
+    def get(self, key):
+        """
+        Read a storage key of the smart contract.
+
+        :param key:bytes The storage key.
+        :return:
+            bytes: The stored value, or None if the key is not in storage.
+        """
+        item = Blockchain.Default().GetStorageItem(StorageKey(script_hash=self.script_hash, key=bytes(key)))
+        if item is None:
+            return None
+        return bytes(item.Value)
+
+    def get_inventory(self, address):
+        """
+        :param address:str The address to read the inventory of.
+        :return:
+            list: The item ids the address owns on the marketplace.
+        """
+        storage_key = inventory_key + self.marketplace + bytes(Helper.AddrStrToScriptHash(address).Data)
+        return decode_ints(self.get(storage_key))
+
+    def get_all_offers(self):
+        """
+        :return:
+            list: The ids of the offers on the marketplace, in the form 'offer3'.
+        """
+        offers = deserialize_bytearray(self.get(offers_key + self.marketplace))
+        return [self._offer_id(offer) for offer in offers]
+
+    def get_offer(self, offer_id):
+        """
+        :param offer_id:str The id of the offer, in the form 'offer3'.
+        :return:
+            list: The address of the owner, the offer id, the item id and the price of the offer,
+            or None if there is no such offer.
+        """
+        index = int(offer_id.split('offer', 1)[1])
+        offer = deserialize_bytearray(self.get(self.marketplace + b'offer' + encode_int(index)))
+        if not offer:
+            return None
+
+        address = Crypto.ToAddress(UInt160.UInt160(data=bytearray(offer[0])))
+        item_id = decode_int(offer[2])
+        price = decode_int(offer[3])
+        return [address, self._offer_id(offer[1]), item_id, price]
+
+    def marketplace_owner(self, marketplace):
+        """
+        :param marketplace:str The name of the marketplace.
+        :return:
+            str: The address of the owner of the marketplace, or None if it is not registered.
+        """
+        owner = self.get(marketplace_key + marketplace.encode("utf-8"))
+        if not owner:
+            return None
+        return Crypto.ToAddress(UInt160.UInt160(data=bytearray(owner)))
+
+    def can_buy_offer(self, address, offer_id):
+        """
+        Check the storage conditions buy_offer of the smart contract requires, without running the VM.
+
+        :param address:str The address buying the offer.
+        :param offer_id:str The id of the offer, in the form 'offer3'.
+        :return:
+            bool: Whether the offer exists and the address can pay its price.
+        """
+        offer = self.get_offer(offer_id)
+        if offer is None:
+            return False
+
+        owner, _offer_id, item_id, price = offer
+        if price <= 0:
+            return False
+        # The contract does not move LOOT when the owner buys back its own offer.
+        return owner == address or self.balance_of(address) >= price
+
+    def can_cancel_offer(self, address, offer_id):
+        """
+        Check the storage conditions cancel_offer of the smart contract requires, without running the VM.
+
+        :param address:str The address cancelling the offer.
+        :param offer_id:str The id of the offer, in the form 'offer3'.
+        :return:
+            bool: Whether the offer exists and is owned by the address.
+        """
+        offer = self.get_offer(offer_id)
+        return offer is not None and offer[0] == address
+
+    def balance_of(self, address):
+        """
+        :param address:str The address to read the LOOT balance of.
+        :return:
+            int: The LOOT balance of the address.
+        """
+        balance = self.get(Helper.AddrStrToScriptHash(address).Data)
+        return decode_int(balance) if balance else 0
+
+    def _offer_id(self, storage_offer_id):
+        """ Convert a stored offer id, the marketplace name followed by e.g. 'offer\\x03', to 'offer3'. """
+        index = bytes(storage_offer_id)[len(self.marketplace) + len(b'offer'):]
+        return 'offer' + str(decode_int(index))
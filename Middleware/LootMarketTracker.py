@@ -0,0 +1,136 @@
+"""
+=====================================================================================
+
+Confirmation tracker of the relayed smart contract invoke transactions.
+
+Instead of looking up every pending transaction on the blockchain on each poll, the tracker checks
+the transactions of each persisted block against the hashes of the pending transactions once, and
+records the status and block height of each transaction key in redis, so searching for a transaction
+is a single cache read.
+
+=====================================================================================
+"""
+
+import json
+import threading
+from logzero import logger
+from neo.Core.Blockchain import Blockchain
+
+
+class ConfirmationTracker:
+    """ Tracks the relayed transactions until a persisted block includes them. """
+
+    # The status of a transaction key, in the redis key confirmation:<transaction_key>.
+    SUBMITTED = "submitted"
+    CONFIRMED = "confirmed"
+    TIMED_OUT = "timed_out"
+
+    def __init__(self, redis_cache, write_batch):
+        """
+        :param redis_cache:StrictRedis The redis connection the statuses are kept in.
+        :param write_batch:RedisWriteBatch The buffered writes the confirmations are written with.
+        """
+        self.redis_cache = redis_cache
+        self.write_batch = write_batch
+
+        # The transaction keys of each pending transaction, by transaction hash.
+        self.pending = {}
+
+        # The block height of each confirmed transaction the invoke queue has not taken yet, by transaction hash.
+        self.confirmed = {}
+
+        self._lock = threading.Lock()
+
+        Blockchain.PersistCompleted.on_change += self.on_block_persisted
+
+    @staticmethod
+    def status_key(transaction_key):
+        return "confirmation:%s" % transaction_key
+
+    def track(self, tx_hash, transaction_keys):
+        """
+        Track a relayed transaction.
+
+        :param tx_hash:str The hash of the transaction.
+        :param transaction_keys:list The transaction keys of the operations of the transaction.
+        """
+        with self._lock:
+            self.pending[tx_hash] = list(transaction_keys)
+        self._set_status(self.redis_cache.pipeline(), transaction_keys, tx_hash, self.SUBMITTED).execute()
+
+    def untrack(self, tx_hash):
+        """
+        Stop tracking a transaction which timed out, its operations are queued again.
+
+        :param tx_hash:str The hash of the transaction.
+        """
+        with self._lock:
+            transaction_keys = self.pending.pop(tx_hash, None)
+        if transaction_keys:
+            self._set_status(self.redis_cache.pipeline(), transaction_keys, tx_hash, self.TIMED_OUT).execute()
+
+    def check(self, tx_hash):
+        """
+        Look up a tracked transaction on the blockchain once, for the transactions which may have been
+        persisted before they were tracked, such as those relayed before the API restarted.
+
+        :param tx_hash:str The hash of the transaction.
+        :return:
+            bool: Whether the transaction is confirmed.
+        """
+        _tx, height = Blockchain.Default().GetTransaction(tx_hash)
+        if height > -1:
+            with self.write_batch.batch(flush=True) as pipe:
+                self._confirm(pipe, tx_hash, height)
+        with self._lock:
+            return tx_hash in self.confirmed
+
+    def take_confirmed(self):
+        """
+        Take the transactions confirmed since the last call.
+
+        :return:
+            dict: The block height of each confirmed transaction, by transaction hash.
+        """
+        with self._lock:
+            confirmed, self.confirmed = self.confirmed, {}
+        return confirmed
+
+    def on_block_persisted(self, block):
+        """ Block persist callback, confirms the pending transactions of the block. """
+        with self._lock:
+            if not self.pending:
+                return
+
+        # Blocks may be trimmed to the hashes of their transactions.
+        tx_hashes = [tx if isinstance(tx, str) else tx.Hash.ToString() for tx in block.Transactions]
+        with self.write_batch.batch(flush=True) as pipe:
+            for tx_hash in tx_hashes:
+                self._confirm(pipe, tx_hash, block.Index)
+
+    def status(self, transaction_key):
+        """
+        :param transaction_key:str The transaction key of an operation.
+        :return:
+            dict: The tx_hash, status and block height of the transaction of the operation,
+            or None if it was never relayed.
+        """
+        status = self.redis_cache.get(self.status_key(transaction_key))
+        return json.loads(status.decode("utf-8")) if status else None
+
+    def _confirm(self, pipe, tx_hash, height):
+        """ Record a pending transaction as confirmed at a height. """
+        with self._lock:
+            transaction_keys = self.pending.pop(tx_hash, None)
+            if transaction_keys is None:
+                return
+            self.confirmed[tx_hash] = height
+        self._set_status(pipe, transaction_keys, tx_hash, self.CONFIRMED, height)
+        logger.info("Transaction %s confirmed at height %s", tx_hash, height)
+
+    def _set_status(self, pipe, transaction_keys, tx_hash, status, height=None):
+        """ Add the writes of the status of transaction keys to a pipeline. """
+        entry = json.dumps({"tx_hash": tx_hash, "status": status, "height": height})
+        for transaction_key in transaction_keys:
+            pipe.set(self.status_key(transaction_key), entry)
+        return pipe
@@ -0,0 +1,216 @@
+"""
+=====================================================================================
+
+UTXO management for the smart contract invoke queue.
+
+Each relayed invoke spends GAS inputs that stay unconfirmed until the transaction is in a block,
+so a wallet with a single large output can only have one transaction in flight. The GAS of every
+wallet of the pool is kept split into many small outputs, and each transaction in flight reserves
+the outputs it spends so no other transaction claims them.
+
+=====================================================================================
+"""
+
+import time
+import threading
+from logzero import logger
+from neocore.Fixed8 import Fixed8
+from neo.Core.Blockchain import Blockchain
+from neo.Core.TX.Transaction import ContractTransaction, TransactionOutput
+from neo.Network.NodeLeader import NodeLeader
+from neo.SmartContract.ContractParameterContext import ContractParametersContext
+
+
+class UTXOManager:
+    """
+    Keeps the GAS of each wallet of the pool split into small outputs, and reserves specific
+    outputs for each transaction in progress until it is confirmed or fails.
+    """
+
+    # The seconds between checks of the free outputs of the wallets.
+    split_check_interval = 30
+
+    # The seconds a split transaction may wait to be confirmed before its inputs are released.
+    split_timeout = 300
+
+    def __init__(self, wallet_pool, split_count=20, split_amount=0.01):
+        """
+        :param wallet_pool:WalletPool The wallets to manage the outputs of.
+        :param split_count:int The number of free outputs each wallet is kept split into.
+        :param split_amount:float The GAS value of each split output.
+        """
+        self.wallet_pool = wallet_pool
+        self.split_count = split_count
+        self.split_amount = Fixed8.FromDecimal(split_amount)
+
+        # The inputs reserved by each transaction in progress, by transaction hash.
+        self.reservations = {}
+
+        # The split transactions waiting for confirmation, by transaction hash: (wallet session, relayed time).
+        self.split_txs = {}
+
+        self._lock = threading.Lock()
+        self._thread = None
+
+    def start(self):
+        """ Start re-splitting the outputs of the wallets in the background. """
+        if self._thread is not None:
+            return
+        self._thread = threading.Thread(target=self._split_loop, daemon=True)
+        self._thread.start()
+
+    def reserved_inputs(self):
+        """
+        :return:
+            list: The inputs reserved by every transaction in progress.
+        """
+        with self._lock:
+            return [tx_input for inputs in self.reservations.values() for tx_input in inputs]
+
+    def free_coins(self, wallet):
+        """
+        The confirmed GAS outputs of a wallet which no transaction in progress has reserved.
+
+        :param wallet:UserWallet The wallet, held by the caller.
+        :return:
+            list: The free coins, smallest first.
+        """
+        reserved = set(self.reserved_inputs())
+        coins = wallet.FindUnspentCoinsByAsset(Blockchain.SystemCoin().Hash, use_standard=True)
+        free_coins = [coin for coin in coins if coin.Reference not in reserved]
+        return sorted(free_coins, key=lambda coin: coin.Output.Value.value)
+
+    def select_inputs(self, wallet, amount):
+        """
+        Choose the free outputs to pay an amount of GAS with, preferring the smallest single
+        output that covers it so the large outputs are left for splitting.
+
+        :param wallet:UserWallet The wallet, held by the caller.
+        :param amount:Fixed8 The GAS to pay.
+        :return:
+            list: The CoinReferences to spend, or None if the free outputs cannot cover the amount.
+        """
+        coins = self.free_coins(wallet)
+        for coin in coins:
+            if coin.Output.Value >= amount:
+                return [coin.Reference]
+
+        # No single output covers the amount, combine the largest outputs.
+        selected = []
+        total = Fixed8.Zero()
+        for coin in reversed(coins):
+            selected.append(coin.Reference)
+            total = total + coin.Output.Value
+            if total >= amount:
+                return selected
+        return None
+
+    def reserve(self, tx_hash, inputs):
+        """
+        Reserve the inputs spent by a relayed transaction.
+
+        :param tx_hash:str The hash of the transaction.
+        :param inputs:list The CoinReferences the transaction spends.
+        """
+        with self._lock:
+            self.reservations[tx_hash] = list(inputs)
+
+    def release(self, tx_hash):
+        """
+        Release the inputs of a transaction once it is confirmed or has failed.
+
+        :param tx_hash:str The hash of the transaction.
+        """
+        with self._lock:
+            self.reservations.pop(tx_hash, None)
+
+    def is_splitting(self, session):
+        """
+        Check if a split transaction of a wallet is waiting to be confirmed.
+
+        :param session:WalletSession The wallet session.
+        """
+        with self._lock:
+            return any(split_session is session for split_session, relayed_at in self.split_txs.values())
+
+    def split(self, session, wallet):
+        """
+        Split the GAS of a wallet into outputs of split_amount, up to split_count free outputs.
+
+        :param session:WalletSession The wallet session, held by the caller.
+        :param wallet:UserWallet The open wallet of the session.
+        :return:
+            ContractTransaction: The relayed split transaction, or None if there was nothing to split.
+        """
+        free_coins = self.free_coins(wallet)
+        free_value = sum(coin.Output.Value.value for coin in free_coins)
+
+        # Keep one split amount back for the change, so the wallet is never drained into the split outputs.
+        split_count = min(self.split_count - len(free_coins), free_value // self.split_amount.value - 1)
+        if split_count < 2:
+            return None
+
+        change_address = wallet.GetChangeAddress()
+        outputs = [TransactionOutput(AssetId=Blockchain.SystemCoin().Hash, Value=self.split_amount, script_hash=change_address)
+                   for _ in range(split_count)]
+
+        tx = wallet.MakeTransaction(tx=ContractTransaction(outputs=outputs), use_standard=True,
+                                    exclude_vin=self.reserved_inputs())
+        if not tx:
+            return None
+
+        context = ContractParametersContext(tx)
+        wallet.Sign(context)
+        if not context.Completed:
+            logger.error("Could not sign the split transaction of wallet %s", session.wallet_path)
+            return None
+
+        tx.scripts = context.GetScripts()
+        if not NodeLeader.Instance().Relay(tx):
+            logger.error("Could not relay the split transaction %s", tx.Hash.ToString())
+            return None
+        wallet.SaveTransaction(tx)
+
+        tx_hash = tx.Hash.ToString()
+        self.reserve(tx_hash, tx.inputs)
+        with self._lock:
+            self.split_txs[tx_hash] = (session, time.time())
+        logger.info("Splitting the GAS of wallet %s into %s outputs, transaction %s", session.wallet_path, split_count, tx_hash)
+        return tx
+
+    def _check_split_txs(self):
+        """ Release the inputs of the split transactions which are confirmed or timed out. """
+        with self._lock:
+            split_txs = list(self.split_txs.items())
+
+        for tx_hash, (session, relayed_at) in split_txs:
+            _tx, height = Blockchain.Default().GetTransaction(tx_hash)
+            if height > -1 or time.time() - relayed_at > self.split_timeout:
+                if height == -1:
+                    logger.error("Split transaction %s was never confirmed.", tx_hash)
+                with self._lock:
+                    self.split_txs.pop(tx_hash, None)
+                self.release(tx_hash)
+
+    def _split_loop(self):
+        """ Re-split the wallets whose free outputs have drained below half of split_count. """
+        while True:
+            time.sleep(self.split_check_interval)
+            try:
+                self._check_split_txs()
+
+                for session in self.wallet_pool.sessions:
+                    if self.is_splitting(session) or not session.is_synced():
+                        continue
+
+                    # Skip the wallets busy invoking, they are checked again on the next pass.
+                    if not session.try_acquire():
+                        continue
+                    try:
+                        with session.use() as wallet:
+                            if len(self.free_coins(wallet)) < self.split_count // 2:
+                                self.split(session, wallet)
+                    finally:
+                        session.release()
+            except Exception as e:
+                logger.exception(e)
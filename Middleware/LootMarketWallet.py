@@ -0,0 +1,298 @@
+"""
+=====================================================================================
+
+Wallet helpers used by the smart contract invoke queue.
+
+The API keeps one wallet session open for the life of the process for each wallet of its pool,
+shared by the invoke queue, test invokes and gas claims. Every wallet of the pool must be authorized
+as an operator of the marketplace, so invokes can be spread over all of them. The readiness of the wallet is signalled by the blockchain persisting
+blocks and the wallet processing them, so invokes never sleep waiting for the wallet to sync.
+
+=====================================================================================
+"""
+
+import time
+import sqlite3
+import threading
+import peewee
+from contextlib import contextmanager
+from logzero import logger
+from twisted.internet import reactor, task
+from neocore.Fixed8 import Fixed8
+from neo.Core.Blockchain import Blockchain
+from neo.Implementations.Wallets.peewee.UserWallet import UserWallet
+
+
+class WalletReadiness:
+    """
+    A condition which fires as soon as a wallet has processed every block persisted on the blockchain.
+    Block persist and wallet ProcessBlocks callbacks notify the waiting threads.
+    """
+
+    def __init__(self):
+        self._condition = threading.Condition()
+
+        # Wake up the waiting threads whenever a block is persisted.
+        Blockchain.PersistCompleted.on_change += self.on_block_persisted
+
+    @staticmethod
+    def is_synced(wallet):
+        """
+        Check if a wallet has caught up with the blockchain.
+
+        :param wallet:UserWallet The wallet to check.
+        :return:
+            bool: Whether the wallet height has reached the blockchain height.
+        """
+        return wallet is not None and wallet._current_height >= Blockchain.Default().Height
+
+    def on_block_persisted(self, block):
+        """ Block persist callback, the blockchain height changed. """
+        self.notify()
+
+    def on_blocks_processed(self):
+        """ Wallet ProcessBlocks callback, the wallet height changed. """
+        self.notify()
+
+    def notify(self):
+        """ Wake up the threads waiting for a wallet to be synced. """
+        with self._condition:
+            self._condition.notify_all()
+
+    def wait(self, wallet, timeout=None):
+        """
+        Block until the wallet is synced with the blockchain.
+
+        :param wallet:UserWallet The wallet to wait for.
+        :param timeout:float The maximum seconds to wait, None to wait forever.
+        :return:
+            bool: Whether the wallet is synced, False if the timeout passed first.
+        """
+        with self._condition:
+            return self._condition.wait_for(lambda: self.is_synced(wallet), timeout)
+
+
+class WalletSession:
+    """
+    Keeps one wallet open for the life of the process and serializes access to it.
+    The wallet is only reloaded when it is detected to be corrupted, either by a database error
+    while it is being used, or by it no longer processing blocks while behind the blockchain.
+    """
+
+    # The seconds the wallet height may stay behind the blockchain without moving before it is considered corrupted.
+    stall_timeout = 120
+
+    def __init__(self, wallet_path, wallet_pass):
+        self.wallet_path = wallet_path
+        self.wallet_pass = wallet_pass
+
+        self.wallet = None
+        self.ready = WalletReadiness()
+
+        # The GAS balance of the wallet, updated as it processes blocks and is used.
+        self.gas = 0
+
+        # Whether the wallet must be reloaded, and why.
+        self.corrupted = False
+        self.last_error = None
+        self.reloads = 0
+
+        self._lock = threading.RLock()
+        self._walletdb_loop = None
+        self._stalled_since = None
+
+    def open(self):
+        """ Open the wallet and start processing blocks, if it is not open already. """
+        with self._lock:
+            if self.wallet is not None:
+                return
+            logger.info("Opening wallet %s", self.wallet_path)
+            self.wallet = UserWallet.Open(self.wallet_path, self.wallet_pass)
+            self.corrupted = False
+            self._stalled_since = None
+
+            # The loop is started on the reactor thread, where the blocks are persisted.
+            self._walletdb_loop = task.LoopingCall(self._process_blocks)
+            reactor.callFromThread(self._walletdb_loop.start, 1)
+
+    def close(self):
+        """ Stop processing blocks and close the wallet. """
+        with self._lock:
+            if self.wallet is None:
+                return
+            reactor.callFromThread(self._walletdb_loop.stop)
+            self._walletdb_loop = None
+            try:
+                self.wallet.Close()
+            except Exception as e:
+                logger.exception(e)
+            self.wallet = None
+
+    def reload(self):
+        """ Close and reopen the wallet, used when it is corrupted. """
+        with self._lock:
+            logger.error("Reloading wallet %s: %s", self.wallet_path, self.last_error)
+            self.close()
+            self.open()
+            self.reloads += 1
+
+    @contextmanager
+    def use(self):
+        """
+        Hold the wallet for the duration of a with block, no other thread may use it meanwhile.
+
+        :return:
+            UserWallet: The open wallet.
+        """
+        with self._lock:
+            if self.corrupted:
+                self.reload()
+            elif self.wallet is None:
+                self.open()
+
+            try:
+                yield self.wallet
+            except (peewee.DatabaseError, sqlite3.DatabaseError) as e:
+                self._mark_corrupted("Database error: %s" % e)
+                raise
+            finally:
+                self._update_gas()
+
+    def try_acquire(self):
+        """
+        Hold the session without waiting, release it with release().
+
+        :return:
+            bool: Whether the session was free and is now held.
+        """
+        return self._lock.acquire(blocking=False)
+
+    def release(self):
+        """ Release a session held with try_acquire(). """
+        self._lock.release()
+
+    def is_synced(self):
+        """ Check if the wallet is open and has processed every persisted block. """
+        return self.ready.is_synced(self.wallet)
+
+    def wait_synced(self, timeout=None):
+        """
+        Block until the wallet has processed every persisted block.
+
+        :param timeout:float The maximum seconds to wait, None to wait forever.
+        :return:
+            bool: Whether the wallet is synced, False if the timeout passed first.
+        """
+        if self.wallet is None or self.corrupted:
+            with self.use():
+                pass
+        return self.ready.wait(self.wallet, timeout)
+
+    def health(self):
+        """
+        The health and sync state of the session.
+
+        :return:
+            dict: Whether the wallet is open, synced and healthy, with its height and the blockchain height.
+        """
+        wallet = self.wallet
+        return {
+            "wallet": self.wallet_path,
+            "open": wallet is not None,
+            "healthy": wallet is not None and not self.corrupted,
+            "synced": self.ready.is_synced(wallet),
+            "wallet_height": wallet._current_height if wallet is not None else None,
+            "blockchain_height": Blockchain.Default().Height,
+            "gas": self.gas,
+            "reloads": self.reloads,
+            "last_error": self.last_error
+        }
+
+    def _mark_corrupted(self, error):
+        """ Flag the wallet to be reloaded the next time it is used. """
+        logger.error("Wallet %s is corrupted: %s", self.wallet_path, error)
+        self.corrupted = True
+        self.last_error = error
+
+    def _update_gas(self):
+        """ Update the tracked GAS balance of the wallet. """
+        wallet = self.wallet
+        if wallet is None:
+            return
+        try:
+            self.gas = wallet.GetBalance(Blockchain.SystemCoin().Hash).value / Fixed8.D
+        except RuntimeError:
+            # The coins changed while being counted, the balance is updated on the next call.
+            pass
+
+    def _process_blocks(self):
+        """ Process the new blocks in the wallet, and signal the threads waiting for it to sync. """
+        wallet = self.wallet
+        if wallet is None or self.corrupted:
+            return
+
+        height = wallet._current_height
+        wallet.ProcessBlocks()
+
+        # ProcessBlocks logs and swallows its errors, so a wallet that stops moving while behind is corrupted.
+        if wallet._current_height == height and not self.ready.is_synced(wallet):
+            if self._stalled_since is None:
+                self._stalled_since = time.time()
+            elif time.time() - self._stalled_since > self.stall_timeout:
+                self._mark_corrupted("Wallet stopped processing blocks at height %s" % height)
+        else:
+            self._stalled_since = None
+
+        if wallet._current_height != height:
+            self._update_gas()
+        self.ready.on_blocks_processed()
+
+
+class WalletPool:
+    """
+    A pool of wallet sessions which invokes are dispatched over, each wallet signing with its own coins.
+    """
+
+    def __init__(self, wallet_paths, wallet_pass):
+        self.sessions = [WalletSession(wallet_path, wallet_pass) for wallet_path in wallet_paths]
+        self._next = 0
+
+    def __len__(self):
+        return len(self.sessions)
+
+    def open(self):
+        """ Open every wallet of the pool. """
+        for session in self.sessions:
+            session.open()
+
+    @contextmanager
+    def use(self):
+        """
+        Hold whichever wallet of the pool is free, for operations that any of the wallets may do.
+
+        :return:
+            UserWallet: The open wallet.
+        """
+        for session in self.sessions:
+            if session.try_acquire():
+                try:
+                    with session.use() as wallet:
+                        yield wallet
+                finally:
+                    session.release()
+                return
+
+        # Every wallet is busy, wait for the wallets in turn.
+        session = self.sessions[self._next % len(self.sessions)]
+        self._next += 1
+        with session.use() as wallet:
+            yield wallet
+
+    def health(self):
+        """
+        The health and sync state of every wallet of the pool.
+
+        :return:
+            list: The health of each wallet session.
+        """
+        return [session.health() for session in self.sessions]
@@ -0,0 +1,142 @@
+"""
+=====================================================================================
+
+Round trip tests of the codec of the LootMarkets smart contract storage format.
+
+The lists are serialized with serialize_array, which writes the same bytes as the serialize_array
+helper of the smart contract, and decoded back with the codec.
+
+=====================================================================================
+"""
+
+import unittest
+from LootMarketCodec import encode_int, decode_int, serialize_var_length_item, serialize_array, \
+    deserialize_bytearray, decode_ints, bulk_decode_ints, numpy
+
+
+class EncodeIntTest(unittest.TestCase):
+
+    def test_zero_has_no_bytes(self):
+        self.assertEqual(encode_int(0), b'')
+        self.assertEqual(decode_int(b''), 0)
+
+    def test_sign_bit_edges(self):
+        # A positive integer whose high bit is set takes an extra byte, so it is not read back as negative.
+        self.assertEqual(encode_int(127), b'\x7f')
+        self.assertEqual(encode_int(128), b'\x80\x00')
+        self.assertEqual(encode_int(255), b'\xff\x00')
+        self.assertEqual(encode_int(32767), b'\xff\x7f')
+        self.assertEqual(encode_int(32768), b'\x00\x80\x00')
+
+    def test_negative(self):
+        self.assertEqual(encode_int(-1), b'\xff')
+        self.assertEqual(encode_int(-128), b'\x80')
+        self.assertEqual(encode_int(-129), b'\x7f\xff')
+        for value in (-1, -128, -129, -32768, -2 ** 70):
+            self.assertEqual(int.from_bytes(encode_int(value), 'little', signed=True), value)
+
+    def test_round_trip(self):
+        for value in (1, 127, 128, 255, 256, 65535, 65536, 2 ** 31, 2 ** 63 - 1, 2 ** 64, 2 ** 200):
+            self.assertEqual(decode_int(encode_int(value)), value)
+
+
+class SerializeVarLengthItemTest(unittest.TestCase):
+
+    def test_prefix(self):
+        self.assertEqual(serialize_var_length_item(0), b'\x01')
+        self.assertEqual(serialize_var_length_item(1), b'\x01\x01')
+        self.assertEqual(serialize_var_length_item(0xfd), b'\x01\xfd\x00')
+        self.assertEqual(serialize_var_length_item(0xff), b'\x01\xff\x00')
+        self.assertEqual(serialize_var_length_item(0x100), b'\x02\x00\x01')
+        self.assertEqual(serialize_var_length_item(0xffff), b'\x02\xff\xff\x00')
+        self.assertEqual(serialize_var_length_item(0x10000), b'\x04\x00\x00\x01')
+
+
+class RoundTripTest(unittest.TestCase):
+
+    def assertItemLengthRoundTrips(self, length):
+        items = [b'a' * length, b'b']
+        self.assertEqual([bytes(item) for item in deserialize_bytearray(serialize_array(items))], items)
+
+    def test_empty_list(self):
+        self.assertEqual(serialize_array([]), b'\x01')
+        self.assertEqual(deserialize_bytearray(serialize_array([])), [])
+        self.assertEqual(decode_ints(serialize_array([])), [])
+
+    def test_missing_value(self):
+        self.assertEqual(deserialize_bytearray(b''), [])
+        self.assertEqual(deserialize_bytearray(None), [])
+
+    def test_bytes(self):
+        items = [b'\x00', b'offer\x03', b'\xff' * 100, b'AK2nJJpJr6o664CWJKi1QRXjqeic2zRp8y']
+        serialized = serialize_array(items)
+        self.assertEqual(serialized[:2], b'\x01\x04')
+        decoded = deserialize_bytearray(serialized)
+        self.assertTrue(all(isinstance(item, memoryview) for item in decoded))
+        self.assertEqual([bytes(item) for item in decoded], items)
+
+    def test_ints(self):
+        values = [1, 5, 127, 128, 255, 256, 65535, 65536, 2 ** 40, 2 ** 64]
+        self.assertEqual(decode_ints(serialize_array(values)), values)
+
+    def test_zero_is_read_as_the_last_item(self):
+        # 0 is written with no bytes, the contract reads its missing length up to the end of the data.
+        self.assertEqual(decode_ints(serialize_array([7, 0])), [7, 0])
+
+    def test_negative_ints(self):
+        values = [-1, -128, -129, -2 ** 40]
+        decoded = deserialize_bytearray(serialize_array(values))
+        self.assertEqual([int.from_bytes(item, 'little', signed=True) for item in decoded], values)
+
+    def test_item_lengths_below_128(self):
+        for length in (1, 0x7e, 0x7f):
+            self.assertItemLengthRoundTrips(length)
+
+    def test_item_lengths_128_to_255_are_not_decodable(self):
+        # The prefix says one byte, the length is written with two.
+        for length in (0x80, 0xfc, 0xfd, 0xfe, 0xff):
+            with self.assertRaises(ValueError):
+                deserialize_bytearray(serialize_array([b'a' * length, b'b']))
+
+    def test_two_byte_item_lengths(self):
+        for length in (0x100, 0x101, 0x7fff):
+            self.assertItemLengthRoundTrips(length)
+
+    def test_item_lengths_32768_to_65535_are_not_decodable(self):
+        for length in (0x8000, 0xfffe, 0xffff):
+            with self.assertRaises(ValueError):
+                deserialize_bytearray(serialize_array([b'a' * length, b'b']))
+
+    def test_list_lengths(self):
+        for length in (0x7f, 0x100, 0x101):
+            values = list(range(1, length + 1))
+            self.assertEqual(decode_ints(serialize_array(values)), values)
+
+    def test_truncated(self):
+        with self.assertRaises(ValueError):
+            deserialize_bytearray(serialize_array([b'abc', b'def'])[:-1])
+
+
+@unittest.skipIf(numpy is None, "bulk_decode_ints requires numpy")
+class BulkDecodeIntsTest(unittest.TestCase):
+
+    def test_matches_decode_ints(self):
+        lists = [[1, 2, 3], [], [255, 256, 65536], [2 ** 63 - 1], [7, 0]]
+        blobs = [serialize_array(values) for values in lists] + [b'', None]
+        values, offsets = bulk_decode_ints(blobs)
+        self.assertEqual(len(offsets), len(blobs) + 1)
+        for i, blob in enumerate(blobs):
+            self.assertEqual(values[offsets[i]:offsets[i + 1]].tolist(), decode_ints(blob))
+
+    def test_no_items(self):
+        values, offsets = bulk_decode_ints([serialize_array([]), b''])
+        self.assertEqual(len(values), 0)
+        self.assertEqual(offsets.tolist(), [0, 0, 0])
+
+    def test_items_over_8_bytes(self):
+        with self.assertRaises(ValueError):
+            bulk_decode_ints([serialize_array([2 ** 64])])
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,190 @@
+"""
+=====================================================================================
+
+Tests of how the invoke queue handles the tasks which fail.
+
+The queue is driven one task at a time with _invoke_task, against an in memory stand-in
+for the redis connection of the journal and the dead letters.
+
+=====================================================================================
+"""
+
+import unittest
+
+try:
+    import LootMarketHandler
+    from LootMarketHandler import LootMarketsSmartContract
+    from LootMarketQueue import InvokeJournal, InvokeScheduler, DeadLetterStore, InfrastructureError
+    from LootMarketEvents import EventHub
+    from LootMarketBulk import BulkGrantJobs
+except ImportError:
+    LootMarketHandler = None
+
+
+class MemoryRedis:
+    """ The redis hash commands the journal, dead letters and bulk grants use, kept in memory. """
+
+    def __init__(self):
+        self.hashes = {}
+
+    def hset(self, name, key, value):
+        self.hashes.setdefault(name, {})[key.encode("utf-8")] = value.encode("utf-8")
+
+    def hmset(self, name, mapping):
+        for key, value in mapping.items():
+            self.hset(name, key, value)
+
+    def hget(self, name, key):
+        return self.hashes.get(name, {}).get(key.encode("utf-8"))
+
+    def hgetall(self, name):
+        return dict(self.hashes.get(name, {}))
+
+    def hdel(self, name, *keys):
+        for key in keys:
+            self.hashes.get(name, {}).pop(key.encode("utf-8"), None)
+
+    def hincrby(self, name, key, amount=1):
+        pass
+
+    def pipeline(self, transaction=True):
+        return MemoryPipeline(self)
+
+
+class MemoryPipeline:
+    """ Runs the commands of a pipeline on MemoryRedis when it is executed. """
+
+    def __init__(self, redis_cache):
+        self.redis_cache = redis_cache
+        self.commands = []
+
+    def __getattr__(self, name):
+        return lambda *args: self.commands.append((getattr(self.redis_cache, name), args))
+
+    def __len__(self):
+        return len(self.commands)
+
+    def execute(self):
+        return [command(*args) for command, args in self.commands]
+
+
+class FaultedTransaction:
+    pass
+
+
+@unittest.skipIf(LootMarketHandler is None, "the handler requires neo-python and redis")
+class InvokeTaskTest(unittest.TestCase):
+
+    def setUp(self):
+        redis_cache = MemoryRedis()
+        handler = LootMarketsSmartContract.__new__(LootMarketsSmartContract)
+        handler.invoke_queue = InvokeScheduler()
+        handler.journal = InvokeJournal(redis_cache)
+        handler.dead_letters = DeadLetterStore(redis_cache)
+        handler.bulk_grants = BulkGrantJobs(redis_cache)
+        handler.events = EventHub()
+        handler.task_attempts = {}
+        handler.task_pauses = {}
+        handler.tx_in_progress = set()
+        handler.max_packed_operations = 1
+        handler.max_coalesced_items = 10
+        self.handler = handler
+
+        # The tasks relayed, a script faults if it gives the item 666.
+        self.relayed = []
+        handler._build_invoke_script = lambda wallet, operation_name, args: repr(args).encode("utf-8")
+        handler.invoke_operation = self.invoke_operation
+
+        self.test_invoke = LootMarketHandler.test_invoke
+        LootMarketHandler.test_invoke = self.fake_test_invoke
+
+    def tearDown(self):
+        LootMarketHandler.test_invoke = self.test_invoke
+
+    def fake_test_invoke(self, script, wallet, outputs):
+        if b"666" in script:
+            # The engine ended in the FAULT state.
+            return FaultedTransaction(), None, [], 10
+        return FaultedTransaction(), None, [True], 10
+
+    def invoke_operation(self, operation_name, transaction_key, *args):
+        tasks, tx, fee = self.handler._pack_tasks(None, (operation_name, transaction_key, list(args)))
+        self.relayed.extend(tasks)
+        return True
+
+    def add_invoke(self, transaction_key, args, priority=None):
+        task = ("give_items", transaction_key, ["LootClicker"] + args)
+        self.handler.journal.acked(task[0], transaction_key, task[2])
+        self.handler.invoke_queue.put(task, priority=priority)
+
+    def drain(self):
+        while not self.handler.invoke_queue.empty():
+            task = self.handler.invoke_queue.get_nowait()
+            self.handler.invoke_queue.task_done()
+            self.assertIsNone(self.handler._invoke_task(task))
+
+    def test_faulting_task_is_dead_lettered(self):
+        self.add_invoke("poison", ["AK2nJJpJr6o664CWJKi1QRXjqeic2zRp8y", 666])
+        self.add_invoke("next", ["AK2nJJpJr6o664CWJKi1QRXjqeic2zRp8y", 1])
+        self.drain()
+
+        dead_letter = self.handler.dead_letters.get("poison")
+        self.assertEqual(dead_letter["reason"], "permanent")
+        self.assertEqual(dead_letter["attempts"], 1)
+        self.assertEqual([task[1] for task in self.relayed], ["next"])
+        self.assertEqual([entry[1] for entry in self.handler.journal.unfinished()], ["next"])
+        self.assertEqual(self.handler.paused_until, 0)
+
+    def test_task_raising_while_test_invoked_is_dead_lettered(self):
+        def raising_test_invoke(script, wallet, outputs):
+            if b"666" in script:
+                # The VM raised while running the script.
+                return None, None, None, None
+            return self.fake_test_invoke(script, wallet, outputs)
+        LootMarketHandler.test_invoke = raising_test_invoke
+
+        self.add_invoke("poison", ["AK2nJJpJr6o664CWJKi1QRXjqeic2zRp8y", 666])
+        self.add_invoke("next", ["AK2nJJpJr6o664CWJKi1QRXjqeic2zRp8y", 1])
+        self.drain()
+
+        self.assertEqual(self.handler.dead_letters.get("poison")["reason"], "permanent")
+        self.assertEqual([task[1] for task in self.relayed], ["next"])
+
+    def test_task_pausing_the_queue_is_counted_as_an_attempt(self):
+        self.handler.max_attempts = 1
+
+        def failing_invoke_operation(operation_name, transaction_key, *args):
+            raise InfrastructureError("Wallet has no gas.")
+        self.handler.invoke_operation = failing_invoke_operation
+
+        self.add_invoke("stuck", ["AK2nJJpJr6o664CWJKi1QRXjqeic2zRp8y", 1])
+        task = self.handler.invoke_queue.get_nowait()
+        self.handler.invoke_queue.task_done()
+
+        # The queue is paused with the task at its head, up to max_task_pauses times.
+        for pauses in range(self.handler.max_task_pauses):
+            self.assertIs(self.handler._invoke_task(task), task)
+            self.assertIsNone(self.handler.dead_letters.get("stuck"))
+
+        self.assertIsNone(self.handler._invoke_task(task))
+        self.assertEqual(self.handler.dead_letters.get("stuck")["reason"], "infrastructure")
+        self.assertEqual(self.handler.task_pauses, {})
+
+    def test_give_items_are_coalesced_within_the_class_of_the_task(self):
+        # The give_items of a bulk grant wait behind the ones given a higher priority.
+        self.add_invoke("grant", ["AK2nJJpJr6o664CWJKi1QRXjqeic2zRp8y", 1])
+        self.add_invoke("first", ["AK2nJJpJr6o664CWJKi1QRXjqeic2zRp8y", 2], priority="market")
+        self.add_invoke("second", ["AK2nJJpJr6o664CWJKi1QRXjqeic2zRp8y", 3], priority="market")
+
+        task = self.handler.invoke_queue.get_nowait()
+        self.handler.invoke_queue.task_done()
+        self.assertEqual(task[1], "first")
+
+        merged = self.handler._coalesce_give_items(task)
+        self.assertEqual(merged[1], ["first", "second"])
+        self.assertEqual(merged[2][2:], [2, 3])
+        self.assertEqual(self.handler.invoke_queue.get_nowait()[1], "grant")
+
+
+if __name__ == "__main__":
+    unittest.main()
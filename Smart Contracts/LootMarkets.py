@@ -39,6 +39,7 @@ contract_owner = b'\xb2\x97\xed\x8c\x0b-$M?\xde\xc8j\xd1 \xd7\x8d\xef\xa3\x9c\xd
 inventory_key = b'Inventory'                       # The inventory of an address.
 item_key = b'item'                                 # The details of an item.
 marketplace_key = b'marketplace'                   # The owner of a marketplace
+operators_key = b'operators'                       # The addresses allowed to operate a marketplace for its owner.
 offers_key = b'Offers'                             # All the offers available on a marketplace.
 current_offer_index_key = b'current_offer_index'   # The current offer index of a marketplace.
 token_deployed = b'deployed'                       # Has the token been deployed.
@@ -120,7 +121,8 @@ def Main(operation, args):
             marketplace = args[0]
             address = args[1]
             operation_result = give_items(args)
-            transaction_details = ["give_items", marketplace, address, operation_result]
+            # Notify the args after the result, the items given follow the marketplace and address.
+            transaction_details = ["give_items", marketplace, address, operation_result, args]
             Notify(transaction_details)
             return operation_result
 
@@ -131,7 +133,7 @@ def Main(operation, args):
                 address = args[1]
                 item_id = args[2]
                 operation_result = remove_item(marketplace, address, item_id)
-                transaction_details = ["remove_item", marketplace, address, operation_result]
+                transaction_details = ["remove_item", marketplace, address, operation_result, item_id]
                 Notify(transaction_details)
                 return operation_result
 
@@ -174,8 +176,10 @@ def Main(operation, args):
                 address = args[1]
                 item_id = args[2]
                 price = args[3]
+                # Notify the offer after the result, so the API can keep its offer book without querying the offers.
+                offer_id = next_offer_id(marketplace)
                 operation_result = put_offer(marketplace, address, item_id, price)
-                transaction_details = ["put_offer", marketplace, address, operation_result]
+                transaction_details = ["put_offer", marketplace, address, operation_result, offer_id, item_id, price]
                 Notify(transaction_details)
                 return operation_result
 
@@ -185,8 +189,10 @@ def Main(operation, args):
                 marketplace = args[0]
                 address_to = args[1]
                 offer_id = args[2]
+                # Notify the item of the offer, so the API can update the inventory it is given to.
+                item_id = offer_item_id(marketplace, offer_id)
                 operation_result = buy_offer(marketplace, address_to, offer_id)
-                transaction_details = ["buy_offer", marketplace, address_to, operation_result]
+                transaction_details = ["buy_offer", marketplace, address_to, operation_result, offer_id, item_id]
                 Notify(transaction_details)
                 return operation_result
 
@@ -196,8 +202,10 @@ def Main(operation, args):
                 marketplace = args[0]
                 address = args[1]
                 offer_id = args[2]
+                # Notify the item of the offer, so the API can update the inventory it is given back to.
+                item_id = offer_item_id(marketplace, offer_id)
                 operation_result = cancel_offer(marketplace, address, offer_id)
-                transaction_details = ["cancel_offer", marketplace, address, operation_result]
+                transaction_details = ["cancel_offer", marketplace, address, operation_result, offer_id, item_id]
                 Notify(transaction_details)
                 return operation_result
 
@@ -264,6 +272,20 @@ def Main(operation, args):
                     address = args[1]
                     return register_marketplace(marketplace, address)
 
+            # Allow an address to invoke the operations of a marketplace alongside its owner.
+            if operation == "add_marketplace_operator":
+                if len(args) == 2:
+                    marketplace = args[0]
+                    address = args[1]
+                    return add_marketplace_operator(marketplace, address)
+
+            # Revoke an operator of a marketplace.
+            if operation == "remove_marketplace_operator":
+                if len(args) == 2:
+                    marketplace = args[0]
+                    address = args[1]
+                    return remove_marketplace_operator(marketplace, address)
+
             # Register a list of addresses for KYC.
             if operation == "kyc_register":
                 return kyc_register(args)
@@ -350,9 +372,8 @@ def give_items(args):
     address = args[1]
 
     # Check marketplace permissions.
-    owner = marketplace_owner(marketplace)
-    if not CheckWitness(owner):
-        print("Operation Forbidden: Only the owner of this marketplace may invoke the operation - give_items")
+    if not is_marketplace_authorized(marketplace):
+        print("Operation Forbidden: Only the owner or an operator of this marketplace may invoke the operation - give_items")
         return False
 
     # Get the address's inventory from storage.
@@ -390,9 +411,8 @@ def remove_item(marketplace, address, item_id):
     """
 
     # Check marketplace permissions.
-    owner = marketplace_owner(marketplace)
-    if not CheckWitness(owner):
-        print("Operation Forbidden: Only the owner of this marketplace may invoke the operation - remove_item")
+    if not is_marketplace_authorized(marketplace):
+        print("Operation Forbidden: Only the owner or an operator of this marketplace may invoke the operation - remove_item")
         return False
 
     # Get the address's inventory.
@@ -425,9 +445,8 @@ def transfer_item(marketplace, address_from, address_to, item_id):
         bool:Whether the transfer of the item was successful.
     """
     # Check marketplace permissions.
-    owner = marketplace_owner(marketplace)
-    if not CheckWitness(owner):
-        print("Operation Forbidden: Only the owner of this marketplace may invoke the operation - transfer_item")
+    if not is_marketplace_authorized(marketplace):
+        print("Operation Forbidden: Only the owner or an operator of this marketplace may invoke the operation - transfer_item")
         return False
 
     # If the item is being transferred to the same address, don't waste gas and return True.
@@ -456,9 +475,8 @@ def create_item(marketplace, item_id, item_type, item_rarity, item_damage):
     :return:
         bool: Whether the item was created.
     """
-    owner = marketplace_owner(marketplace)
-    if not CheckWitness(owner):
-        print("Operation Forbidden: Only the owner of this marketplace may invoke the operation - create_item")
+    if not is_marketplace_authorized(marketplace):
+        print("Operation Forbidden: Only the owner or an operator of this marketplace may invoke the operation - create_item")
         return False
 
     context = GetContext()
@@ -563,9 +581,8 @@ def put_offer(marketplace, address, item_id, price):
         return False
 
     # Check marketplace permissions.
-    owner = marketplace_owner(marketplace)
-    if not CheckWitness(owner):
-        print("Operation Forbidden: Only the owner of this marketplace may invoke the operation - put_offer")
+    if not is_marketplace_authorized(marketplace):
+        print("Operation Forbidden: Only the owner or an operator of this marketplace may invoke the operation - put_offer")
         return False
 
     # If the removal of the item from the address was successful, put the offer up.
@@ -578,15 +595,10 @@ def put_offer(marketplace, address, item_id, price):
         # Concatenate the key to get all the offers on the marketplace.
         marketplace_offers_key = concat(offers_key,marketplace)
 
-        # If the index has not been set yet we create it, else we create a new offer id with the current index.
+        # If the index has not been set yet we create it.
+        marketplace_offer_id = next_offer_id(marketplace)
         if not index:
             index = 1
-            marketplace_offer_id = concat(marketplace, "offer\x01")
-        else:
-            # Create the offer id to put into storage.
-            offer_id = concat("offer", index)
-            # Concatenate the name of the marketplace and offer so we can access these offers on individual markets.
-            marketplace_offer_id = concat(marketplace, offer_id)
 
         # Get the list of all offers that are currently up in the marketplace.
         all_offers_s = get_all_offers(marketplace)
@@ -619,6 +631,29 @@ def put_offer(marketplace, address, item_id, price):
     return False
 
 
+def next_offer_id(marketplace):
+    """
+    Return the id the next offer put on a marketplace is given.
+
+    :param marketplace:str The name of the marketplace to access.
+    :return:
+        bytearray: The name of the marketplace concatenated with 'offer' and the index of the offer.
+    """
+    context = GetContext()
+
+    # Concatenate the key to get the current index of the marketplace, then get the current offer index.
+    marketplace_index_key = concat(current_offer_index_key, marketplace)
+    index = Get(context, marketplace_index_key)
+
+    # If the index has not been set yet the first offer is given the index 1.
+    if not index:
+        return concat(marketplace, "offer\x01")
+
+    # Concatenate the name of the marketplace and offer so we can access these offers on individual markets.
+    offer_id = concat("offer", index)
+    return concat(marketplace, offer_id)
+
+
 def new_offer(address_owner, offer_id, item_id, price):
     """
     Helper method used to create a new offer container object.
@@ -654,9 +689,8 @@ def buy_offer(marketplace, address_from, offer_id):
     """
 
     # Check marketplace permissions.
-    owner = marketplace_owner(marketplace)
-    if not CheckWitness(owner):
-        print("Operation Forbidden: Only the owner of this marketplace may invoke the operation - buy_offer")
+    if not is_marketplace_authorized(marketplace):
+        print("Operation Forbidden: Only the owner or an operator of this marketplace may invoke the operation - buy_offer")
         return False
 
     # Deserialize the retrieved offer object from storage.
@@ -695,9 +729,8 @@ def cancel_offer(marketplace, address, offer_id):
     """
 
     # Check marketplace permissions.
-    owner = marketplace_owner(marketplace)
-    if not CheckWitness(owner):
-        print("Operation Forbidden: Only the owner of this marketplace may invoke the operation - cancel_offer")
+    if not is_marketplace_authorized(marketplace):
+        print("Operation Forbidden: Only the owner or an operator of this marketplace may invoke the operation - cancel_offer")
         return False
 
     # Deserialize the retrieved offer object from storage.
@@ -795,6 +828,25 @@ def get_offer(marketplace,offer_id):
     offer_s = Get(context, marketplace_offer_key)
     return offer_s
 
+
+def offer_item_id(marketplace, offer_id):
+    """
+    Return the id of the item of an offer on a marketplace.
+
+    :param marketplace:str The name of the marketplace to access.
+    :param offer_id: The id of the offer.
+    :return:
+        int: The id of the item of the offer, or 0 if there is no offer.
+    """
+    offer_s = get_offer(marketplace, offer_id)
+
+    # If there is no offer, return 0.
+    if not offer_s:
+        return 0
+
+    offer = deserialize_bytearray(offer_s)
+    return offer[2]
+
 # endregion
 
 
@@ -838,6 +890,110 @@ def marketplace_owner(marketplace):
     owner = Get(context, owner_key)
     return owner
 
+
+def add_marketplace_operator(marketplace, address):
+    """
+    Allow an address to invoke the operations of a marketplace, so the operations can be
+    signed by several wallets at once. Like registering a marketplace, only the contract owner
+    may add the operators, the wallets of the API are authorized by whoever deploys it.
+
+    :param marketplace:str The name of the marketplace to add the operator to.
+    :param address:str The address of the operator.
+    :return:
+        bool: Whether the operator was added.
+    """
+    context = GetContext()
+
+    # The marketplace must exist.
+    if not marketplace_owner(marketplace):
+        print("No marketplace with this name exists!")
+        return False
+
+    # Get the operators of the marketplace from storage.
+    marketplace_operators_key = concat(operators_key, marketplace)
+    operators_s = Get(context, marketplace_operators_key)
+
+    if not operators_s:
+        operators = []
+    else:
+        operators = deserialize_bytearray(operators_s)
+
+    # If the address is already an operator, return True.
+    for operator in operators:
+        if operator == address:
+            return True
+
+    # Serialize and save the modified operators back into storage.
+    operators.append(address)
+    operators_s = serialize_array(operators)
+    Put(context, marketplace_operators_key, operators_s)
+    return True
+
+
+def remove_marketplace_operator(marketplace, address):
+    """
+    Revoke the permission of an address to invoke the operations of a marketplace, only the
+    contract owner may remove the operators.
+
+    :param marketplace:str The name of the marketplace to remove the operator from.
+    :param address:str The address of the operator.
+    :return:
+        bool: Whether the operator was removed.
+    """
+    context = GetContext()
+
+    # Get the operators of the marketplace from storage.
+    marketplace_operators_key = concat(operators_key, marketplace)
+    operators_s = Get(context, marketplace_operators_key)
+
+    if not operators_s:
+        return False
+    operators = deserialize_bytearray(operators_s)
+
+    current_index = 0
+    for operator in operators:
+        # If the address is an operator, remove it at the current index and save the modified operators.
+        if operator == address:
+            operators.remove(current_index)
+            Delete(context, marketplace_operators_key)
+            # The key is left deleted once the last operator is removed.
+            if len(operators) > 0:
+                operators_s = serialize_array(operators)
+                Put(context, marketplace_operators_key, operators_s)
+            return True
+        current_index += 1
+
+    return False
+
+
+def is_marketplace_authorized(marketplace):
+    """
+    Check if the invoker is the owner or an operator of a marketplace.
+
+    :param marketplace:str The name of the marketplace to check the permissions of.
+    :return:
+        bool: Whether the owner or an operator of the marketplace witnessed the invocation.
+    """
+    context = GetContext()
+
+    owner = marketplace_owner(marketplace)
+    if CheckWitness(owner):
+        return True
+
+    # Get the operators of the marketplace from storage.
+    marketplace_operators_key = concat(operators_key, marketplace)
+    operators_s = Get(context, marketplace_operators_key)
+
+    if not operators_s:
+        return False
+
+    operators = deserialize_bytearray(operators_s)
+    for operator in operators:
+        if CheckWitness(operator):
+            return True
+
+    return False
+
 # endregion
 
 